@@ -9,6 +9,41 @@ api_url = os.environ.get("APP_URL") + "api/"
 api_header = {"Authorization": "Token {}".format(os.environ.get("AZ_FUNCTION_KEY"))}
 
 
+def lookup_nlp_cache(documents):
+    """
+    Get the cached codes of those documents which have been through NLP
+    before, as {document id: codes}. The cache is best-effort: if it can't
+    be reached, every document is sent to NLP.
+    """
+    try:
+        response = requests.post(
+            url=api_url + "nlpcache/lookup/",
+            headers=api_header,
+            json={"documents": documents},
+        )
+        response.raise_for_status()
+        return response.json()["hits"]
+    except (requests.RequestException, ValueError, KeyError) as e:
+        print("NLP CACHE LOOKUP FAILED >>> ", e)
+        return {}
+
+
+def store_nlp_cache(documents):
+    """
+    Cache the codes NLP found in each of `documents`, [{text, codes}]. A
+    failure is only logged, as the codes are saved regardless.
+    """
+    try:
+        response = requests.post(
+            url=api_url + "nlpcache/",
+            headers=api_header,
+            json={"documents": documents},
+        )
+        response.raise_for_status()
+    except requests.RequestException as e:
+        print("NLP CACHE STORE FAILED >>> ", e)
+
+
 def main(msg: func.QueueMessage):
 
     # Define NLP things
@@ -27,52 +62,84 @@ def main(msg: func.QueueMessage):
 
     message = json.loads(message)
     print("MESSAGE >>> ", message)
-    print(message["body"])
 
-    post_response_url = []
-    response = requests.post(url, headers=headers, data=message["body"])
-    post_response_url.append(response.headers["operation-location"])
+    # Each message holds a batch of documents, sized by the webapp to fit
+    # into a single NLP request
+    documents = json.loads(message["body"])["documents"]
+    print("DOCUMENTS >>> ", len(documents))
+
+    # Documents which have been through NLP before are taken from the cache
+    hits = lookup_nlp_cache(documents)
+    print("CACHE HITS >>> ", len(hits))
+    codes = [
+        [document_id] + code
+        for document_id, document_codes in hits.items()
+        for code in document_codes
+    ]
+
+    misses = [document for document in documents if document["id"] not in hits]
+    if misses:
+        post_response_url = []
+        response = requests.post(
+            url, headers=headers, data=json.dumps({"documents": misses})
+        )
+        response.raise_for_status()
+        post_response_url.append(response.headers["operation-location"])
 
-    # Get the data back from NLP API, convert code to conceptIDs
-    get_response = omop_helpers.get_data_from_nlp(
-        url=url, headers=headers, post_response_url=post_response_url
-    )
+        # Get the data back from NLP API, convert code to conceptIDs.
+        # Raises if the job fails, so that the message is retried
+        get_response = omop_helpers.get_data_from_nlp(
+            url=url, headers=headers, post_response_url=post_response_url
+        )
+
+        # A document which fails does not fail the rest of the batch
+        for error in get_response.get("errors", []):
+            print("NLP ERROR >>> ", error)
+
+        new_codes = omop_helpers.process_nlp_response(get_response)
+        codes += new_codes
+
+        # Cache the codes of every document processed, including those with none
+        processed = {document["id"]: [] for document in get_response["documents"]}
+        for code in new_codes:
+            processed[code[0]].append(code[1:])
+        texts = {document["id"]: document["text"] for document in misses}
+        store_nlp_cache(
+            [
+                {"text": texts[document_id], "codes": document_codes}
+                for document_id, document_codes in processed.items()
+            ]
+        )
 
-    codes = omop_helpers.process_nlp_response(get_response)
     codes_dict = omop_helpers.concept_code_to_id(codes)
 
+    # Build every ScanReportConcept in the job, skipping repeats of the same
+    # concept on the same object
+    payloads = {}
     for item in codes_dict:
 
-        if item["pk"].split("_")[1] == "field":
-
-            print("SAVING TO FIELD LEVEL...")
-            payload = {
-                "nlp_entity": item["nlp_entity"],
-                "nlp_entity_type": item["nlp_entity_type"],
-                "nlp_confidence": item["nlp_confidence"],
-                "nlp_vocabulary": item["nlp_vocab"],
-                "nlp_concept_code": item["nlp_code"],
-                "concept": item["conceptid"],
-                "object_id": item["pk"].split("_")[0],
-                "content_type": 15,
-            }
-
-        else:
-
-            print("SAVING TO VALUE LEVEL...")
-            payload = {
-                "nlp_entity": item["nlp_entity"],
-                "nlp_entity_type": item["nlp_entity_type"],
-                "nlp_confidence": item["nlp_confidence"],
-                "nlp_vocabulary": item["nlp_vocab"],
-                "nlp_concept_code": item["nlp_code"],
-                "concept": item["conceptid"],
-                "object_id": item["pk"].split("_")[0],
-                "content_type": 17,
-            }
-
-        print("PAYLOAD >>>", payload)
+        object_id, level = item["pk"].split("_")
+        content_type = 15 if level == "field" else 17
+        key = (item["conceptid"], object_id, content_type)
+        if key in payloads:
+            continue
+
+        payloads[key] = {
+            "nlp_entity": item["nlp_entity"],
+            "nlp_entity_type": item["nlp_entity_type"],
+            "nlp_confidence": item["nlp_confidence"],
+            "nlp_vocabulary": item["nlp_vocab"],
+            "nlp_concept_code": item["nlp_code"],
+            "concept": item["conceptid"],
+            "object_id": int(object_id),
+            "content_type": content_type,
+        }
 
+    print("SAVING CONCEPTS >>>", len(payloads))
+    if payloads:
         response = requests.post(
-            url=api_url + "scanreportconcepts/", headers=api_header, data=payload
+            url=api_url + "scanreportconcepts/",
+            headers=api_header,
+            json=list(payloads.values()),
         )
+        response.raise_for_status()
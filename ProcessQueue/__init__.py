@@ -672,13 +672,18 @@ async def process_values_from_sheet(
     # Get the details of all the SRValues posted in this table. Then we will be able
     # to run them through the vocabulary mapper and apply any automatic vocab mappings.
 
-    # GET values where the scan_report_table is the current table.
+    # GET values where the scan_report_table is the current table, streamed one
+    # value per line so that large tables don't have to be sent in one response.
     logger.debug("GET posted values")
-    details_of_posted_values = requests.get(
+    values_response = requests.get(
         url=f"{API_URL}scanreportvaluesfilterscanreporttable/?scan_report_table"
-        f"={current_table_id}",
+        f"={current_table_id}&format=ndjson",
         headers=HEADERS,
-    ).json()
+        stream=True,
+    )
+    details_of_posted_values = [
+        json.loads(line) for line in values_response.iter_lines() if line
+    ]
     logger.debug("GET posted values finished")
 
     # ---------------------------------------------------------------------------------
@@ -49,6 +49,7 @@ INSTALLED_APPS = [
     "django.contrib.messages",
     "whitenoise.runserver_nostatic",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "extra_views",
     "mapping",
     "data",
@@ -165,5 +166,42 @@ EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
 
 # NLP API KEY
 NLP_API_KEY = os.getenv("NLP_API_KEY")
+# NLP results are cached per model version, for NLP_CACHE_TTL_DAYS days
+NLP_MODEL_VERSION = os.getenv("NLP_MODEL_VERSION", "v3.1-preview.5")
+NLP_CACHE_TTL_DAYS = int(os.getenv("NLP_CACHE_TTL_DAYS", 180))
 
 SESSION_COOKIE_AGE = 86400  # session length is 24 hours
+
+# Long mapping operations run as jobs, on this many threads of each web
+# process. Set to 0 to leave them to `manage.py run_jobs` instead.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+# Running jobs are requeued after this many minutes, as their worker has died
+JOB_TIMEOUT_MINUTES = int(os.getenv("JOB_TIMEOUT_MINUTES", 60))
+
+# A concept hierarchy index built by `manage.py concept_hierarchy build`, for
+# ancestor/descendant lookups without querying `concept_ancestor`
+CONCEPT_HIERARCHY_PATH = os.getenv("CONCEPT_HIERARCHY_PATH")
+
+# Mapping rules diagrams with more nodes than this are not drawn, as graphviz
+# takes too long to lay them out. Their destination tables are drawn one by one.
+MAPPING_RULES_SVG_MAX_NODES = int(os.getenv("MAPPING_RULES_SVG_MAX_NODES", 1000))
+
+# Responses of the OMOP vocabulary endpoints are cached in the "vocabulary"
+# cache, in process memory by default. VOCABULARY_CACHE_BACKEND takes any
+# Django cache backend, e.g. FileBasedCache with VOCABULARY_CACHE_LOCATION a
+# directory, or a memcached or Redis backend with its server.
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "vocabulary": {
+        "BACKEND": os.getenv(
+            "VOCABULARY_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.getenv("VOCABULARY_CACHE_LOCATION", "vocabulary"),
+        "TIMEOUT": int(os.getenv("VOCABULARY_CACHE_SECONDS", 86400)),
+    },
+}
+# Clients may reuse vocabulary responses for this long without revalidating
+VOCABULARY_CACHE_SECONDS = int(os.getenv("VOCABULARY_CACHE_SECONDS", 86400))
+# Set on loading a new vocabulary to change the cache keys straight away,
+# rather than once the vocabulary table is read again
+VOCABULARY_VERSION = os.getenv("VOCABULARY_VERSION")
@@ -13,6 +13,7 @@ from .models import (
     DataDictionary,
     MappingRule,
     NLPModel,
+    NLPCacheEntry,
     ScanReportConcept,
     Dataset,
     Project,
@@ -184,6 +185,17 @@ class ScanReportConceptAdmin(admin.ModelAdmin):
     )
 
 
+class NLPCacheEntryAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "model_version",
+        "hits",
+        "misses",
+        "last_hit_at",
+        "updated_at",
+    )
+
+
 class DatasetAdmin(admin.ModelAdmin):
     filter_horizontal = (
         "viewers",
@@ -220,6 +232,7 @@ admin.site.register(OmopField, OmopFieldAdmin)
 admin.site.register(MappingRule, MappingRuleAdmin)
 admin.site.register(DataDictionary, DataDictionaryAdmin)
 admin.site.register(NLPModel)
+admin.site.register(NLPCacheEntry, NLPCacheEntryAdmin)
 admin.site.register(ScanReportConcept, ScanReportConceptAdmin)
 admin.site.register(Dataset, DatasetAdmin)
 admin.site.register(Project, ProjectAdmin)
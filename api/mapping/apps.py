@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class MappingConfig(AppConfig):
     name = "mapping"
+
+    def ready(self):
+        # Connect the signal handlers maintaining the access tables
+        from . import signals  # noqa: F401
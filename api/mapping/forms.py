@@ -13,7 +13,7 @@ from mapping.models import (
 )
 import openpyxl
 import csv
-from io import BytesIO, StringIO
+from io import StringIO
 from collections import Counter
 
 
@@ -142,6 +142,10 @@ class ScanReportForm(forms.Form):
         Runs a number of consistency checks on the provided workbook. The aim is to
         return quickly if there is an issue with the data, and provide feedback to the
         user so they can fix the issue.
+
+        The workbook may be opened read-only: the first two columns of the Field
+        Overview sheet are streamed through once, and only the first row of each
+        other sheet is read.
         """
         errors = []
         # Get the first sheet 'Field Overview'
@@ -149,7 +153,14 @@ class ScanReportForm(forms.Form):
 
         # Grab the scan report columns from the first worksheet
         # Define what the column headings should be
-        source_headers = [header.value for header in fo_ws[1]]
+        source_headers = list(
+            next(
+                fo_ws.iter_rows(
+                    min_row=1, max_row=1, max_col=fo_ws.max_column, values_only=True
+                ),
+                (None,),
+            )
+        )
 
         expected_headers = [
             "Table",
@@ -182,26 +193,61 @@ class ScanReportForm(forms.Form):
             )
             raise ValidationError(errors)
 
-        # Check tables are correctly separated in FO - a single empty line between each
-        # table
-        cell_above = fo_ws["A"][1]
-        for cell in fo_ws["A"][1:]:
+        # Read the tables and fields of the FO sheet in a single pass. Along the way,
+        # check tables are correctly separated - a single empty line between each
+        # table - and collect the table names, and the fields of each table up to the
+        # first two empty lines in a row, beyond which there are only spurious rows.
+        table_names = set()
+        tables = []
+        current_table_fields = []
+        current_table_name = None
+        value_above = None
+        last_value = None
+        collecting = True
+        rows = fo_ws.iter_rows(min_row=2, max_col=2, values_only=True)
+        for row_number, row in enumerate(rows, start=2):
+            value, field = (tuple(row) + (None, None))[:2]
+            if row_number == 2:
+                value_above = value
             if (
-                cell.value != cell_above.value
-                and (cell.value != "" and cell.value is not None)
-                and (cell_above.value != "" and cell_above.value is not None)
-            ) or (cell.value == "" and cell_above.value == ""):
+                value != value_above
+                and (value != "" and value is not None)
+                and (value_above != "" and value_above is not None)
+            ) or (value == "" and value_above == ""):
                 errors.append(
                     ValidationError(
-                        f"At {cell}, tables in Field Overview "
-                        f"table are not correctly separated by "
+                        f"At <Cell {fo_ws.title!r}.A{row_number}>, tables in Field "
+                        f"Overview table are not correctly separated by "
                         f"a single line. "
                         f"Note: There should be no separator "
                         f"line between the header row and the "
                         f"first row of the first table."
                     )
                 )
-            cell_above = cell
+            value_above = value
+
+            if value != "" and value is not None:
+                table_names.add(value)
+
+            if not collecting:
+                continue
+            if value == "" or value is None:
+                # We're at the end of the table, unless this is the second empty
+                # line in a row
+                if last_value == "" or last_value is None:
+                    collecting = False
+                    continue
+                tables.append((current_table_name, current_table_fields))
+                current_table_fields = []
+            else:
+                # We can trust the table name not to change in this case due to the
+                # check for empty lines between tables.
+                current_table_fields.append(field)
+                current_table_name = value
+            last_value = value
+        # The last table may run to the end of the sheet
+        if collecting and current_table_fields:
+            tables.append((current_table_name, current_table_fields))
 
         if errors:
             raise ValidationError(errors)
@@ -210,11 +256,6 @@ class ScanReportForm(forms.Form):
         # on to comparing its contents to the sheets
 
         # Check tables in FO match supplied sheets
-        table_names = set(
-            cell.value
-            for cell in fo_ws["A"][1:]
-            if (cell.value != "" and cell.value is not None)
-        )
         # Drop "Table Overview" and "_" sheetnames if present, as these are never used.
         table_names.difference_update(["Table Overview", "_"])
 
@@ -255,108 +296,87 @@ class ScanReportForm(forms.Form):
         if errors:
             raise ValidationError(errors)
 
-        # Loop over the rows, and for each table, once we reach the end of the table,
-        # compare the fields provided with the fields in the associated sheet
-        current_table_fields = []
-        last_value = None
-        for row in fo_ws.iter_rows(min_row=2):
-            # Loop over rows, collecting all fields in each table in turn
-            if row[0].value == "" or row[0].value is None:
-                # We're at the end of the table, so process
-                # Firstly, check that we're not two empty lines in a row - if so,
-                # then we're beyond the last true value and iter_rows is just giving
-                # us spurious rows. Abort early.
-                if last_value == "" or last_value is None:
-                    break
-                # Get all field names from the associated sheet, by grabbing the first
-                # row, and then grabbing every second column value (because the
-                # alternate columns should be 'Frequency'
-                table_sheet_fields = [
-                    cell.value for cell in next(wb[current_table_name].rows)
-                ][::2]
-
-                # Check for multiple columns in a single sheet with the same name
-                count_table_sheet_fields = Counter(table_sheet_fields)
-                for field in count_table_sheet_fields:
-                    if count_table_sheet_fields[field] > 1:
-                        errors.append(
-                            ValidationError(
-                                f"Sheet '{current_table_name}' "
-                                f"contains more than one field "
-                                f"with the name '{field}'. "
-                                f"Field names must be unique "
-                                f"within a table."
-                            )
+        # For each table, compare the fields provided with the fields in the
+        # associated sheet
+        for current_table_name, current_table_fields in tables:
+            # Get all field names from the associated sheet, by grabbing the first
+            # row, and then grabbing every second column value (because the
+            # alternate columns should be 'Frequency'
+            table_sheet_fields = list(
+                next(
+                    wb[current_table_name].iter_rows(max_row=1, values_only=True),
+                    (None,),
+                )
+            )[::2]
+
+            # Check for multiple columns in a single sheet with the same name
+            count_table_sheet_fields = Counter(table_sheet_fields)
+            for field in count_table_sheet_fields:
+                if count_table_sheet_fields[field] > 1:
+                    errors.append(
+                        ValidationError(
+                            f"Sheet '{current_table_name}' "
+                            f"contains more than one field "
+                            f"with the name '{field}'. "
+                            f"Field names must be unique "
+                            f"within a table."
                         )
+                    )
 
-                # Check for multiple fields with the same name associated to a single
-                # table in the Field Overview sheet
-                count_current_table_fields = Counter(current_table_fields)
-                for field in count_current_table_fields:
-                    if count_current_table_fields[field] > 1:
-                        errors.append(
-                            ValidationError(
-                                f"Field Overview sheet contains "
-                                f"more than one field with the "
-                                f"name '{field}' against the "
-                                f"table '{current_table_name}'. "
-                                f"Field names must be unique "
-                                f"within a table."
-                            )
+            # Check for multiple fields with the same name associated to a single
+            # table in the Field Overview sheet
+            count_current_table_fields = Counter(current_table_fields)
+            for field in count_current_table_fields:
+                if count_current_table_fields[field] > 1:
+                    errors.append(
+                        ValidationError(
+                            f"Field Overview sheet contains "
+                            f"more than one field with the "
+                            f"name '{field}' against the "
+                            f"table '{current_table_name}'. "
+                            f"Field names must be unique "
+                            f"within a table."
                         )
+                    )
 
-                # Check for any fields that are in only one of the Field Overview and
-                # the associated sheet
-                if sorted(table_sheet_fields) != sorted(current_table_fields):
-                    sheet_only = set(table_sheet_fields).difference(
-                        current_table_fields
+            # Check for any fields that are in only one of the Field Overview and
+            # the associated sheet
+            if sorted(table_sheet_fields) != sorted(current_table_fields):
+                sheet_only = set(table_sheet_fields).difference(current_table_fields)
+                fo_only = set(current_table_fields).difference(table_sheet_fields)
+                errors.append(
+                    ValidationError(
+                        f"Fields in Field Overview against "
+                        f"table {current_table_name} do not "
+                        f"match fields in the associated "
+                        f"sheet. "
                     )
-                    fo_only = set(current_table_fields).difference(table_sheet_fields)
+                )
+                if sheet_only:
                     errors.append(
                         ValidationError(
-                            f"Fields in Field Overview against "
-                            f"table {current_table_name} do not "
-                            f"match fields in the associated "
-                            f"sheet. "
+                            f"{sheet_only} exist in the "
+                            f"'{current_table_name}' sheet "
+                            f"but there are no matching "
+                            f"entries in the second column "
+                            f"of the Field Overview sheet "
+                            f"in the rows associated to the "
+                            f"table '{current_table_name}'. "
+                            f""
                         )
                     )
-                    if sheet_only:
-                        errors.append(
-                            ValidationError(
-                                f"{sheet_only} exist in the "
-                                f"'{current_table_name}' sheet "
-                                f"but there are no matching "
-                                f"entries in the second column "
-                                f"of the Field Overview sheet "
-                                f"in the rows associated to the "
-                                f"table '{current_table_name}'. "
-                                f""
-                            )
-                        )
-                    if fo_only:
-                        errors.append(
-                            ValidationError(
-                                f"{fo_only} exist in second "
-                                f"column of Field Over"
-                                f"view sheet against the table "
-                                f"'{current_table_name}' but "
-                                f"there are no matching column "
-                                f"names in the associated sheet "
-                                f"'{current_table_name}'."
-                            )
+                if fo_only:
+                    errors.append(
+                        ValidationError(
+                            f"{fo_only} exist in second "
+                            f"column of Field Over"
+                            f"view sheet against the table "
+                            f"'{current_table_name}' but "
+                            f"there are no matching column "
+                            f"names in the associated sheet "
+                            f"'{current_table_name}'."
                         )
-
-                # Reset the list of fields associated to this table as we iterate down
-                # the FO sheet.
-                current_table_fields = []
-            else:
-                # Update current list of field names and the current table name - we can
-                # trust the table name not to change in this case due to the earlier
-                # check for empty lines between tables in the FO sheet.
-                current_table_fields.append(row[1].value)
-                current_table_name = row[0].value
-
-            last_value = row[0].value
+                    )
 
         if errors:
             raise ValidationError(errors)
@@ -373,11 +393,15 @@ class ScanReportForm(forms.Form):
                 "is not in XLSX format. Please upload a .xlsx file."
             )
 
-        # Load in the Excel sheet, grab the first workbook
-        file_in_memory = scan_report.read()
-        wb = openpyxl.load_workbook(filename=BytesIO(file_in_memory), data_only=True)
-
-        self.run_fast_consistency_checks(wb)
+        # Stream the Excel sheet from the upload, rather than loading it in full
+        wb = openpyxl.load_workbook(
+            filename=scan_report, read_only=True, data_only=True
+        )
+        try:
+            self.run_fast_consistency_checks(wb)
+        finally:
+            wb.close()
+            scan_report.seek(0)
 
         return scan_report
 
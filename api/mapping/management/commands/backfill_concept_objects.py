@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from mapping.services_backfill import backfill_concept_objects
+
+
+class Command(BaseCommand):
+    help = "Fill in the typed field and value foreign keys of scan report concepts"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=50000,
+            help="The number of ids to update at a time.",
+        )
+
+    def handle(self, *args, **options):
+        filled = backfill_concept_objects(options["batch_size"])
+        for model, count in filled.items():
+            print(f"Filled in {count} concepts on a {model.__name__}.")
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from mapping.services_backfill import backfill_scan_reports
+
+
+class Command(BaseCommand):
+    help = "Fill in the scan report of fields and values saved without one"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=50000,
+            help="The number of ids to update at a time.",
+        )
+
+    def handle(self, *args, **options):
+        filled = backfill_scan_reports(options["batch_size"])
+        for model, count in filled.items():
+            print(f"Filled in the scan report of {count} {model.__name__} rows.")
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from mapping.services_access import check_access
+
+
+class Command(BaseCommand):
+    help = "Check the dataset and scan report access tables are consistent"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--verbose-rows",
+            action="store_true",
+            help="Print each inconsistent (user_id, object_id, role) row.",
+        )
+
+    def handle(self, *args, **options):
+        differences = check_access()
+        for name, rows in differences.items():
+            print(f"{name}: {len(rows)}")
+            if options["verbose_rows"]:
+                for row in sorted(rows):
+                    print(f"    {row}")
+
+        if any(differences.values()):
+            raise CommandError(
+                "The access tables are inconsistent, run `rebuild_access` to fix them."
+            )
+        print("The access tables are consistent.")
@@ -0,0 +1,103 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+from data.models import ConceptAncestor
+from mapping.services_hierarchy import ConceptHierarchy, build_concept_hierarchy
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the concept hierarchy index from concept_ancestor, "
+        "or benchmark it against querying concept_ancestor"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["build", "benchmark"])
+        parser.add_argument(
+            "--path",
+            default=settings.CONCEPT_HIERARCHY_PATH,
+            help="The index file, by default CONCEPT_HIERARCHY_PATH.",
+        )
+        parser.add_argument(
+            "--sample",
+            type=int,
+            default=200,
+            help="With benchmark, the number of concepts to look up.",
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if not path:
+            raise CommandError("Give the index file with --path.")
+
+        if options["action"] == "build":
+            start = time.perf_counter()
+            rows = build_concept_hierarchy(path)
+            print(
+                f"Indexed {rows} concept_ancestor rows in {path} "
+                f"in {time.perf_counter() - start:.1f}s."
+            )
+            return
+
+        hierarchy = ConceptHierarchy(path)
+        keys = hierarchy.ancestor_ids()
+        step = max(1, len(keys) // max(1, options["sample"]))
+        sample = [keys[i] for i in range(0, len(keys), step)][: options["sample"]]
+        fields = (
+            "descendant_concept_id",
+            "min_levels_of_separation",
+            "max_levels_of_separation",
+        )
+
+        def timed(lookup):
+            start = time.perf_counter()
+            result = lookup()
+            return result, time.perf_counter() - start
+
+        # The descendants of each concept in turn
+        sql, sql_time = timed(
+            lambda: [
+                sorted(
+                    ConceptAncestor.objects.filter(
+                        ancestor_concept_id=concept_id
+                    ).values_list(*fields)
+                )
+                for concept_id in sample
+            ]
+        )
+        index, index_time = timed(
+            lambda: [hierarchy.descendants(concept_id) for concept_id in sample]
+        )
+        print(
+            f"Descendants of {len(sample)} concepts: "
+            f"SQL {sql_time:.3f}s, index {index_time:.3f}s"
+        )
+        mismatches = sum(a != b for a, b in zip(sql, index))
+
+        # The descendants of the sample found in the sample, as a set
+        among = set(sample)
+        sql, sql_time = timed(
+            lambda: sorted(
+                ConceptAncestor.objects.filter(
+                    ancestor_concept_id__in=sample, descendant_concept_id__in=sample
+                )
+                .exclude(ancestor_concept_id=F("descendant_concept_id"))
+                .values_list("ancestor_concept_id", *fields)
+            )
+        )
+        index, index_time = timed(
+            lambda: sorted(hierarchy.find_descendants(sample, among))
+        )
+        print(
+            f"Descendants of {len(sample)} concepts among them: "
+            f"SQL {sql_time:.3f}s, index {index_time:.3f}s"
+        )
+        mismatches += sql != index
+
+        if mismatches:
+            raise CommandError(
+                f"The index disagrees with concept_ancestor on {mismatches} lookups, "
+                "rebuild it."
+            )
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from mapping.services_search import SEARCH_INDEXES
+
+
+class Command(BaseCommand):
+    help = "Create the pg_trgm indexes used by the concept search"
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError(
+                "The search indexes are for Postgres; other databases are "
+                "searched in-process."
+            )
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+        with connection.cursor() as cursor:
+            for statement in SEARCH_INDEXES:
+                print(statement)
+                cursor.execute(statement)
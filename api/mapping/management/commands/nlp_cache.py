@@ -0,0 +1,61 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import F, Sum
+from django.utils import timezone
+from mapping.models import NLPCacheEntry
+
+
+class Command(BaseCommand):
+    help = (
+        "Report NLP cache hit rates, and evict expired or least recently used entries"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--prune",
+            action="store_true",
+            help=f"""Delete entries older than NLP_CACHE_TTL_DAYS
+            (currently {settings.NLP_CACHE_TTL_DAYS}).""",
+        )
+        parser.add_argument(
+            "--max-entries",
+            required=False,
+            type=int,
+            help="""With --prune, also delete the least recently used entries
+            beyond this number.""",
+        )
+
+    def handle(self, *args, **options):
+        entries = NLPCacheEntry.objects.all()
+        expiry = timezone.now() - timedelta(days=settings.NLP_CACHE_TTL_DAYS)
+        totals = entries.aggregate(hits=Sum("hits"), misses=Sum("misses"))
+        hits = totals["hits"] or 0
+        misses = totals["misses"] or 0
+        lookups = hits + misses
+
+        print(f"Entries: {entries.count()}")
+        print(f"Expired entries: {entries.filter(updated_at__lt=expiry).count()}")
+        print(f"Hits: {hits}")
+        print(f"Misses: {misses}")
+        if lookups:
+            print(f"Hit rate: {hits / lookups:.1%}")
+        for version in entries.values("model_version").annotate(hits=Sum("hits")):
+            print(f"Model version {version['model_version']}: {version['hits']} hits")
+
+        if not options["prune"]:
+            return
+
+        deleted, _ = entries.filter(updated_at__lt=expiry).delete()
+        print(f"Deleted {deleted} expired entries")
+
+        max_entries = options.get("max_entries")
+        if max_entries is not None:
+            # Least recently used first, with entries never hit ordered by age
+            stale = NLPCacheEntry.objects.order_by(
+                F("last_hit_at").desc(nulls_last=True), "-updated_at"
+            )
+            stale_ids = list(stale.values_list("id", flat=True)[max_entries:])
+            deleted, _ = NLPCacheEntry.objects.filter(id__in=stale_ids).delete()
+            print(f"Deleted {deleted} least recently used entries")
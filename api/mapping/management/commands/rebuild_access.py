@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from mapping.models import DatasetAccess, ScanReportAccess
+from mapping.services_access import rebuild_access
+
+
+class Command(BaseCommand):
+    help = "Rebuild the dataset and scan report access tables from scratch"
+
+    def handle(self, *args, **options):
+        rebuild_access()
+        print(f"Dataset access rows: {DatasetAccess.objects.count()}")
+        print(f"Scan report access rows: {ScanReportAccess.objects.count()}")
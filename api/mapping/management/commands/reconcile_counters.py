@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from mapping.services_counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = "Check the scan report, table and field counters against true counts"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scan-report",
+            type=int,
+            nargs="+",
+            dest="scan_reports",
+            help="Only check these scan report ids.",
+        )
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            help="Overwrite drifted counters with the true counts.",
+        )
+
+    def handle(self, *args, **options):
+        drift = reconcile_counters(options["scan_reports"], fix=options["fix"])
+        for model, pk, name, stored, expected in drift:
+            print(f"{model.__name__} {pk} {name}: {stored} != {expected}")
+
+        if drift and not options["fix"]:
+            raise CommandError(
+                f"{len(drift)} counters have drifted, run with `--fix` to repair them."
+            )
+        if drift:
+            print(f"Repaired {len(drift)} counters.")
+        else:
+            print("The counters are consistent.")
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from mapping.models import ActiveScanReportConcept
+from mapping.services_active_concepts import refresh_active_concepts
+
+
+class Command(BaseCommand):
+    help = "Rebuild the materialised concepts of the active scan reports"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scan-report",
+            type=int,
+            nargs="+",
+            dest="scan_reports",
+            help="Only rebuild these scan report ids.",
+        )
+
+    def handle(self, *args, **options):
+        refresh_active_concepts(options["scan_reports"])
+        print(f"{ActiveScanReportConcept.objects.count()} active concepts.")
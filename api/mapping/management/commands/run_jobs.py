@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+from mapping.services_jobs import requeue_stale_jobs, run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = "Run the pending mapping jobs, polling the job table for new ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once there are no pending jobs, rather than polling.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="Seconds to wait between polls for new jobs.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            if requeued := requeue_stale_jobs():
+                print(f"Requeued {requeued} stale jobs.")
+            if ran := run_pending_jobs():
+                print(f"Ran {ran} jobs.")
+            if options["once"]:
+                break
+            time.sleep(options["interval"])
@@ -4,6 +4,7 @@ To come
 
 from django.conf import settings
 from django.db import models
+from django.db.models import Index, Q
 from django.db.models.constraints import UniqueConstraint
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -42,6 +43,25 @@ class VisibilityChoices(models.TextChoices):
     RESTRICTED = "RESTRICTED", "Restricted"
 
 
+class AccessRoleChoices(models.TextChoices):
+    VIEW = "VIEW", "View"
+    EDIT = "EDIT", "Edit"
+    ADMIN = "ADMIN", "Admin"
+
+
+class JobKind(models.TextChoices):
+    REFRESH_RULES = "REFRESH_RULES", "Refresh mapping rules"
+    RULES_SVG = "RULES_SVG", "Mapping rules diagram"
+    ANALYSE_CONCEPTS = "ANALYSE_CONCEPTS", "Analyse concepts"
+
+
+class JobStatus(models.TextChoices):
+    PENDING = "PENDING", "Pending"
+    RUNNING = "RUNNING", "Running"
+    COMPLETE = "COMPLETE", "Complete"
+    FAILED = "FAILED", "Failed"
+
+
 class BaseModel(models.Model):
     """
     To come
@@ -55,6 +75,37 @@ class BaseModel(models.Model):
         abstract = True
 
 
+class CounterFieldsMixin:
+    """
+    Leave the denormalised counters in `COUNTER_FIELDS` out of ordinary saves
+    of existing rows, so that a stale instance can't overwrite counts which
+    have been updated in the database since it was loaded.
+    """
+
+    COUNTER_FIELDS = ()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not args and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+
+class DeferredCountersMixin:
+    """
+    Delete with the counter changes of the whole cascade applied together.
+    """
+
+    def delete(self, *args, **kwargs):
+        from .services_counters import deferred_counters
+
+        with deferred_counters():
+            return super().delete(*args, **kwargs)
+
+
 class ClassificationSystem(BaseModel):
     """
     Class for 'classification system', i.e. SNOMED or ICD-10 etc.
@@ -140,6 +191,23 @@ class ScanReportConcept(BaseModel):
 
     content_object = GenericForeignKey()
 
+    # The field or value of the generic relation, as typed foreign keys that
+    # can be joined on. Kept in step with it by `signals.py`.
+    scan_report_field = models.ForeignKey(
+        "ScanReportField",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="scan_report_concepts",
+    )
+    scan_report_value = models.ForeignKey(
+        "ScanReportValue",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="scan_report_concepts",
+    )
+
     # save how the mapping rule was created
     creation_type = models.CharField(
         max_length=1,
@@ -147,15 +215,35 @@ class ScanReportConcept(BaseModel):
         default=CreationType.Manual,
     )
 
+    class Meta:
+        indexes = [
+            # The concepts of a field or value
+            Index(fields=["content_type", "object_id"], name="srconcept_object"),
+            # The fields or values with a concept
+            Index(
+                fields=["concept", "content_type", "object_id"],
+                name="srconcept_concept_object",
+            ),
+        ]
+
     def __str__(self):
         return str(self.id)
 
 
-class ScanReport(BaseModel):
+class ScanReport(DeferredCountersMixin, CounterFieldsMixin, BaseModel):
     """
     To come
     """
 
+    COUNTER_FIELDS = (
+        "table_count",
+        "field_count",
+        "value_count",
+        "mapping_rule_count",
+        "mapped_value_count",
+        "rules_version",
+    )
+
     author = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -215,15 +303,37 @@ class ScanReport(BaseModel):
         blank=True,
     )
 
+    # Denormalised counters, kept up to date by `services_counters`
+    table_count = models.IntegerField(default=0)
+    field_count = models.IntegerField(default=0)
+    value_count = models.IntegerField(default=0)
+    mapping_rule_count = models.IntegerField(default=0)
+    mapped_value_count = models.IntegerField(default=0)
+    # Bumped whenever anything in the compiled mapping rules changes
+    rules_version = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # The scan reports whose concepts are active, see
+            # `ScanReportActiveConceptFilterViewSet`
+            Index(
+                fields=["status"],
+                condition=Q(hidden=False),
+                name="scanreport_status_shown",
+            ),
+        ]
+
     def __str__(self):
         return str(self.id)
 
 
-class ScanReportTable(BaseModel):
+class ScanReportTable(DeferredCountersMixin, CounterFieldsMixin, BaseModel):
     """
     To come
     """
 
+    COUNTER_FIELDS = ("field_count", "value_count", "mapped_value_count")
+
     scan_report = models.ForeignKey(ScanReport, on_delete=models.CASCADE)
 
     name = models.CharField(max_length=256)
@@ -250,17 +360,30 @@ class ScanReportTable(BaseModel):
         related_name="date_event",
     )
 
+    # Denormalised counters, kept up to date by `services_counters`
+    field_count = models.IntegerField(default=0)
+    value_count = models.IntegerField(default=0)
+    mapped_value_count = models.IntegerField(default=0)
+
     def __str__(self):
         return str(self.id)
 
 
-class ScanReportField(BaseModel):
+class ScanReportField(DeferredCountersMixin, CounterFieldsMixin, BaseModel):
     """
     To come
     """
 
+    COUNTER_FIELDS = ("value_count", "mapped_value_count")
+
     scan_report_table = models.ForeignKey(ScanReportTable, on_delete=models.CASCADE)
 
+    # Denormalised from `scan_report_table`, so that the fields of a scan report
+    # are found without a join. Set on saving by `signals.py`.
+    scan_report = models.ForeignKey(
+        ScanReport, on_delete=models.CASCADE, null=True, blank=True
+    )
+
     name = models.CharField(max_length=512)
 
     description_column = models.CharField(max_length=512)
@@ -300,6 +423,10 @@ class ScanReportField(BaseModel):
 
     concepts = GenericRelation(ScanReportConcept)
 
+    # Denormalised counters, kept up to date by `services_counters`
+    value_count = models.IntegerField(default=0)
+    mapped_value_count = models.IntegerField(default=0)
+
     def __str__(self):
         return str(self.id)
 
@@ -344,17 +471,33 @@ class MappingRule(BaseModel):
 
     approved = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            Index(fields=["scan_report", "concept"], name="mappingrule_concept"),
+            # The rule for a destination field, source field and concept
+            Index(
+                fields=["scan_report", "omop_field", "source_field", "concept"],
+                name="mappingrule_destination",
+            ),
+        ]
+
     def __str__(self):
         return str(self.id)
 
 
-class ScanReportValue(BaseModel):
+class ScanReportValue(DeferredCountersMixin, BaseModel):
     """
     To come
     """
 
     scan_report_field = models.ForeignKey(ScanReportField, on_delete=models.CASCADE)
 
+    # Denormalised from `scan_report_field`, so that the values of a scan report
+    # are found without joining fields and tables. Set on saving by `signals.py`.
+    scan_report = models.ForeignKey(
+        ScanReport, on_delete=models.CASCADE, null=True, blank=True
+    )
+
     value = models.CharField(max_length=128)
 
     frequency = models.IntegerField()
@@ -365,6 +508,11 @@ class ScanReportValue(BaseModel):
 
     value_description = models.CharField(max_length=512, blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            Index(fields=["scan_report_field", "value"], name="srvalue_field_value")
+        ]
+
     def __str__(self):
         return str(self.id)
 
@@ -394,6 +542,95 @@ class NLPModel(models.Model):
         return str(self.id)
 
 
+class NLPCacheEntry(BaseModel):
+    """
+    The codes extracted by the NLP service from a document, keyed by a hash
+    of the normalised document text and the NLP model version, so that the
+    same text is never sent to the NLP service twice.
+    """
+
+    key = models.CharField(max_length=64, unique=True)
+    model_version = models.CharField(max_length=64)
+    # JSON list of [entity, category, confidence, vocabulary, code] lists
+    codes = models.TextField(default="[]")
+    hits = models.PositiveIntegerField(default=0)
+    misses = models.PositiveIntegerField(default=1)
+    last_hit_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return str(self.id)
+
+
+class MappingRulesArtifact(BaseModel):
+    """
+    The compiled mapping rules JSON of a scan report, and their diagram,
+    valid while its `rules_version` matches that of the scan report.
+    """
+
+    scan_report = models.OneToOneField(
+        ScanReport, on_delete=models.CASCADE, related_name="rules_artifact"
+    )
+    rules_version = models.IntegerField()
+    content = models.TextField()
+    # The rendered diagram of the rules, once it has been drawn
+    svg = models.TextField(blank=True)
+    # JSON object of the diagrams of single destination tables drawn so far,
+    # by table name
+    table_svgs = models.TextField(default="{}")
+
+    @staticmethod
+    def get_etag(scan_report_id, rules_version):
+        return f'"{scan_report_id}-{rules_version}"'
+
+    @property
+    def etag(self):
+        return self.get_etag(self.scan_report_id, self.rules_version)
+
+    def __str__(self):
+        return str(self.id)
+
+
+class Job(BaseModel):
+    """
+    A long-running operation on a scan report, run outside of the request by
+    the workers in `services_jobs.py`, whose progress and result are polled.
+    """
+
+    kind = models.CharField(max_length=32, choices=JobKind.choices)
+    scan_report = models.ForeignKey(
+        ScanReport, on_delete=models.CASCADE, related_name="jobs"
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        related_name="+",
+        blank=True,
+        null=True,
+    )
+    status = models.CharField(
+        max_length=8, choices=JobStatus.choices, default=JobStatus.PENDING
+    )
+    # The only destination table to draw the rules diagram of, if any
+    destination_table = models.CharField(max_length=64, blank=True)
+    # Percentage complete
+    progress = models.PositiveSmallIntegerField(default=0)
+    # The state of the data the result was computed from, so that a complete
+    # job can be reused while it hasn't changed. Blank if never reusable.
+    cache_key = models.CharField(max_length=64, blank=True)
+    result = models.TextField(blank=True)
+    content_type = models.CharField(max_length=64, default="application/json")
+    # JSON list of the messages raised while running
+    messages = models.TextField(default="[]")
+    error = models.TextField(blank=True)
+    # JSON object of what the client needs to act on the error
+    error_details = models.TextField(default="{}")
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return str(self.id)
+
+
 class Dataset(BaseModel):
     """
     Model for datasets which contain scan reports.
@@ -460,3 +697,90 @@ class Project(BaseModel):
 
     def __str__(self) -> str:
         return str(self.id)
+
+
+class DatasetAccess(models.Model):
+    """
+    The effective roles of users on datasets, taking project membership and
+    visibility into account. Maintained by the signals in `signals.py`.
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+"
+    )
+    dataset = models.ForeignKey(
+        Dataset, on_delete=models.CASCADE, related_name="access"
+    )
+    role = models.CharField(max_length=8, choices=AccessRoleChoices.choices)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(
+                fields=["user", "role", "dataset"], name="datasetaccess_unique"
+            )
+        ]
+
+    def __str__(self):
+        return str(self.id)
+
+
+class ScanReportAccess(models.Model):
+    """
+    The effective roles of users on scan reports, taking project membership,
+    visibility and parent dataset roles into account. Maintained by the
+    signals in `signals.py`.
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+"
+    )
+    scan_report = models.ForeignKey(
+        ScanReport, on_delete=models.CASCADE, related_name="access"
+    )
+    role = models.CharField(max_length=8, choices=AccessRoleChoices.choices)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(
+                fields=["user", "role", "scan_report"],
+                name="scanreportaccess_unique",
+            )
+        ]
+
+    def __str__(self):
+        return str(self.id)
+
+
+class ActiveScanReportConcept(models.Model):
+    """
+    The scan report concepts of "active" scan reports - not hidden, with an
+    unhidden parent dataset, and marked "Mapping Complete" - along with the
+    field or value they are on, for the worker to reuse their mappings.
+    Maintained by the signals in `signals.py`.
+    """
+
+    scan_report_concept = models.OneToOneField(
+        ScanReportConcept,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="active",
+    )
+    scan_report = models.ForeignKey(
+        ScanReport, on_delete=models.CASCADE, related_name="+"
+    )
+    concept = models.ForeignKey(Concept, on_delete=models.DO_NOTHING, related_name="+")
+    content_type = models.ForeignKey(
+        ContentType, on_delete=models.CASCADE, related_name="+"
+    )
+    object_id = models.PositiveIntegerField()
+    # The field of the concept, or of its value
+    scan_report_field = models.ForeignKey(
+        ScanReportField, on_delete=models.CASCADE, related_name="+"
+    )
+    field_name = models.CharField(max_length=512)
+    # Null for concepts on fields
+    value = models.CharField(max_length=128, null=True, blank=True)
+    value_description = models.CharField(max_length=512, null=True, blank=True)
+
+    def __str__(self):
+        return str(self.scan_report_concept_id)
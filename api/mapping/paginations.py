@@ -6,3 +6,23 @@ class CustomPagination(pagination.PageNumberPagination):
     page_size_query_param = "page_size"
     max_page_size = 50
     page_query_param = "p"
+
+
+class ValueCursorPagination(pagination.CursorPagination):
+    """
+    Pages of scan report values in id order, for listings of whole scan
+    reports or tables. Only used when a `cursor` or `page_size` is asked for,
+    so that other clients still get every value at once.
+    """
+
+    page_size = 1000
+    page_size_query_param = "page_size"
+    max_page_size = 10000
+    ordering = "id"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not {self.cursor_query_param, self.page_size_query_param} & set(
+            request.query_params
+        ):
+            return None
+        return super().paginate_queryset(queryset, request, view)
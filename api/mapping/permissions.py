@@ -1,31 +1,20 @@
 import os
 from typing import Any
 from django.contrib.auth.models import User
-from django.db.models.query_utils import Q
 from rest_framework import permissions
 from rest_framework.request import Request
 from .models import (
+    AccessRoleChoices,
     Dataset,
+    DatasetAccess,
     ScanReport,
+    ScanReportAccess,
     ScanReportField,
     ScanReportTable,
     ScanReportValue,
-    VisibilityChoices,
 )
 
 
-# Get scan report for the table|field|value
-SCAN_REPORT_QUERIES = {
-    ScanReportTable: lambda x: ScanReport.objects.get(id=x.scan_report.id),
-    ScanReportField: lambda x: ScanReport.objects.get(
-        id=x.scan_report_table.scan_report.id
-    ),
-    ScanReportValue: lambda x: ScanReport.objects.get(
-        id=x.scan_report_field.scan_report_table.scan_report.id
-    ),
-}
-
-
 def is_az_function_user(user: User) -> bool:
     """Check of the user is the `AZ_FUNCTION_USER`
 
@@ -39,6 +28,134 @@ def is_az_function_user(user: User) -> bool:
     return user.username == os.getenv("AZ_FUNCTION_USER")
 
 
+VIEW, EDIT, ADMIN = (
+    AccessRoleChoices.VIEW,
+    AccessRoleChoices.EDIT,
+    AccessRoleChoices.ADMIN,
+)
+
+
+class PermissionResolver:
+    """Resolve a user's roles on datasets and scan reports.
+
+    Roles are read from the `DatasetAccess` and `ScanReportAccess` tables with
+    one query per dataset or scan report, and memoised along with the scan
+    report each table, field or value belongs to, so repeated checks on the
+    same objects within a request are free.
+    Use `get_permission_resolver()` to share one resolver per request.
+    """
+
+    def __init__(self, user: User):
+        self.user = user
+        self._dataset_roles = {}
+        self._scan_report_roles = {}
+        # Memoised ids of the scan report each table or field belongs to
+        self._table_scan_reports = {}
+        self._field_scan_reports = {}
+
+    def _scan_report_id(self, obj: Any) -> int:
+        """Get the id of the scan report a table, field or value belongs to,
+        without refetching parents that have already been resolved.
+        """
+        if isinstance(obj, ScanReportTable):
+            return obj.scan_report_id
+        if isinstance(obj, (ScanReportField, ScanReportValue)) and obj.scan_report_id:
+            return obj.scan_report_id
+        if isinstance(obj, ScanReportField):
+            table_id = obj.scan_report_table_id
+            if table_id not in self._table_scan_reports:
+                self._table_scan_reports[
+                    table_id
+                ] = ScanReportTable.objects.values_list(
+                    "scan_report_id", flat=True
+                ).get(
+                    id=table_id
+                )
+            return self._table_scan_reports[table_id]
+        if isinstance(obj, ScanReportValue):
+            field_id = obj.scan_report_field_id
+            if field_id not in self._field_scan_reports:
+                table_id, scan_report_id = ScanReportField.objects.values_list(
+                    "scan_report_table_id", "scan_report_table__scan_report_id"
+                ).get(id=field_id)
+                self._table_scan_reports[table_id] = scan_report_id
+                self._field_scan_reports[field_id] = scan_report_id
+            return self._field_scan_reports[field_id]
+
+    def dataset_roles(self, dataset_id: int) -> set:
+        """Get the user's roles on a dataset.
+
+        Args:
+            dataset_id (int): The id of the dataset.
+
+        Returns:
+            set: The subset of `{VIEW, EDIT, ADMIN}` the user holds.
+        """
+        if dataset_id not in self._dataset_roles:
+            self._dataset_roles[dataset_id] = set(
+                DatasetAccess.objects.filter(
+                    user_id=self.user.id, dataset_id=dataset_id
+                ).values_list("role", flat=True)
+            )
+        return self._dataset_roles[dataset_id]
+
+    def scan_report_roles(self, scan_report_id: int) -> set:
+        """Get the user's roles on a scan report.
+
+        Args:
+            scan_report_id (int): The id of the scan report.
+
+        Returns:
+            set: The subset of `{VIEW, EDIT, ADMIN}` the user holds.
+        """
+        if scan_report_id not in self._scan_report_roles:
+            self._scan_report_roles[scan_report_id] = set(
+                ScanReportAccess.objects.filter(
+                    user_id=self.user.id, scan_report_id=scan_report_id
+                ).values_list("role", flat=True)
+            )
+        return self._scan_report_roles[scan_report_id]
+
+    def has_role(self, obj: Any, role: str) -> bool:
+        """Check the user holds a role on a dataset, or a scan report
+        or its table, field or value.
+
+        Args:
+            obj (Any): The object to check the permissions on.
+            role (str): One of `VIEW`, `EDIT` or `ADMIN`.
+
+        Returns:
+            bool: `True` if the user holds the role, else `False`.
+        """
+        if isinstance(obj, Dataset):
+            return role in self.dataset_roles(obj.id)
+        if isinstance(obj, ScanReport):
+            return role in self.scan_report_roles(obj.id)
+        if isinstance(obj, (ScanReportTable, ScanReportField, ScanReportValue)):
+            return role in self.scan_report_roles(self._scan_report_id(obj))
+        return False
+
+
+def get_permission_resolver(request: Request) -> PermissionResolver:
+    """Get the `PermissionResolver` for a request, creating it on first use.
+
+    The resolver is stored on the underlying `HttpRequest`, so the permission
+    classes, serializers and views handling a request all share it.
+
+    Args:
+        request (Request): The request with the User instance.
+
+    Returns:
+        PermissionResolver: The resolver for the request's user.
+    """
+    http_request = getattr(request, "_request", request)
+    resolver = getattr(http_request, "_permission_resolver", None)
+    if resolver is None or resolver.user.id != request.user.id:
+        resolver = PermissionResolver(request.user)
+        http_request._permission_resolver = resolver
+    return resolver
+
+
 def has_viewership(obj: Any, request: Request) -> bool:
     """Check the viewership permission on an object.
 
@@ -49,133 +166,7 @@ def has_viewership(obj: Any, request: Request) -> bool:
     Returns:
         bool: `True` if the request's user has permission, else `False`.
     """
-    # Permission checks to perform
-    checks = {
-        Dataset: lambda x: Dataset.objects.filter(
-            Q(visibility=VisibilityChoices.PUBLIC)
-            | Q(viewers__id=request.user.id, visibility=VisibilityChoices.RESTRICTED)
-            | Q(editors__id=request.user.id, visibility=VisibilityChoices.RESTRICTED)
-            | Q(admins__id=request.user.id, visibility=VisibilityChoices.RESTRICTED),
-            project__members__id=request.user.id,
-            id=x.id,
-        ).exists(),
-        ScanReport: lambda x: ScanReport.objects.filter(
-            # parent dataset and SR are public checks
-            Q(
-                # parent dataset and SR are public
-                parent_dataset__visibility=VisibilityChoices.PUBLIC,
-                visibility=VisibilityChoices.PUBLIC,
-            )
-            # parent dataset is public but SR restricted checks
-            | Q(
-                # parent dataset is public
-                # SR is restricted and user is in SR viewers
-                parent_dataset__visibility=VisibilityChoices.PUBLIC,
-                viewers=request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset is public
-                # SR is restricted and user is in SR editors
-                parent_dataset__visibility=VisibilityChoices.PUBLIC,
-                editors=request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset is public
-                # SR is restricted and user is SR author
-                parent_dataset__visibility=VisibilityChoices.PUBLIC,
-                author=request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset is public
-                # SR is restricted and user is in parent dataset editors
-                parent_dataset__visibility=VisibilityChoices.PUBLIC,
-                parent_dataset__editors=request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset is public
-                # SR is restricted and user is in parent dataset admins
-                parent_dataset__visibility=VisibilityChoices.PUBLIC,
-                parent_dataset__admins=request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            # parent dataset and SR are restricted checks
-            | Q(
-                # parent dataset and SR are restricted
-                # user is in SR viewers
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                viewers=request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset and SR are restricted
-                # user is in SR editors
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                editors=request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset and SR are restricted
-                # user is SR author
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                author=request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset and SR are restricted
-                # user is in parent dataset admins
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                parent_dataset__admins=request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset and SR are restricted
-                # user is in parent dataset editors
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                parent_dataset__editors=request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            # parent dataset is restricted but SR is public checks
-            | Q(
-                # parent dataset is restricted and SR public
-                # user is in parent dataset editors
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                parent_dataset__editors=request.user.id,
-                visibility=VisibilityChoices.PUBLIC,
-            )
-            | Q(
-                # parent dataset is restricted and SR public
-                # user is in parent dataset admins
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                parent_dataset__admins=request.user.id,
-                visibility=VisibilityChoices.PUBLIC,
-            )
-            | Q(
-                # parent dataset is restricted and SR public
-                # user is in parent dataset viewers
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                parent_dataset__viewers=request.user.id,
-                visibility=VisibilityChoices.PUBLIC,
-            ),
-            parent_dataset__project__members=request.user.id,
-            id=x.id,
-        ).exists(),
-    }
-
-    # If `obj` is a scan report table|field|value, get the scan report
-    # it belongs to and check the user has permission to view it.
-    if sub_scan_report := SCAN_REPORT_QUERIES.get(type(obj)):
-        sub_scan_report = sub_scan_report(obj)
-        return checks.get(type(sub_scan_report))(sub_scan_report)
-
-    # If `obj` is a dataset or scan report, check the user can view it.
-    if permission_check := checks.get(type(obj)):
-        return permission_check(obj)
-
-    return False
+    return get_permission_resolver(request).has_role(obj, VIEW)
 
 
 def has_editorship(obj: Any, request: Request) -> bool:
@@ -188,30 +179,7 @@ def has_editorship(obj: Any, request: Request) -> bool:
     Returns:
         bool: `True` if the request's user has permission, else `False`.
     """
-    # Permission checks to perform
-    checks = {
-        Dataset: lambda x: Dataset.objects.filter(
-            project__members__id=request.user.id, editors__id=request.user.id, id=x.id
-        ).exists(),
-        ScanReport: lambda x: ScanReport.objects.filter(
-            Q(parent_dataset__editors__id=request.user.id)
-            | Q(editors__id=request.user.id),
-            parent_dataset__project__members__id=request.user.id,
-            id=x.id,
-        ).exists(),
-    }
-
-    # If `obj` is a scan report table|field|value, get the scan report
-    # it belongs to and check the user has permission to edit it.
-    if sub_scan_report := SCAN_REPORT_QUERIES.get(type(obj)):
-        sub_scan_report = sub_scan_report(obj)
-        return checks.get(type(sub_scan_report))(sub_scan_report)
-
-    # If `obj` is a dataset or scan report, check the user can edit it.
-    if permission_check := checks.get(type(obj)):
-        return permission_check(obj)
-
-    return False
+    return get_permission_resolver(request).has_role(obj, EDIT)
 
 
 def is_admin(obj: Any, request: Request) -> bool:
@@ -224,30 +192,7 @@ def is_admin(obj: Any, request: Request) -> bool:
     Returns:
         bool: `True` if the request's user has permission, else `False`.
     """
-    # Permission checks to perform
-    checks = {
-        Dataset: lambda x: Dataset.objects.filter(
-            project__members__id=request.user.id, admins__id=request.user.id, id=x.id
-        ).exists(),
-        ScanReport: lambda x: ScanReport.objects.filter(
-            Q(parent_dataset__admins__id=request.user.id)
-            | Q(author__id=request.user.id),
-            parent_dataset__project__members__id=request.user.id,
-            id=x.id,
-        ).exists(),
-    }
-
-    # If `obj` is a scan report table|field|value, get the scan report
-    # it belongs to and check the user has permission to edit it.
-    if sub_scan_report := SCAN_REPORT_QUERIES.get(type(obj)):
-        sub_scan_report = sub_scan_report(obj)
-        return checks.get(type(sub_scan_report))(sub_scan_report)
-
-    # If `obj` is a dataset or scan report, check the user can edit it.
-    if permission_check := checks.get(type(obj)):
-        return permission_check(obj)
-
-    return False
+    return get_permission_resolver(request).has_role(obj, ADMIN)
 
 
 class CanViewProject(permissions.BasePermission):
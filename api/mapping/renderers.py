@@ -0,0 +1,28 @@
+import json
+
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def iter_ndjson(rows):
+    """
+    Yield each row as a line of JSON.
+    """
+    for row in rows:
+        yield json.dumps(row, cls=JSONEncoder).encode() + b"\n"
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Renders a list as newline-delimited JSON, one item per line, for
+    `?format=ndjson` or `Accept: application/x-ndjson`.
+    """
+
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return b"".join(iter_ndjson(data if isinstance(data, list) else [data]))
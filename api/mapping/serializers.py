@@ -1,3 +1,4 @@
+import json
 from rest_framework import serializers
 from rest_framework.exceptions import PermissionDenied, NotFound
 from drf_dynamic_fields import DynamicFieldsMixin
@@ -13,6 +14,7 @@ from data.models import (
     DrugStrength,
 )
 from mapping.models import (
+    ActiveScanReportConcept,
     ScanReportField,
     ScanReportValue,
     ScanReport,
@@ -25,16 +27,16 @@ from mapping.models import (
     OmopTable,
     MappingRule,
     Dataset,
+    Job,
+    JobKind,
     Project,
 )
 
-from .services_rules import (
-    analyse_concepts,
-    get_mapping_rules_json,
-)
+from .services_rules import get_mapping_rules_artifact
 
 from .permissions import (
     has_editorship,
+    has_viewership,
     is_admin,
     is_az_function_user,
 )
@@ -123,6 +125,7 @@ class ScanReportViewSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = ScanReport
         fields = "__all__"
+        read_only_fields = ScanReport.COUNTER_FIELDS
 
 
 class ScanReportEditSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
@@ -162,6 +165,7 @@ class ScanReportEditSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = ScanReport
         fields = "__all__"
+        read_only_fields = ScanReport.COUNTER_FIELDS
 
 
 class DatasetViewSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
@@ -247,12 +251,14 @@ class ScanReportTableListSerializer(DynamicFieldsMixin, serializers.ModelSeriali
     class Meta:
         model = ScanReportTable
         fields = "__all__"
+        read_only_fields = ScanReportTable.COUNTER_FIELDS
 
 
 class ScanReportTableEditSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = ScanReportTable
         fields = "__all__"
+        read_only_fields = ScanReportTable.COUNTER_FIELDS
 
 
 class ScanReportFieldListSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
@@ -285,6 +291,7 @@ class ScanReportFieldListSerializer(DynamicFieldsMixin, serializers.ModelSeriali
     class Meta:
         model = ScanReportField
         fields = "__all__"
+        read_only_fields = ScanReportField.COUNTER_FIELDS + ("scan_report",)
 
 
 class ScanReportFieldEditSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
@@ -298,6 +305,7 @@ class ScanReportFieldEditSerializer(DynamicFieldsMixin, serializers.ModelSeriali
     class Meta:
         model = ScanReportField
         fields = "__all__"
+        read_only_fields = ScanReportField.COUNTER_FIELDS + ("scan_report",)
 
 
 class ScanReportValueViewSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
@@ -327,6 +335,7 @@ class ScanReportValueViewSerializer(DynamicFieldsMixin, serializers.ModelSeriali
     class Meta:
         model = ScanReportValue
         fields = "__all__"
+        read_only_fields = ("scan_report",)
 
 
 class ScanReportValueEditSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
@@ -337,6 +346,7 @@ class ScanReportValueEditSerializer(DynamicFieldsMixin, serializers.ModelSeriali
     class Meta:
         model = ScanReportValue
         fields = "__all__"
+        read_only_fields = ("scan_report",)
 
 
 class ScanReportConceptSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
@@ -345,6 +355,27 @@ class ScanReportConceptSerializer(DynamicFieldsMixin, serializers.ModelSerialize
         fields = "__all__"
 
 
+class ActiveScanReportConceptSerializer(
+    DynamicFieldsMixin, serializers.ModelSerializer
+):
+    # The id of the scan report concept
+    id = serializers.IntegerField(source="scan_report_concept_id", read_only=True)
+
+    class Meta:
+        model = ActiveScanReportConcept
+        fields = [
+            "id",
+            "concept",
+            "content_type",
+            "object_id",
+            "scan_report",
+            "scan_report_field",
+            "field_name",
+            "value",
+            "value_description",
+        ]
+
+
 class ClassificationSystemSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = ClassificationSystem
@@ -412,16 +443,70 @@ class GetRulesJSON(DynamicFieldsMixin, serializers.ModelSerializer):
         fields = "__all__"
 
     def to_representation(self, scan_report):
-        qs = MappingRule.objects.filter(scan_report=scan_report)
-        rules = get_mapping_rules_json(qs)
-        return rules
+        artifact = get_mapping_rules_artifact(scan_report)
+        return json.loads(artifact.content)
 
 
-class GetRulesAnalysis(DynamicFieldsMixin, serializers.ModelSerializer):
-    class Meta:
-        model = ScanReport
-        fields = "__all__"
+class JobSerializer(serializers.ModelSerializer):
+    messages = serializers.SerializerMethodField()
+    error_details = serializers.SerializerMethodField()
 
-    def to_representation(self, scan_report):
-        analysis = analyse_concepts(scan_report.id)
-        return analysis
+    def get_messages(self, job):
+        return json.loads(job.messages)
+
+    def get_error_details(self, job):
+        return json.loads(job.error_details)
+
+    def validate(self, data):
+        if data.get("destination_table") and data["kind"] != JobKind.RULES_SVG:
+            raise serializers.ValidationError(
+                {"destination_table": "Only the rules diagram can be drawn by table."}
+            )
+        if request := self.context.get("request"):
+            scan_report = data["scan_report"]
+            if is_az_function_user(request.user):
+                pass
+            elif data["kind"] == JobKind.REFRESH_RULES:
+                if not (
+                    is_admin(scan_report, request)
+                    or has_editorship(scan_report, request)
+                ):
+                    raise PermissionDenied(
+                        "You must have editor or admin privileges on the scan report to refresh its rules.",
+                    )
+            elif not has_viewership(scan_report, request):
+                raise PermissionDenied(
+                    "You do not have permission to view this scan report.",
+                )
+        else:
+            raise serializers.ValidationError(
+                "Missing request context. Unable to validate job."
+            )
+        return super().validate(data)
+
+    class Meta:
+        model = Job
+        # The result is served by the `result` endpoint, in its own content type
+        fields = (
+            "id",
+            "kind",
+            "scan_report",
+            "destination_table",
+            "user",
+            "status",
+            "progress",
+            "messages",
+            "error",
+            "error_details",
+            "created_at",
+            "started_at",
+            "finished_at",
+        )
+        read_only_fields = (
+            "user",
+            "status",
+            "progress",
+            "error",
+            "started_at",
+            "finished_at",
+        )
@@ -0,0 +1,232 @@
+"""
+Maintenance of the `DatasetAccess` and `ScanReportAccess` tables, which hold
+the effective roles of users on datasets and scan reports so that list and
+permission queries are a single indexed join rather than a many-way OR.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+
+from .models import (
+    AccessRoleChoices,
+    Dataset,
+    DatasetAccess,
+    Project,
+    ScanReport,
+    ScanReportAccess,
+    VisibilityChoices,
+)
+
+VIEW, EDIT, ADMIN = (
+    AccessRoleChoices.VIEW,
+    AccessRoleChoices.EDIT,
+    AccessRoleChoices.ADMIN,
+)
+
+
+def _users_by(through, key, ids):
+    """
+    Group the user ids of an M2M through table by `key`, for the given ids.
+    """
+    users = defaultdict(set)
+    for key_id, user_id in through.objects.filter(**{f"{key}__in": ids}).values_list(
+        key, "user_id"
+    ):
+        users[key_id].add(user_id)
+    return users
+
+
+def _dataset_users(dataset_ids):
+    """
+    Get the project members, viewers, editors and admins of each dataset.
+    """
+    projects = defaultdict(set)
+    for dataset_id, project_id in Project.datasets.through.objects.filter(
+        dataset_id__in=dataset_ids
+    ).values_list("dataset_id", "project_id"):
+        projects[dataset_id].add(project_id)
+    project_members = _users_by(
+        Project.members.through,
+        "project_id",
+        set().union(*projects.values()),
+    )
+    members = defaultdict(set)
+    for dataset_id, project_ids in projects.items():
+        for project_id in project_ids:
+            members[dataset_id] |= project_members[project_id]
+
+    return {
+        "members": members,
+        "viewers": _users_by(Dataset.viewers.through, "dataset_id", dataset_ids),
+        "editors": _users_by(Dataset.editors.through, "dataset_id", dataset_ids),
+        "admins": _users_by(Dataset.admins.through, "dataset_id", dataset_ids),
+    }
+
+
+def compute_dataset_access(dataset_ids):
+    """
+    Compute the (user_id, dataset_id, role) rows for the given datasets.
+
+    The user must be a member of a project the dataset is in, then:
+        - VIEW: the dataset is 'PUBLIC', or the user is a viewer, editor or admin
+        - EDIT: the user is an editor
+        - ADMIN: the user is an admin
+    """
+    dataset_ids = list(dataset_ids)
+    users = _dataset_users(dataset_ids)
+    rows = set()
+    for dataset_id, visibility in Dataset.objects.filter(
+        id__in=dataset_ids
+    ).values_list("id", "visibility"):
+        members = users["members"][dataset_id]
+        viewers = users["viewers"][dataset_id]
+        editors = users["editors"][dataset_id]
+        admins = users["admins"][dataset_id]
+
+        if visibility == VisibilityChoices.PUBLIC:
+            can_view = members
+        else:
+            can_view = members & (viewers | editors | admins)
+
+        for role, user_ids in (
+            (VIEW, can_view),
+            (EDIT, members & editors),
+            (ADMIN, members & admins),
+        ):
+            rows.update((user_id, dataset_id, role) for user_id in user_ids)
+
+    return rows
+
+
+def compute_scan_report_access(scan_report_ids):
+    """
+    Compute the (user_id, scan_report_id, role) rows for the given scan reports.
+
+    The user must be a member of a project the parent dataset is in, then:
+        - VIEW: the parent dataset and SR are 'PUBLIC', or
+          the SR is 'RESTRICTED' and the user is in SR viewers|editors,
+          is the SR author or is in parent dataset editors|admins, or
+          the parent dataset is 'RESTRICTED' and the SR 'PUBLIC' and the user
+          is in parent dataset viewers|editors|admins
+        - EDIT: the user is in SR editors or parent dataset editors
+        - ADMIN: the user is the SR author or in parent dataset admins
+    """
+    scan_reports = list(
+        ScanReport.objects.filter(
+            id__in=list(scan_report_ids), parent_dataset__isnull=False
+        ).values_list("id", "author_id", "visibility", "parent_dataset_id")
+    )
+    scan_report_ids = [scan_report[0] for scan_report in scan_reports]
+    dataset_users = _dataset_users({scan_report[3] for scan_report in scan_reports})
+    dataset_visibility = dict(
+        Dataset.objects.filter(
+            id__in={scan_report[3] for scan_report in scan_reports}
+        ).values_list("id", "visibility")
+    )
+    sr_viewers = _users_by(ScanReport.viewers.through, "scanreport_id", scan_report_ids)
+    sr_editors = _users_by(ScanReport.editors.through, "scanreport_id", scan_report_ids)
+
+    rows = set()
+    for scan_report_id, author_id, visibility, dataset_id in scan_reports:
+        members = dataset_users["members"][dataset_id]
+        ds_viewers = dataset_users["viewers"][dataset_id]
+        ds_editors = dataset_users["editors"][dataset_id]
+        ds_admins = dataset_users["admins"][dataset_id]
+        author = {author_id} if author_id else set()
+        ds_visibility = dataset_visibility[dataset_id]
+
+        if visibility == VisibilityChoices.RESTRICTED:
+            can_view = members & (
+                sr_viewers[scan_report_id]
+                | sr_editors[scan_report_id]
+                | author
+                | ds_editors
+                | ds_admins
+            )
+        elif ds_visibility == VisibilityChoices.PUBLIC:
+            can_view = members
+        else:
+            can_view = members & (ds_viewers | ds_editors | ds_admins)
+
+        for role, user_ids in (
+            (VIEW, can_view),
+            (EDIT, members & (ds_editors | sr_editors[scan_report_id])),
+            (ADMIN, members & (ds_admins | author)),
+        ):
+            rows.update((user_id, scan_report_id, role) for user_id in user_ids)
+
+    return rows
+
+
+def refresh_scan_report_access(scan_report_ids):
+    """
+    Recompute the access rows of the given scan reports.
+    """
+    scan_report_ids = set(scan_report_ids)
+    if not scan_report_ids:
+        return
+    rows = compute_scan_report_access(scan_report_ids)
+    with transaction.atomic():
+        ScanReportAccess.objects.filter(scan_report_id__in=scan_report_ids).delete()
+        ScanReportAccess.objects.bulk_create(
+            ScanReportAccess(user_id=user_id, scan_report_id=scan_report_id, role=role)
+            for user_id, scan_report_id, role in rows
+        )
+
+
+def refresh_dataset_access(dataset_ids):
+    """
+    Recompute the access rows of the given datasets and of their scan reports.
+    """
+    dataset_ids = set(dataset_ids)
+    if not dataset_ids:
+        return
+    rows = compute_dataset_access(dataset_ids)
+    with transaction.atomic():
+        DatasetAccess.objects.filter(dataset_id__in=dataset_ids).delete()
+        DatasetAccess.objects.bulk_create(
+            DatasetAccess(user_id=user_id, dataset_id=dataset_id, role=role)
+            for user_id, dataset_id, role in rows
+        )
+        refresh_scan_report_access(
+            ScanReport.objects.filter(parent_dataset_id__in=dataset_ids).values_list(
+                "id", flat=True
+            )
+        )
+
+
+def rebuild_access():
+    """
+    Rebuild the access tables from scratch.
+    """
+    with transaction.atomic():
+        DatasetAccess.objects.all().delete()
+        ScanReportAccess.objects.all().delete()
+        refresh_dataset_access(Dataset.objects.values_list("id", flat=True))
+
+
+def check_access():
+    """
+    Compare the access tables with the roles computed from scratch.
+
+    Returns:
+        dict: The rows missing from, and the extra rows in, each table.
+    """
+    expected_datasets = compute_dataset_access(
+        Dataset.objects.values_list("id", flat=True)
+    )
+    actual_datasets = set(
+        DatasetAccess.objects.values_list("user_id", "dataset_id", "role")
+    )
+    expected_scan_reports = compute_scan_report_access(
+        ScanReport.objects.values_list("id", flat=True)
+    )
+    actual_scan_reports = set(
+        ScanReportAccess.objects.values_list("user_id", "scan_report_id", "role")
+    )
+    return {
+        "dataset_missing": expected_datasets - actual_datasets,
+        "dataset_extra": actual_datasets - expected_datasets,
+        "scan_report_missing": expected_scan_reports - actual_scan_reports,
+        "scan_report_extra": actual_scan_reports - expected_scan_reports,
+    }
@@ -0,0 +1,157 @@
+"""
+Maintenance of `ActiveScanReportConcept`, the materialised concepts of the
+active scan reports: those marked "Mapping Complete" which aren't hidden and
+whose dataset isn't hidden. The worker reads them on every upload to reuse
+earlier mappings.
+
+The signal handlers in `signals.py` refresh the rows of a scan report when
+whether it is active may have changed, and the rows of concepts as they are
+saved. `manage.py refresh_active_concepts` rebuilds the whole table.
+"""
+from django.db import transaction
+
+from .models import (
+    ActiveScanReportConcept,
+    ScanReport,
+    ScanReportConcept,
+    ScanReportField,
+    ScanReportValue,
+    Status,
+)
+
+BATCH_SIZE = 2000
+
+
+def get_active_scan_reports():
+    """
+    Get the scan reports whose concepts are active.
+    """
+    return ScanReport.objects.filter(
+        hidden=False, parent_dataset__hidden=False, status=Status.COMPLETE
+    )
+
+
+def is_active_concept(scan_report_concept):
+    """
+    Whether a saved `ScanReportConcept` is on a field or value of an active
+    scan report, in one query.
+    """
+    if scan_report_concept.scan_report_value_id is not None:
+        objects = ScanReportValue.objects.filter(
+            pk=scan_report_concept.scan_report_value_id
+        )
+    else:
+        objects = ScanReportField.objects.filter(
+            pk=scan_report_concept.scan_report_field_id
+        )
+    return objects.filter(scan_report__in=get_active_scan_reports()).exists()
+
+
+def _iter_active_concepts(scan_report_ids=None, concept_ids=None):
+    """
+    Yield an unsaved `ActiveScanReportConcept` for each concept on a field or
+    value of an active scan report, only of the given scan reports or concepts
+    if given.
+    """
+    active = get_active_scan_reports()
+    if scan_report_ids is not None:
+        active = active.filter(pk__in=scan_report_ids)
+    concepts = ScanReportConcept.objects.all()
+    if concept_ids is not None:
+        concepts = concepts.filter(id__in=concept_ids)
+    on_fields = concepts.filter(scan_report_field__scan_report__in=active).values_list(
+        "id",
+        "concept_id",
+        "content_type_id",
+        "object_id",
+        "scan_report_field__scan_report_id",
+        "scan_report_field_id",
+        "scan_report_field__name",
+    )
+    for row in on_fields.iterator(chunk_size=BATCH_SIZE):
+        yield ActiveScanReportConcept(
+            scan_report_concept_id=row[0],
+            concept_id=row[1],
+            content_type_id=row[2],
+            object_id=row[3],
+            scan_report_id=row[4],
+            scan_report_field_id=row[5],
+            field_name=row[6],
+        )
+    on_values = concepts.filter(scan_report_value__scan_report__in=active).values_list(
+        "id",
+        "concept_id",
+        "content_type_id",
+        "object_id",
+        "scan_report_value__scan_report_id",
+        "scan_report_value__scan_report_field_id",
+        "scan_report_value__scan_report_field__name",
+        "scan_report_value__value",
+        "scan_report_value__value_description",
+    )
+    for row in on_values.iterator(chunk_size=BATCH_SIZE):
+        yield ActiveScanReportConcept(
+            scan_report_concept_id=row[0],
+            concept_id=row[1],
+            content_type_id=row[2],
+            object_id=row[3],
+            scan_report_id=row[4],
+            scan_report_field_id=row[5],
+            field_name=row[6],
+            value=row[7],
+            value_description=row[8],
+        )
+
+
+def _insert(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            ActiveScanReportConcept.objects.bulk_create(batch)
+            batch = []
+    ActiveScanReportConcept.objects.bulk_create(batch)
+
+
+def refresh_active_concepts(scan_report_ids=None):
+    """
+    Rebuild the active concepts of the given scan reports, or of every scan
+    report if `scan_report_ids` is None.
+    """
+    rows = ActiveScanReportConcept.objects.all()
+    if scan_report_ids is not None:
+        scan_report_ids = list(scan_report_ids)
+        rows = rows.filter(scan_report_id__in=scan_report_ids)
+    with transaction.atomic():
+        rows.delete()
+        _insert(_iter_active_concepts(scan_report_ids=scan_report_ids))
+
+
+def refresh_concepts(concept_ids):
+    """
+    Rebuild the active concept rows of the given scan report concepts.
+    """
+    concept_ids = list(concept_ids)
+    with transaction.atomic():
+        ActiveScanReportConcept.objects.filter(
+            scan_report_concept_id__in=concept_ids
+        ).delete()
+        _insert(_iter_active_concepts(concept_ids=concept_ids))
+
+
+def update_field_name(field):
+    """
+    Copy the name of a saved field to the active concepts on it or its values.
+    """
+    ActiveScanReportConcept.objects.filter(scan_report_field=field).exclude(
+        field_name=field.name
+    ).update(field_name=field.name)
+
+
+def update_value(value):
+    """
+    Copy a saved value to the active concepts on it.
+    """
+    ActiveScanReportConcept.objects.filter(
+        scan_report_concept__scan_report_value=value
+    ).update(value=value.value, value_description=value.value_description)
@@ -0,0 +1,103 @@
+"""
+One-off backfills of the denormalised columns added to existing rows, run by
+their management commands after the migrations which add the columns:
+
+- `backfill_scan_reports()` fills in the scan report of fields and values
+  saved before they had one.
+- `backfill_concept_objects()` fills in the typed foreign keys of scan report
+  concepts saved before they had them.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import F, Max, OuterRef, Subquery
+
+from .models import (
+    ScanReportConcept,
+    ScanReportField,
+    ScanReportTable,
+    ScanReportValue,
+)
+from .services_counters import bump_rules_version
+
+
+def backfill_scan_reports(batch_size=50000):
+    """
+    Fill in the scan report of the fields and values without one, a range of
+    `batch_size` ids at a time so that each update stays short.
+
+    Returns:
+        dict: {model: number of rows filled in}
+    """
+    parents = (
+        (
+            ScanReportField,
+            Subquery(
+                ScanReportTable.objects.filter(
+                    pk=OuterRef("scan_report_table_id")
+                ).values("scan_report_id")[:1]
+            ),
+        ),
+        # Fields first, so that their values can be filled in from them
+        (
+            ScanReportValue,
+            Subquery(
+                ScanReportField.objects.filter(
+                    pk=OuterRef("scan_report_field_id")
+                ).values("scan_report_id")[:1]
+            ),
+        ),
+    )
+    filled = {}
+    for model, scan_report_id in parents:
+        filled[model] = 0
+        last = model.objects.aggregate(last=Max("id"))["last"] or 0
+        for start in range(0, last + 1, batch_size):
+            filled[model] += model.objects.filter(
+                id__gte=start, id__lt=start + batch_size, scan_report__isnull=True
+            ).update(scan_report_id=scan_report_id)
+    return filled
+
+
+def backfill_concept_objects(batch_size=50000):
+    """
+    Fill in the typed foreign keys of the scan report concepts saved without
+    them from their generic relation, a range of `batch_size` ids at a time.
+
+    The compiled mapping rules read the concepts through these keys, so the
+    rules of the scan reports whose concepts are filled in are marked as out
+    of date, to be compiled again with them.
+
+    Returns:
+        dict: {model: number of concepts filled in}
+    """
+    filled = {}
+    scan_report_ids = set()
+    last = ScanReportConcept.objects.aggregate(last=Max("id"))["last"] or 0
+    for model, name, scan_report in (
+        (ScanReportField, "scan_report_field", "scan_report_table__scan_report_id"),
+        (
+            ScanReportValue,
+            "scan_report_value",
+            "scan_report_field__scan_report_table__scan_report_id",
+        ),
+    ):
+        filled[model] = 0
+        concepts = ScanReportConcept.objects.filter(
+            content_type=ContentType.objects.get_for_model(model),
+            **{f"{name}__isnull": True},
+        )
+        for start in range(0, last + 1, batch_size):
+            # Leave out concepts whose field or value no longer exists
+            batch = concepts.filter(
+                id__gte=start,
+                id__lt=start + batch_size,
+                object_id__in=model.objects.values("id"),
+            )
+            scan_report_ids.update(
+                model.objects.filter(id__in=batch.values("object_id")).values_list(
+                    scan_report, flat=True
+                )
+            )
+            filled[model] += batch.update(**{f"{name}_id": F("object_id")})
+    for scan_report_id in scan_report_ids:
+        bump_rules_version(scan_report_id)
+    return filled
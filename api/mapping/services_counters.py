@@ -0,0 +1,336 @@
+"""
+Maintenance of the denormalised counters on `ScanReport`, `ScanReportTable`
+and `ScanReportField`, which let the count endpoints read a handful of rows
+rather than aggregating over every value of a scan report.
+
+Single-row changes are applied by the signal handlers in `signals.py`. Bulk
+paths wrap their work in `deferred_counters()`, so that all of the changes
+they make are summed and written with one `UPDATE` per counted row, in the
+same transaction as the rows they count.
+"""
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Count, F
+
+from .models import (
+    MappingRule,
+    ScanReport,
+    ScanReportConcept,
+    ScanReportField,
+    ScanReportTable,
+    ScanReportValue,
+)
+
+_state = threading.local()
+
+
+class _Batch:
+    def __init__(self):
+        # {(model, pk): Counter({field: delta})}
+        self.deltas = defaultdict(Counter)
+        # {field_id: (table_id, scan_report_id)}
+        self.field_parents = {}
+        # {table_id: scan_report_id}
+        self.table_parents = {}
+        # {value_id: field_id} of values being deleted
+        self.deleted_values = {}
+        # The ids of deleted values already counted as no longer mapped
+        self.unmapped_values = set()
+
+
+def _batch():
+    return getattr(_state, "batch", None)
+
+
+@contextmanager
+def deferred_counters():
+    """
+    Collect the counter changes made within the block and apply them on exit,
+    in the same transaction as the block. Nested blocks join the outer one.
+    """
+    if _batch() is not None:
+        yield
+        return
+    _state.batch = _Batch()
+    try:
+        with transaction.atomic():
+            yield
+            _flush(_state.batch)
+    finally:
+        _state.batch = None
+
+
+def _flush(batch):
+    # Rows with the same changes are updated together
+    groups = defaultdict(list)
+    for (model, pk), deltas in batch.deltas.items():
+        changes = tuple(sorted((name, n) for name, n in deltas.items() if n))
+        if changes:
+            groups[(model, changes)].append(pk)
+    for (model, changes), pks in groups.items():
+        model.objects.filter(pk__in=pks).update(
+            **{name: F(name) + n for name, n in changes}
+        )
+
+
+def add_counts(model, pk, **deltas):
+    """
+    Add `deltas` to the counters of the `model` row with primary key `pk`.
+    """
+    if pk is None:
+        return
+    if (batch := _batch()) is not None:
+        batch.deltas[(model, pk)].update(deltas)
+    else:
+        model.objects.filter(pk=pk).update(
+            **{name: F(name) + n for name, n in deltas.items()}
+        )
+
+
+def get_table_parent(table_id):
+    """
+    Get the scan report id of a table, memoised for the current batch.
+    """
+    batch = _batch()
+    if batch is not None and table_id in batch.table_parents:
+        return batch.table_parents[table_id]
+    scan_report_id = (
+        ScanReportTable.objects.filter(pk=table_id)
+        .values_list("scan_report_id", flat=True)
+        .first()
+    )
+    if batch is not None:
+        batch.table_parents[table_id] = scan_report_id
+    return scan_report_id
+
+
+def get_field_parents(field_id):
+    """
+    Get the (table id, scan report id) of a field, memoised for the current batch.
+    """
+    batch = _batch()
+    if batch is not None and field_id in batch.field_parents:
+        return batch.field_parents[field_id]
+    parents = ScanReportField.objects.filter(pk=field_id).values_list(
+        "scan_report_table_id", "scan_report_table__scan_report_id"
+    ).first() or (None, None)
+    if batch is not None:
+        batch.field_parents[field_id] = parents
+    return parents
+
+
+def set_concept_object(scan_report_concept):
+    """
+    Set the typed foreign keys of a `ScanReportConcept` from its generic
+    relation, for saving. Bulk paths call this on each concept themselves.
+    """
+    model = ContentType.objects.get_for_id(
+        scan_report_concept.content_type_id
+    ).model_class()
+    object_id = scan_report_concept.object_id
+    scan_report_concept.scan_report_field_id = (
+        object_id if model is ScanReportField else None
+    )
+    scan_report_concept.scan_report_value_id = (
+        object_id if model is ScanReportValue else None
+    )
+
+
+def bump_rules_version(scan_report_id):
+    """
+    Mark the compiled mapping rules of a scan report as out of date.
+    """
+    add_counts(ScanReport, scan_report_id, rules_version=1)
+
+
+def get_concept_scan_report(scan_report_concept):
+    """
+    Get the scan report id of the field or value a `ScanReportConcept` is on.
+    """
+    field_id = scan_report_concept.object_id
+    if (
+        scan_report_concept.content_type_id
+        == ContentType.objects.get_for_model(ScanReportValue).id
+    ):
+        field_id = (
+            ScanReportValue.objects.filter(pk=field_id)
+            .values_list("scan_report_field_id", flat=True)
+            .first()
+        )
+    return get_field_parents(field_id)[1]
+
+
+def count_values(field_id, n, mapped=False):
+    """
+    Add `n` to the value (or mapped value) counts of a field and its parents.
+    """
+    name = "mapped_value_count" if mapped else "value_count"
+    table_id, scan_report_id = get_field_parents(field_id)
+    add_counts(ScanReportField, field_id, **{name: n})
+    add_counts(ScanReportTable, table_id, **{name: n})
+    add_counts(ScanReport, scan_report_id, **{name: n})
+
+
+def count_mapped_values(value_ids, n):
+    """
+    Add `n` to the mapped value counts for each of the given values.
+    """
+    fields = Counter(
+        ScanReportValue.objects.filter(pk__in=value_ids).values_list(
+            "scan_report_field_id", flat=True
+        )
+    )
+    for field_id, count in fields.items():
+        count_values(field_id, n * count, mapped=True)
+
+
+def deleting_value(value_id, field_id):
+    """
+    Remember a value which is about to be deleted, and look up its parents
+    while they still exist, as its concepts may be deleted after them.
+    """
+    if (batch := _batch()) is not None:
+        batch.deleted_values[value_id] = field_id
+        get_field_parents(field_id)
+
+
+def concept_counted_on_value(value_id, n):
+    """
+    Update the mapped value counts after a concept is added to (n=1) or
+    removed from (n=-1) a value. A value is mapped while it has any concepts.
+    """
+    batch = _batch()
+    if n < 0 and batch is not None and value_id in batch.deleted_values:
+        # All of the concepts of a deleted value go with it
+        if value_id not in batch.unmapped_values:
+            batch.unmapped_values.add(value_id)
+            count_values(batch.deleted_values[value_id], -1, mapped=True)
+        return
+    remaining = ScanReportConcept.objects.filter(
+        content_type=ContentType.objects.get_for_model(ScanReportValue),
+        object_id=value_id,
+    ).count()
+    if remaining == (1 if n > 0 else 0):
+        count_mapped_values([value_id], n)
+
+
+def compute_counters(scan_report_ids=None):
+    """
+    Count the tables, fields, values, mapping rules and mapped values from
+    scratch, with one grouped query per count.
+
+    Args:
+        scan_report_ids: The scan reports to count, or `None` for all of them.
+
+    Returns:
+        dict: {model: {pk: {counter: value}}} for every counted row.
+    """
+    value_type = ContentType.objects.get_for_model(ScanReportValue)
+    scan_reports = ScanReport.objects.all()
+    tables = ScanReportTable.objects.all()
+    fields = ScanReportField.objects.all()
+    values = ScanReportValue.objects.all()
+    rules = MappingRule.objects.all()
+    if scan_report_ids is not None:
+        scan_reports = scan_reports.filter(pk__in=scan_report_ids)
+        tables = tables.filter(scan_report_id__in=scan_report_ids)
+        fields = fields.filter(scan_report_table__scan_report_id__in=scan_report_ids)
+        values = values.filter(
+            scan_report_field__scan_report_table__scan_report_id__in=scan_report_ids
+        )
+        rules = rules.filter(scan_report_id__in=scan_report_ids)
+    mapped_values = values.filter(
+        pk__in=ScanReportConcept.objects.filter(content_type=value_type).values(
+            "object_id"
+        )
+    )
+
+    def grouped(queryset, key):
+        return dict(
+            queryset.order_by()
+            .values(key)
+            .annotate(count=Count("id"))
+            .values_list(key, "count")
+        )
+
+    expected = {
+        ScanReport: {pk: {} for pk in scan_reports.values_list("id", flat=True)},
+        ScanReportTable: {pk: {} for pk in tables.values_list("id", flat=True)},
+        ScanReportField: {pk: {} for pk in fields.values_list("id", flat=True)},
+    }
+    counts = (
+        (ScanReport, "table_count", tables, "scan_report"),
+        (ScanReport, "field_count", fields, "scan_report_table__scan_report"),
+        (
+            ScanReport,
+            "value_count",
+            values,
+            "scan_report_field__scan_report_table__scan_report",
+        ),
+        (ScanReport, "mapping_rule_count", rules, "scan_report"),
+        (
+            ScanReport,
+            "mapped_value_count",
+            mapped_values,
+            "scan_report_field__scan_report_table__scan_report",
+        ),
+        (ScanReportTable, "field_count", fields, "scan_report_table"),
+        (
+            ScanReportTable,
+            "value_count",
+            values,
+            "scan_report_field__scan_report_table",
+        ),
+        (
+            ScanReportTable,
+            "mapped_value_count",
+            mapped_values,
+            "scan_report_field__scan_report_table",
+        ),
+        (ScanReportField, "value_count", values, "scan_report_field"),
+        (ScanReportField, "mapped_value_count", mapped_values, "scan_report_field"),
+    )
+    for model, name, queryset, key in counts:
+        found = grouped(queryset, key)
+        for pk, row in expected[model].items():
+            row[name] = found.get(pk, 0)
+    return expected
+
+
+def reconcile_counters(scan_report_ids=None, fix=False):
+    """
+    Compare the stored counters with counts made from scratch.
+
+    Args:
+        scan_report_ids: The scan reports to check, or `None` for all of them.
+        fix (bool): Whether to overwrite drifted counters with the true counts.
+
+    Returns:
+        list: (model, pk, counter, stored, expected) for each drifted counter.
+    """
+    drift = []
+    with transaction.atomic():
+        for model, rows in compute_counters(scan_report_ids).items():
+            stored = {
+                row["id"]: row
+                for row in model.objects.filter(pk__in=list(rows)).values(
+                    "id", *model.COUNTER_FIELDS
+                )
+            }
+            for pk, expected in rows.items():
+                changed = {
+                    name: count
+                    for name, count in expected.items()
+                    if stored[pk][name] != count
+                }
+                drift.extend(
+                    (model, pk, name, stored[pk][name], count)
+                    for name, count in changed.items()
+                )
+                if fix and changed:
+                    model.objects.filter(pk=pk).update(**changed)
+    return drift
@@ -0,0 +1,286 @@
+"""
+An optional in-process index of the OMOP concept hierarchy, which answers
+ancestor/descendant lookups without going through `concept_ancestor`, a table
+of tens of millions of rows.
+
+`manage.py concept_hierarchy build` writes the hierarchy to a file of
+compressed sparse row (CSR) arrays: one block maps each ancestor to its
+descendants, the other maps each descendant to its ancestors. The file is
+memory-mapped on first use, so processes on a host share its pages. It is
+used wherever `CONCEPT_HIERARCHY_PATH` names a built file. Without one,
+callers query the database as before.
+"""
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from data.models import ConceptAncestor
+
+_MAGIC = b"CCHIER01"
+# Arrays are stored in the byte order of the host which built the file
+_BYTE_ORDER = 0x0102030405060708
+# Magic, byte order, then (number of keys, number of rows) of each block
+_HEADER = struct.Struct("=8sqqqqq")
+# The arrays of each block, and their typecodes
+_ARRAYS = (
+    ("keys", "i"),
+    ("indptr", "q"),
+    ("targets", "i"),
+    ("min_levels", "h"),
+    ("max_levels", "h"),
+)
+# The arrays of each row buffered before being written to disk
+_CHUNK_SIZE = 100000
+
+_hierarchy = None
+_hierarchy_lock = threading.Lock()
+
+
+def _layout(counts):
+    """
+    Get the offsets in the file of the arrays of blocks of the given
+    (number of keys, number of rows), each aligned to 8 bytes.
+
+    Returns:
+        list: a dict per block of {array name: (typecode, length, offset)}.
+    """
+    offset = _HEADER.size
+    layout = []
+    for n_keys, n_rows in counts:
+        block = {}
+        for name, typecode in _ARRAYS:
+            length = {"keys": n_keys, "indptr": n_keys + 1}.get(name, n_rows)
+            offset += -offset % 8
+            block[name] = (typecode, length, offset)
+            offset += length * array(typecode).itemsize
+        layout.append(block)
+    return layout
+
+
+class _BlockWriter:
+    """
+    Collects the CSR arrays of one block from rows sorted by key then
+    target, spooling the per-row arrays to temporary files.
+    """
+
+    def __init__(self):
+        self.keys = array("i")
+        self.indptr = array("q", [0])
+        self.n_rows = 0
+        self.buffers = {name: array(typecode) for name, typecode in _ARRAYS[2:]}
+        self.files = {name: tempfile.TemporaryFile() for name in self.buffers}
+
+    def add(self, key, target, min_level, max_level):
+        if not self.keys or self.keys[-1] != key:
+            if self.keys:
+                self.indptr.append(self.n_rows)
+            self.keys.append(key)
+        self.buffers["targets"].append(target)
+        self.buffers["min_levels"].append(min_level)
+        self.buffers["max_levels"].append(max_level)
+        self.n_rows += 1
+        if len(self.buffers["targets"]) >= _CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        for name, buffer in self.buffers.items():
+            buffer.tofile(self.files[name])
+            del buffer[:]
+
+    def finish(self):
+        self.flush()
+        if self.keys:
+            self.indptr.append(self.n_rows)
+
+    def write(self, f, block):
+        for name, (typecode, length, offset) in block.items():
+            f.write(b"\0" * (offset - f.tell()))
+            if name in self.files:
+                self.files[name].seek(0)
+                shutil.copyfileobj(self.files[name], f)
+                self.files[name].close()
+            else:
+                getattr(self, name).tofile(f)
+
+
+def build_concept_hierarchy(path):
+    """
+    Write the concept hierarchy index to `path`, replacing any index already
+    there once the new one is complete.
+
+    Returns:
+        int: the number of `concept_ancestor` rows indexed.
+    """
+    writers = []
+    for key, target in (
+        ("ancestor_concept_id", "descendant_concept_id"),
+        ("descendant_concept_id", "ancestor_concept_id"),
+    ):
+        writer = _BlockWriter()
+        rows = (
+            ConceptAncestor.objects.order_by(key, target)
+            .values_list(
+                key, target, "min_levels_of_separation", "max_levels_of_separation"
+            )
+            .iterator(chunk_size=_CHUNK_SIZE)
+        )
+        for row in rows:
+            writer.add(*row)
+        writer.finish()
+        writers.append(writer)
+
+    counts = [(len(writer.keys), writer.n_rows) for writer in writers]
+    partial = f"{path}.partial"
+    with open(partial, "wb") as f:
+        f.write(
+            _HEADER.pack(_MAGIC, _BYTE_ORDER, *[n for count in counts for n in count])
+        )
+        for writer, block in zip(writers, _layout(counts)):
+            writer.write(f, block)
+    # Processes with the old index mapped keep reading it until they reload
+    os.replace(partial, path)
+    return writers[0].n_rows
+
+
+class _CSR:
+    """
+    One block of the index: the targets of each key, sorted by concept id,
+    along with their min and max levels of separation.
+    """
+
+    def __init__(self, keys, indptr, targets, min_levels, max_levels):
+        self.keys = keys
+        self.indptr = indptr
+        self.targets = targets
+        self.min_levels = min_levels
+        self.max_levels = max_levels
+
+    def span(self, key):
+        i = bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return 0, 0
+        return self.indptr[i], self.indptr[i + 1]
+
+    def get(self, key):
+        start, end = self.span(key)
+        return [
+            (self.targets[j], self.min_levels[j], self.max_levels[j])
+            for j in range(start, end)
+        ]
+
+    def related(self, keys, among):
+        """
+        Yield (key, target, min level, max level) for each target of `keys`
+        which is in the set `among`, leaving out the keys themselves.
+        """
+        for key in sorted(keys):
+            start, end = self.span(key)
+            if end - start > 8 * len(among):
+                # Look the few candidates up in the sorted targets of a big row
+                rows = []
+                for target in among:
+                    j = bisect_left(self.targets, target, start, end)
+                    if j < end and self.targets[j] == target:
+                        rows.append(j)
+                rows.sort()
+            else:
+                rows = (j for j in range(start, end) if self.targets[j] in among)
+            for j in rows:
+                if self.targets[j] != key:
+                    yield key, self.targets[j], self.min_levels[j], self.max_levels[j]
+
+
+class ConceptHierarchy:
+    """
+    A memory-mapped concept hierarchy index, as written by
+    `build_concept_hierarchy()`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime_ns
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, byte_order, *counts = _HEADER.unpack_from(self._mmap)
+        if magic != _MAGIC or byte_order != _BYTE_ORDER:
+            raise ValueError(
+                f"{path} is not a concept hierarchy index built on this platform."
+            )
+        view = memoryview(self._mmap)
+        self._descendants, self._ancestors = (
+            _CSR(
+                **{
+                    name: view[
+                        offset : offset + length * array(typecode).itemsize
+                    ].cast(typecode)
+                    for name, (typecode, length, offset) in block.items()
+                }
+            )
+            for block in _layout(zip(counts[::2], counts[1::2]))
+        )
+
+    def ancestor_ids(self):
+        """
+        Get the sorted ids of the concepts with descendants.
+        """
+        return self._descendants.keys
+
+    def descendants(self, concept_id):
+        """
+        Get the (descendant concept id, min level, max level) of a concept.
+        """
+        return self._descendants.get(concept_id)
+
+    def ancestors(self, concept_id):
+        """
+        Get the (ancestor concept id, min level, max level) of a concept.
+        """
+        return self._ancestors.get(concept_id)
+
+    def find_descendants(self, concept_ids, among):
+        """
+        Find the descendants of any of `concept_ids` which are in the set
+        `among`, other than the concepts themselves.
+
+        Returns:
+            iterator: (concept id, descendant concept id, min level, max level)
+        """
+        return self._descendants.related(concept_ids, among)
+
+    def find_ancestors(self, concept_ids, among):
+        """
+        Find the ancestors of any of `concept_ids` which are in the set
+        `among`, other than the concepts themselves.
+
+        Returns:
+            iterator: (concept id, ancestor concept id, min level, max level)
+        """
+        return self._ancestors.related(concept_ids, among)
+
+
+def get_concept_hierarchy():
+    """
+    Get the index at `CONCEPT_HIERARCHY_PATH`, reloading it once it has been
+    rebuilt.
+
+    Returns:
+        ConceptHierarchy: the index, or `None` if there isn't one.
+    """
+    global _hierarchy
+    path = settings.CONCEPT_HIERARCHY_PATH
+    if not path or not os.path.exists(path):
+        return None
+    with _hierarchy_lock:
+        if (
+            _hierarchy is None
+            or _hierarchy.path != path
+            or _hierarchy.mtime != os.stat(path).st_mtime_ns
+        ):
+            _hierarchy = ConceptHierarchy(path)
+    return _hierarchy
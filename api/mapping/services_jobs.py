@@ -0,0 +1,285 @@
+"""
+A small runner for the long mapping operations (refreshing the rules,
+drawing the rules diagram and analysing concepts), so that they run outside
+of the request/response cycle and are polled for their progress and result.
+
+Jobs are rows of the `Job` table, so no broker is needed. They are run by a
+thread pool of `JOB_WORKERS` threads in the web process, or, with
+`JOB_WORKERS = 0`, by `manage.py run_jobs`. Workers claim a pending job with
+a conditional update, so that each job is run once.
+"""
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.messages.constants import DEFAULT_TAGS
+from django.db import connections, transaction
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import Job, JobKind, JobStatus, ScanReport
+from .services_rules import (
+    MappingRulesDiagramTooLarge,
+    analyse_concepts,
+    get_mapping_rules_svg,
+    refresh_mapping_rules,
+)
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class JobRequest:
+    """
+    Stands in for the request given to services which report problems with
+    `django.contrib.messages`, and collects their messages for the job.
+    """
+
+    def __init__(self, user=None):
+        self.user = user
+        self._messages = self
+        self.messages = []
+
+    def add(self, level, message, extra_tags=""):
+        self.messages.append(
+            {"level": DEFAULT_TAGS.get(level, ""), "message": str(message)}
+        )
+
+
+def report_progress(job):
+    """
+    Get a callback for a service to report the percentage of `job` done.
+    """
+
+    def progress(percent):
+        if percent != job.progress:
+            job.progress = percent
+            Job.objects.filter(pk=job.pk).update(progress=percent)
+
+    return progress
+
+
+def _refresh_rules(job, request):
+    return json.dumps(
+        refresh_mapping_rules(
+            request, job.scan_report_id, progress=report_progress(job)
+        )
+    )
+
+
+def _rules_svg(job, request):
+    return get_mapping_rules_svg(job.scan_report, job.destination_table or None)
+
+
+def _analyse_concepts(job, request):
+    return json.dumps(
+        analyse_concepts(job.scan_report_id, progress=report_progress(job)),
+        cls=JSONEncoder,
+    )
+
+
+# {kind: (runner, content type of the result)}
+JOB_RUNNERS = {
+    JobKind.REFRESH_RULES: (_refresh_rules, "application/json"),
+    JobKind.RULES_SVG: (_rules_svg, "image/svg+xml"),
+    JobKind.ANALYSE_CONCEPTS: (_analyse_concepts, "application/json"),
+}
+
+
+def get_cache_key(kind, scan_report_id):
+    """
+    Get the state of the data a job of `kind` depends on, or "" if its
+    results can never be reused. Jobs are only reused for the same
+    destination table, so it isn't part of the key.
+    """
+    if kind == JobKind.RULES_SVG:
+        return str(
+            ScanReport.objects.values_list("rules_version", flat=True).get(
+                pk=scan_report_id
+            )
+        )
+    if kind == JobKind.ANALYSE_CONCEPTS:
+        # The analysis compares against the rules of every other scan report
+        totals = ScanReport.objects.aggregate(
+            n=Count("id"), last=Max("id"), version=Sum("rules_version")
+        )
+        return f"{totals['n']}-{totals['last']}-{totals['version']}"
+    return ""
+
+
+def submit_job(kind, scan_report_id, user=None, destination_table=""):
+    """
+    Get a job running `kind` on a scan report (and, for the rules diagram, on
+    `destination_table` only): one which is waiting to run, a complete one
+    whose result is still valid, or else a new one. Waiting and new jobs are
+    started once the current transaction commits.
+
+    Jobs left running by a worker which has died are put back in the queue
+    first, so that they don't hold back the jobs of their kind for good.
+
+    Returns:
+        Job: the job to poll.
+    """
+    requeue_stale_jobs()
+    cache_key = get_cache_key(kind, scan_report_id)
+    jobs = Job.objects.filter(
+        kind=kind, scan_report_id=scan_report_id, destination_table=destination_table
+    ).order_by("-id")
+    if (job := jobs.filter(status=JobStatus.PENDING).first()) is not None:
+        # Its worker may have died before claiming it
+        transaction.on_commit(lambda: start_job(job.id))
+        return job
+    if cache_key:
+        job = jobs.filter(
+            status__in=[JobStatus.RUNNING, JobStatus.COMPLETE], cache_key=cache_key
+        ).first()
+        if job is not None:
+            return job
+
+    job = Job.objects.create(
+        kind=kind,
+        scan_report_id=scan_report_id,
+        destination_table=destination_table,
+        user=user,
+        content_type=JOB_RUNNERS[kind][1],
+    )
+    transaction.on_commit(lambda: start_job(job.id))
+    return job
+
+
+def claim_job(job_id=None):
+    """
+    Mark the oldest pending job (or the job `job_id`) as running, skipping
+    jobs which another worker has claimed first, and jobs which would run
+    alongside a job of the same kind on the same scan report.
+
+    Returns:
+        Job: the claimed job, or `None` if there is nothing to run.
+    """
+    pending = Job.objects.filter(status=JobStatus.PENDING).order_by("id")
+    if job_id is not None:
+        pending = pending.filter(pk=job_id)
+    busy = set(
+        Job.objects.filter(status=JobStatus.RUNNING).values_list(
+            "kind", "scan_report_id"
+        )
+    )
+    for job in pending:
+        if (job.kind, job.scan_report_id) in busy:
+            continue
+        claimed = Job.objects.filter(pk=job.pk, status=JobStatus.PENDING).update(
+            status=JobStatus.RUNNING, started_at=timezone.now()
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def run_job(job):
+    """
+    Run a claimed job, and save its result, or its error if it fails.
+    """
+    runner, _ = JOB_RUNNERS[job.kind]
+    request = JobRequest(job.user)
+    job.cache_key = get_cache_key(job.kind, job.scan_report_id)
+    Job.objects.filter(pk=job.pk).update(cache_key=job.cache_key)
+    try:
+        job.result = runner(job, request)
+    except MappingRulesDiagramTooLarge as e:
+        # Let the client offer to draw the tables one at a time
+        job.status = JobStatus.FAILED
+        job.error = str(e)
+        job.error_details = json.dumps({"destination_tables": e.destination_tables})
+    except Exception as e:
+        logger.exception(f"Job {job.id} ({job.kind}) failed")
+        job.status = JobStatus.FAILED
+        job.error = str(e)
+    else:
+        job.status = JobStatus.COMPLETE
+        job.progress = 100
+    job.messages = json.dumps(request.messages)
+    job.finished_at = timezone.now()
+    job.save(
+        update_fields=[
+            "status",
+            "progress",
+            "result",
+            "messages",
+            "error",
+            "error_details",
+            "finished_at",
+            "updated_at",
+        ]
+    )
+    return job
+
+
+def run_pending_jobs(limit=None):
+    """
+    Run pending jobs one after another until there are none left to claim,
+    or `limit` jobs have been run.
+
+    Returns:
+        int: the number of jobs run.
+    """
+    count = 0
+    while limit is None or count < limit:
+        job = claim_job()
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+
+def requeue_stale_jobs(timeout=None):
+    """
+    Put jobs which have been running for longer than `timeout` (by default
+    `JOB_TIMEOUT_MINUTES`) back in the queue, as their worker has died.
+
+    Returns:
+        int: the number of jobs requeued.
+    """
+    if timeout is None:
+        timeout = timedelta(minutes=settings.JOB_TIMEOUT_MINUTES)
+    return Job.objects.filter(
+        status=JobStatus.RUNNING, started_at__lt=timezone.now() - timeout
+    ).update(status=JobStatus.PENDING, progress=0, started_at=None)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.JOB_WORKERS, thread_name_prefix="mapping-job"
+            )
+    return _executor
+
+
+def _work(job_id):
+    try:
+        if (job := claim_job(job_id)) is not None:
+            run_job(job)
+        # Then run anything held back while another job of its kind ran
+        run_pending_jobs()
+    except Exception:
+        logger.exception(f"Job worker failed on job {job_id}")
+    finally:
+        connections.close_all()
+
+
+def start_job(job_id):
+    """
+    Run a job on the in-process thread pool, unless it is left to
+    `manage.py run_jobs` by `JOB_WORKERS = 0`.
+    """
+    if settings.JOB_WORKERS > 0:
+        _get_executor().submit(_work, job_id)
@@ -1,45 +1,38 @@
 import base64
+import hashlib
 import json
 import logging
 import os
-import time
+import re
+from datetime import timedelta
 from azure.storage.queue import QueueClient
 
 import requests
 from data.models import Concept, ConceptRelationship
-from django.db.models import Q
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import F, Q
 from django.contrib import messages
-
-from .models import ScanReportAssertion, ScanReportField, ScanReportValue
-from .services_rules import get_concept_from_concept_code
+from django.utils import timezone
+
+from .models import (
+    NLPCacheEntry,
+    ScanReportAssertion,
+    ScanReportConcept,
+    ScanReportField,
+    ScanReportValue,
+)
+from .services_active_concepts import get_active_scan_reports, refresh_active_concepts
+from .services_counters import (
+    count_mapped_values,
+    deferred_counters,
+    set_concept_object,
+)
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
 
 
-def get_data_from_nlp(url, headers, post_response_url):
-    """
-    This function takes a list of POST'ed URLs and returns
-    a list of responses.
-    """
-
-    get_response = []
-    for url in post_response_url:
-
-        req = requests.get(url, headers=headers)
-        job = req.json()
-
-        while job["status"] != "succeeded":
-            req = requests.get(url, headers=headers)
-            job = req.json()
-            time.sleep(3)
-        else:
-            get_response.append(job["results"])
-            logger.info("NLP Done!")
-
-    return get_response
-
-
 def process_nlp_response(get_response):
     """
     This function takes as input an NLP GET response
@@ -72,6 +65,76 @@ def process_nlp_response(get_response):
     return codes
 
 
+def get_concept_ids_from_concept_codes(vocabulary_codes):
+    """
+    Given an iterable of (vocabulary_id, concept_code) pairs, as returned by the
+    NLP service, return a dictionary mapping each pair that is recognised in the
+    vocabularies to the concept_id of its standard concept.
+
+    As `omop_helpers.get_concept_ids_from_concept_codes_batch()`, in two
+    queries however many pairs there are: one for the source concepts, and one
+    for the standard concepts of those which are non-standard. Where a source
+    concept maps to several standard concepts, the first is used.
+    """
+    # NLP returns SNOMED as SNOMEDCT_US, and RxNorm as RXNORM
+    nlp_to_omop_vocabulary = {"SNOMEDCT_US": "SNOMED", "RXNORM": "RxNorm"}
+
+    vocabulary_codes = {
+        (vocabulary_id, str(concept_code))
+        for vocabulary_id, concept_code in vocabulary_codes
+    }
+    codes_by_vocabulary = {}
+    for vocabulary_id, concept_code in vocabulary_codes:
+        omop_vocabulary_id = nlp_to_omop_vocabulary.get(vocabulary_id, vocabulary_id)
+        codes_by_vocabulary.setdefault(omop_vocabulary_id, set()).add(concept_code)
+    if not codes_by_vocabulary:
+        return {}
+
+    query = Q()
+    for vocabulary_id, concept_codes in codes_by_vocabulary.items():
+        query |= Q(vocabulary_id=vocabulary_id, concept_code__in=concept_codes)
+    source_concepts = {}
+    for concept_id, vocabulary_id, concept_code, standard_concept in (
+        Concept.objects.filter(query)
+        .order_by("concept_id")
+        .values_list("concept_id", "vocabulary_id", "concept_code", "standard_concept")
+    ):
+        source_concepts.setdefault(
+            (vocabulary_id, concept_code), (concept_id, standard_concept == "S")
+        )
+
+    # Look up the standard concepts of all non-standard source concepts at once,
+    # leaving out those which map to themselves
+    standard_concepts = {}
+    for concept_id_1, concept_id_2 in (
+        ConceptRelationship.objects.filter(
+            concept_id_1__in=[
+                concept_id
+                for concept_id, standard in source_concepts.values()
+                if not standard
+            ],
+            relationship_id__contains="Maps to",
+        )
+        .exclude(concept_id_2=F("concept_id_1"))
+        .order_by("concept_id_1", "concept_id_2")
+        .values_list("concept_id_1", "concept_id_2")
+    ):
+        standard_concepts.setdefault(concept_id_1, concept_id_2)
+
+    concept_ids = {}
+    for vocabulary_id, concept_code in vocabulary_codes:
+        omop_vocabulary_id = nlp_to_omop_vocabulary.get(vocabulary_id, vocabulary_id)
+        source_concept = source_concepts.get((omop_vocabulary_id, concept_code))
+        if source_concept is None:
+            continue
+        concept_id, standard = source_concept
+        if standard:
+            concept_ids[(vocabulary_id, concept_code)] = concept_id
+        elif concept_id in standard_concepts:
+            concept_ids[(vocabulary_id, concept_code)] = standard_concepts[concept_id]
+    return concept_ids
+
+
 def concept_code_to_id(codes):
     """
     This functions looks up standard and valid conceptIDs for concept codes
@@ -87,82 +150,347 @@ def concept_code_to_id(codes):
         "nlp_code",
         "conceptid",
     ]
+    concept_ids = get_concept_ids_from_concept_codes(
+        (str(item[4]), str(item[5])) for item in codes
+    )
     for item in codes:
-        try:
-            x = get_concept_from_concept_code(
-                concept_code=str(item[5]), vocabulary_id=str(item[4])
-            )
-            item.append(x[1].concept_id)
-            codes_dict.append(dict(zip(keys, item)))
-        except:
-            logger.info("Concept Code", item[5], "not found!")
+        concept_id = concept_ids.get((str(item[4]), str(item[5])))
+        if concept_id is None:
+            logger.info(f"Concept Code {item[5]} not found!")
+            continue
+        codes_dict.append(dict(zip(keys, item + [concept_id])))
 
     return codes_dict
 
 
-def start_nlp_field_level(request, search_term):
+# Limits of the Text Analytics for Health jobs endpoint, see
+# https://docs.microsoft.com/en-us/azure/cognitive-services/language-service/concepts/data-limits
+NLP_MAX_DOCUMENTS_PER_REQUEST = 25
+NLP_MAX_CHARS_PER_REQUEST = 125000
+# Azure Storage Queue messages are limited to 64KB, and base64 encoding inflates
+# the payload by a third, so keep each JSON payload below 48KB.
+NLP_MAX_MESSAGE_BYTES = 48000
 
-    field = ScanReportField.objects.get(pk=search_term)
-    scan_report_id = field.scan_report_table.scan_report.id
 
-    # Checks to see if the field is 'pass_from_source'
-    # If True, we pass field-level data i.e. a single string (field description)
-    # If False, we pass all values associated with that field
+def batch_nlp_documents(
+    documents,
+    max_documents=NLP_MAX_DOCUMENTS_PER_REQUEST,
+    max_chars=NLP_MAX_CHARS_PER_REQUEST,
+    max_message_bytes=NLP_MAX_MESSAGE_BYTES,
+):
+    """
+    Pack NLP documents into as few batches as possible, such that each batch
+    can be sent to the NLP service as a single request and fits into a single
+    queue message.
+
+    Input: documents - A list of {"language", "id", "text"} dicts
+    Output: batches - A list of lists of documents
+    """
+    batches = []
+    this_batch = []
+    this_batch_chars = 0
+    this_batch_bytes = len(json.dumps({"documents": []}))
+    for document in documents:
+        document_chars = len(document["text"])
+        # Account for the ", " separating documents in the JSON payload
+        document_bytes = len(json.dumps(document)) + 2
+        if this_batch and (
+            len(this_batch) >= max_documents
+            or this_batch_chars + document_chars > max_chars
+            or this_batch_bytes + document_bytes > max_message_bytes
+        ):
+            batches.append(this_batch)
+            this_batch = []
+            this_batch_chars = 0
+            this_batch_bytes = len(json.dumps({"documents": []}))
+        this_batch.append(document)
+        this_batch_chars += document_chars
+        this_batch_bytes += document_bytes
+
+    if this_batch:
+        batches.append(this_batch)
+
+    return batches
+
+
+def send_nlp_documents(documents):
+    """
+    Batch the documents and send each batch as a single message to the
+    nlp-processing-queue in Azure, reusing one queue client for all messages.
+
+    Returns the number of messages sent.
+    """
+    batches = batch_nlp_documents(documents)
+    if not batches:
+        return 0
+
+    queue = QueueClient.from_connection_string(
+        conn_str=os.environ.get("STORAGE_CONN_STRING"),
+        queue_name=os.environ.get("NLP_QUEUE_NAME"),
+    )
+
+    for batch in batches:
+        payload = json.dumps({"documents": batch})
+
+        message_bytes = payload.encode("ascii")
+        base64_bytes = base64.b64encode(message_bytes)
+        base64_message = base64_bytes.decode("ascii")
+
+        queue.send_message(base64_message)
+
+    logger.info(f"Sent {len(documents)} NLP documents in {len(batches)} messages")
+    return len(batches)
+
+
+def get_nlp_documents(field):
+    """
+    Build the NLP documents for a ScanReportField.
+
+    If the field is 'pass_from_source', a single document is built from the
+    field description (falling back to the field name). Otherwise one document
+    is built per ScanReportValue of the field, excluding values in the negative
+    assertions of the ScanReport.
+    """
     if field.pass_from_source:
 
         # We want to use the field description if available
         # However, we fall back to field name if field_description is "" (blank)
         field_text = (
-            field.description_column
-            if field.description_column is not ""
-            else field.name
+            field.description_column if field.description_column != "" else field.name
         )
 
-        document = {
-            "documents": [
-                {
-                    "language": "en",
-                    "id": str(field.id) + "_field",
-                    "text": field_text.replace("_", " "),
-                }
-            ]
-        }
+        return [
+            {
+                "language": "en",
+                "id": str(field.id) + "_field",
+                "text": field_text.replace("_", " "),
+            }
+        ]
 
-        payload = json.dumps(document)
+    scan_report_id = field.scan_report_table.scan_report_id
 
-        message_bytes = payload.encode("ascii")
-        base64_bytes = base64.b64encode(message_bytes)
-        base64_message = base64_bytes.decode("ascii")
+    # Grab assertions for the ScanReport
+    assertions = ScanReportAssertion.objects.filter(scan_report__id=scan_report_id)
+    neg_assertions = assertions.values_list("negative_assertion")
 
-        # Send JSON payload to nlp-processing-queue in Azure
-        queue = QueueClient.from_connection_string(
-            conn_str=os.environ.get("STORAGE_CONN_STRING"),
-            queue_name=os.environ.get("NLP_QUEUE_NAME"),
+    # Grab values associated with the ScanReportField
+    # Remove values in the negative assertions list
+    scan_report_values = ScanReportValue.objects.filter(scan_report_field=field).filter(
+        ~Q(value__in=neg_assertions)
+    )
+
+    field_text = (
+        field.description_column if field.description_column is not None else field.name
+    )
+
+    documents = []
+    for item in scan_report_values:
+        value_text = (
+            item.value_description if item.value_description is not None else item.value
+        )
+        documents.append(
+            {
+                "language": "en",
+                "id": str(item.id) + "_value",
+                "text": field_text.replace("_", " ")
+                + ", "
+                + value_text.replace("_", " "),
+            }
         )
 
-        queue.send_message(base64_message)
+    return documents
+
+
+def normalise_nlp_text(text):
+    """
+    Normalise document text for the NLP cache, so that texts differing only
+    in case or whitespace share a cache entry.
+    """
+    return re.sub(r"\s+", " ", text).strip().lower()
 
+
+def get_nlp_cache_key(text, model_version=None):
+    """
+    Return the NLP cache key of a document text: the sha256 of the normalised
+    text and the NLP model version.
+    """
+    model_version = model_version or settings.NLP_MODEL_VERSION
+    key = f"{model_version}\n{normalise_nlp_text(text)}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def get_nlp_cache_entries():
+    """
+    Return the NLP cache entries that have not expired.
+    """
+    expiry = timezone.now() - timedelta(days=settings.NLP_CACHE_TTL_DAYS)
+    return NLPCacheEntry.objects.filter(updated_at__gte=expiry)
+
+
+def lookup_nlp_cache(documents):
+    """
+    Look up NLP documents in the cache, counting a hit on each entry found.
+
+    Input: documents - A list of {"id", "text"} dicts
+    Output: hits - A dict mapping the ids of documents found in the cache
+            to their cached [entity, category, confidence, vocabulary, code]
+            lists
+    """
+    keys = {
+        document["id"]: get_nlp_cache_key(document["text"]) for document in documents
+    }
+    entries = {
+        entry.key: entry
+        for entry in get_nlp_cache_entries().filter(key__in=set(keys.values()))
+    }
+    if entries:
+        NLPCacheEntry.objects.filter(pk__in=[e.pk for e in entries.values()]).update(
+            hits=F("hits") + 1, last_hit_at=timezone.now()
+        )
+
+    hits = {
+        document_id: json.loads(entries[key].codes)
+        for document_id, key in keys.items()
+        if key in entries
+    }
+    logger.info(f"NLP cache: {len(hits)} hits, {len(keys) - len(hits)} misses")
+    return hits
+
+
+def store_nlp_cache(documents):
+    """
+    Store the codes extracted by the NLP service in the cache, replacing any
+    expired entry for the same text.
+
+    Input: documents - A list of {"text", "codes"} dicts
+    """
+    for document in documents:
+        key = get_nlp_cache_key(document["text"])
+        entry, created = NLPCacheEntry.objects.get_or_create(
+            key=key,
+            defaults={
+                "model_version": settings.NLP_MODEL_VERSION,
+                "codes": json.dumps(document["codes"]),
+            },
+        )
+        if not created:
+            entry.codes = json.dumps(document["codes"])
+            entry.misses = F("misses") + 1
+            entry.save()
+
+
+def save_cached_nlp_concepts(hits):
+    """
+    Create the ScanReportConcepts for documents found in the NLP cache.
+
+    Input: hits - A dict as returned by lookup_nlp_cache()
+    """
+    codes = [
+        [document_id] + code
+        for document_id, document_codes in hits.items()
+        for code in document_codes
+    ]
+    content_types = {
+        "field": ContentType.objects.get_for_model(ScanReportField),
+        "value": ContentType.objects.get_for_model(ScanReportValue),
+    }
+
+    concepts = {}
+    for item in concept_code_to_id(codes):
+        object_id, level = item["pk"].split("_")
+        key = (item["conceptid"], int(object_id), level)
+        if key in concepts:
+            continue
+        concepts[key] = ScanReportConcept(
+            nlp_entity=item["nlp_entity"],
+            nlp_entity_type=item["nlp_entity_type"],
+            nlp_confidence=item["nlp_confidence"],
+            nlp_vocabulary=item["nlp_vocab"],
+            nlp_concept_code=item["nlp_code"],
+            concept_id=item["conceptid"],
+            object_id=int(object_id),
+            content_type=content_types[level],
+        )
+
+    # Don't add multiple concepts of the same id to the same object, finding
+    # the existing ones in one query
+    levels = {content_type.id: level for level, content_type in content_types.items()}
+    existing = ScanReportConcept.objects.filter(
+        concept__in={concept_id for concept_id, _, _ in concepts},
+        object_id__in={object_id for _, object_id, _ in concepts},
+        content_type__in=content_types.values(),
+    ).values_list("concept", "object_id", "content_type")
+    for concept_id, object_id, content_type_id in existing:
+        concepts.pop((concept_id, object_id, levels[content_type_id]), None)
+
+    # `bulk_create` doesn't send signals, so count the newly mapped values here
+    value_type = content_types["value"]
+    value_ids = {
+        concept.object_id
+        for concept in concepts.values()
+        if concept.content_type == value_type
+    }
+    already_mapped = set(
+        ScanReportConcept.objects.filter(
+            content_type=value_type, object_id__in=value_ids
+        ).values_list("object_id", flat=True)
+    )
+    for concept in concepts.values():
+        set_concept_object(concept)
+    with deferred_counters():
+        ScanReportConcept.objects.bulk_create(concepts.values())
+        count_mapped_values(value_ids - already_mapped, 1)
+
+    # Nor are the active concepts refreshed, should the scan report be active
+    field_ids = {
+        concept.object_id
+        for concept in concepts.values()
+        if concept.content_type != value_type
+    }
+    scan_report_ids = set(
+        ScanReportValue.objects.filter(id__in=value_ids).values_list(
+            "scan_report_id", flat=True
+        )
+    ) | set(
+        ScanReportField.objects.filter(id__in=field_ids).values_list(
+            "scan_report_id", flat=True
+        )
+    )
+    refresh_active_concepts(
+        get_active_scan_reports()
+        .filter(id__in=scan_report_ids)
+        .values_list("id", flat=True)
+    )
+
+
+def start_nlp_field_level(request, search_term):
+
+    field = ScanReportField.objects.select_related("scan_report_table").get(
+        pk=search_term
+    )
+
+    # Checks to see if the field is 'pass_from_source'
+    # If True, we pass field-level data i.e. a single string (field description)
+    # If False, we pass all values associated with that field
+    documents = get_nlp_documents(field)
+
+    # Documents which have been through NLP before are saved from the cache
+    hits = lookup_nlp_cache(documents)
+    save_cached_nlp_concepts(hits)
+
+    # Send the remaining documents in batches to nlp-processing-queue in Azure
+    send_nlp_documents(
+        [document for document in documents if document["id"] not in hits]
+    )
+
+    if field.pass_from_source:
         messages.success(
             request,
             "Running NLP at the field level for {}. Check back soon for results from the NLP API.".format(
                 field.name
             ),
         )
-
-        return True
-
     else:
-
-        # Grab assertions for the ScanReport
-        assertions = ScanReportAssertion.objects.filter(scan_report__id=scan_report_id)
-        neg_assertions = assertions.values_list("negative_assertion")
-
-        # Grab values associated with the ScanReportField
-        # Remove values in the negative assertions list
-        scan_report_values = ScanReportValue.objects.filter(
-            scan_report_field=search_term
-        ).filter(~Q(value__in=neg_assertions))
-
         messages.success(
             request,
             "Running NLP at the value level for {}. Check back soon for results from the NLP API.".format(
@@ -170,43 +498,4 @@ def start_nlp_field_level(request, search_term):
             ),
         )
 
-        # Send data to Azure Storage Queue
-        for item in scan_report_values:
-
-            field_text = (
-                item.scan_report_field.description_column
-                if item.scan_report_field.description_column is not None
-                else item.scan_report_field.name
-            )
-            value_text = (
-                item.value_description
-                if item.value_description is not None
-                else item.value
-            )
-
-            document = {
-                "documents": [
-                    {
-                        "language": "en",
-                        "id": str(item.id) + "_value",
-                        "text": field_text.replace("_", " ")
-                        + ", "
-                        + value_text.replace("_", " "),
-                    }
-                ]
-            }
-
-            payload = json.dumps(document)
-
-            message_bytes = payload.encode("ascii")
-            base64_bytes = base64.b64encode(message_bytes)
-            base64_message = base64_bytes.decode("ascii")
-
-            # Send JSON payload to nlp-processing-queue in Azure
-            queue = QueueClient.from_connection_string(
-                conn_str=os.environ.get("STORAGE_CONN_STRING"),
-                queue_name=os.environ.get("NLP_QUEUE_NAME"),
-            )
-            queue.send_message(base64_message)
-
     return True
@@ -1,19 +1,30 @@
 import json
-import io
 import csv
+from collections import Counter, defaultdict
 from datetime import datetime
+from itertools import groupby
 
 from django.contrib import messages
 from django.contrib.contenttypes.models import ContentType
 from data.models import Concept, ConceptRelationship, ConceptAncestor
 
-from mapping.models import ScanReportTable, ScanReportField, ScanReportValue
-from mapping.models import ScanReportConcept, OmopTable, OmopField, Concept, MappingRule
+from mapping.models import ScanReportField, ScanReportValue
+from mapping.models import MappingRulesArtifact, ScanReport
+from mapping.models import ScanReportConcept, OmopField, Concept, MappingRule
+from mapping.services_hierarchy import get_concept_hierarchy
+from mapping.services_counters import (
+    add_counts,
+    bump_rules_version,
+    deferred_counters,
+)
 
 from graphviz import Digraph
 
-from django.http import HttpResponse
-from django.db.models import Q
+from django.conf import settings
+from django.http import HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import parse_etags
+from django.db import transaction
+from django.db.models import F, Q
 
 
 class NonStandardConceptMapsToSelf(Exception):
@@ -42,287 +53,296 @@ m_date_field_mapper = {
     "specimen": ["specimen_datetime"],
 }
 
+# the number of concepts whose rules are built at a time when refreshing rules
+REFRESH_BATCH_SIZE = 1000
 
-def find_date_event(source_table):
-    """
-    convienience function to return the source field of a date event
-    for a destination table from the current source table
-
-    Paramaters:
-      - source_table (ScanReportTable): object for the scan report table
 
-    Returns:
-      - ScanReportField : the source_field that has been marked as the date event
+class MappingRuleContext:
     """
-    return source_table.date_event
-
-
-def find_person_id(source_table):
+    The OMOP fields and tables, preloaded once, for generating the rules of
+    many concepts without looking them up again for each concept.
     """
-    convenience function to return the person_id for a source table
-    Args:
-      - source_table (ScanReportTable)
-    Returns:
-      - person_id (ScanReportField)
-    """
-    return source_table.person_id
-
 
-def get_omop_field(destination_field, destination_table=None):
+    def __init__(self):
+        self.omop_fields = {}
+        self.omop_fields_by_name = {}
+        for omop_field in OmopField.objects.select_related("table"):
+            self.omop_fields[(omop_field.table.table, omop_field.field)] = omop_field
+            self.omop_fields_by_name.setdefault(omop_field.field, []).append(omop_field)
+
+    def get_omop_field(self, destination_field, destination_table=None):
+        """
+        Get the OMOP field `destination_field` of `destination_table`, or, if
+        no table is given and the name is ambiguous, of an allowed table.
+        """
+        if destination_table is not None:
+            return self.omop_fields.get((destination_table, destination_field))
+        omop_fields = self.omop_fields_by_name.get(destination_field, [])
+        if len(omop_fields) > 1:
+            allowed = [f for f in omop_fields if f.table.table in m_allowed_tables]
+            return allowed[0] if allowed else None
+        return omop_fields[0] if omop_fields else None
+
+
+def get_mapping_rules_for_concept(request, context, scan_report_concept, source_field):
     """
-    function to return the destination_field object, given lookup names
+    Build, without saving, the rules of a concept: its person id and date
+    event, and its source concept id, concept id and source value (and value
+    as number for measurements), reporting why if it can't have rules.
+
     Args:
-      - destination_field (str) : the name of the destination field
-      - [optional] destination_table (str) : the name of destination table, if known
+       - request (HttpRequest): django object for the request, or None
+       - context (MappingRuleContext): the preloaded OMOP fields and tables
+       - scan_report_concept (ScanReportConcept): the concept to make rules for
+       - source_field (ScanReportField): the field the concept is on, or that
+         its value is in, with its `scan_report_table` loaded
     Returns:
-      - OmopField : the destination field object
+       - list : the unsaved MappingRules, or None if rules can't be made
     """
 
-    # if we haven't specified the table name
-    if destination_table is None:
-        # look up the field from the "allowed_tables"
-        omop_field = OmopField.objects.filter(field=destination_field)
-
-        if len(omop_field) > 1:
-            return omop_field.filter(table__table__in=m_allowed_tables)[0]
-        elif len(omop_field) == 0:
-            return None
+    def error(msg):
+        if request is not None:
+            messages.error(request, msg)
         else:
-            return omop_field[0]
-
-    else:
-        # otherwise, if we know which table the field is in, use this to find the field
-        omop_field = OmopField.objects.filter(table__table=destination_table).get(
-            field=destination_field
-        )
-    return omop_field
-
-
-def get_person_id_rule(
-    request, scan_report, scan_report_concept, source_table, destination_table
-):
-    # look up what source_field for this table contains the person id
-    person_id_source_field = find_person_id(source_table)
-
-    # get the associated OmopField Object (aka destination_table::person_id)
-    person_id_omop_field = OmopField.objects.get(
-        table=destination_table, field="person_id"
-    )
-
-    # create a new 1-1 rule
-    rule_domain_person_id, created = MappingRule.objects.update_or_create(
-        scan_report=scan_report,
-        omop_field=person_id_omop_field,
-        source_field=person_id_source_field,
-        concept=scan_report_concept,
-        approved=True,
-    )
-    # return the rule mapping
-    return rule_domain_person_id
-
-
-def get_date_rules(
-    request, scan_report, scan_report_concept, source_table, destination_table
-):
-
-    #!todo - need some checks for this
-    date_event_source_field = find_date_event(source_table)
+            print(msg)
 
-    date_omop_fields = m_date_field_mapper[destination_table.table]
-    # loop over all returned
-    # most will return just one date event
-    # in the case of condition_occurrence, it returns start and end
-    date_rules = []
-    for date_omop_field in date_omop_fields:
+    concept = scan_report_concept.concept
+    domain = concept.domain_id.lower()
 
-        # get the actual omop field object
-        date_event_omop_field = OmopField.objects.get(
-            table=destination_table, field=date_omop_field
+    # start looking up what table we're looking at
+    omop_field = context.get_omop_field(f"{domain}_source_concept_id")
+    if omop_field is None:
+        error(
+            f"Something up with this concept, '{domain}_source_concept_id' does not exist, or is from a table that is not allowed."
         )
-
-        # create a new 1-1 rule
-        rule_domain_date_event, created = MappingRule.objects.update_or_create(
-            scan_report=scan_report,
-            omop_field=date_event_omop_field,
-            source_field=date_event_source_field,
-            concept=scan_report_concept,
-            approved=True,
+    elif omop_field.table.table not in m_allowed_tables:
+        error(
+            f"Concept {concept.concept_id} ({concept.concept_name}) is from table '{omop_field.table.table}' which is not implemented yet."
         )
-
-        date_rules.append(rule_domain_date_event)
-
-    return date_rules
-
-
-def find_destination_table(request, concept):
-    domain = concept.domain_id.lower()
-    # get the omop field for the source_concept_id for this domain
-    omop_field = get_omop_field(f"{domain}_source_concept_id")
-    if omop_field is None:
+    if omop_field is None or omop_field.table.table not in m_allowed_tables:
         if request is not None:
-            messages.error(
+            messages.warning(
                 request,
-                f"Something up with this concept, '{domain}_source_concept_id' does not exist, or is from a table that is not allowed.",
+                f"Failed to make rules for {concept.concept_id} ({concept.concept_name})",
             )
         return None
-    # start looking up what table we're looking at
-    destination_table = omop_field.table
+    destination_table = omop_field.table.table
 
-    if destination_table.table not in m_allowed_tables:
-        messages.error(
-            request,
-            f"Concept {concept.concept_id} ({concept.concept_name}) is from table '{destination_table.table}' which is not implemented yet.",
-        )
+    # check whether the person_id and date events for this table are valid
+    # if not, we dont want to create any rules for this concept
+    source_table = source_field.scan_report_table
+    if source_table.person_id_id is None:
+        error(f"No person_id set for this table {source_table}, cannot create rules.")
+        return None
+    if source_table.date_event_id is None:
+        error(f"No date_event set for this table {source_table}, cannot create rules.")
         return None
-    return destination_table
-
-
-def validate_person_id_and_date(request, source_table):
-    """
-    Before creating any rules, we need to make sure the person_id and date_event
-    has been set
-    """
-
-    # find the date event first
-    person_id_source_field = find_person_id(source_table)
 
-    if person_id_source_field is None:
-        msg = f"No person_id set for this table {source_table}, cannot create rules."
-        if request:
-            messages.error(request, msg)
-        else:
-            print(msg)
-        return False
+    # (destination field, source field id) of each rule
+    destinations = [
+        (
+            context.get_omop_field("person_id", destination_table),
+            source_table.person_id_id,
+        )
+    ]
+    destinations += [
+        (
+            context.get_omop_field(date_field, destination_table),
+            source_table.date_event_id,
+        )
+        for date_field in m_date_field_mapper[destination_table]
+    ]
+    destinations += [
+        (omop_field, source_field.id),
+        (context.get_omop_field(f"{domain}_concept_id"), source_field.id),
+        (context.get_omop_field(f"{domain}_source_value"), source_field.id),
+    ]
+    if domain == "measurement":
+        destinations.append(
+            (context.get_omop_field("value_as_number", "measurement"), source_field.id)
+        )
 
-    date_event_source_field = find_date_event(source_table)
-    if date_event_source_field is None:
-        msg = f"No date_event set for this table {source_table}, cannot create rules."
-        if request:
-            messages.error(msg)
-        else:
-            print(msg)
-        return False
+    if any(destination_field is None for destination_field, _ in destinations):
+        error(
+            f"Missing OMOP fields of table '{destination_table}', cannot create rules for {concept.concept_id} ({concept.concept_name})."
+        )
+        return None
 
-    return True
+    return [
+        MappingRule(
+            scan_report_id=source_table.scan_report_id,
+            omop_field=destination_field,
+            source_field_id=source_field_id,
+            concept=scan_report_concept,
+            approved=True,
+        )
+        for destination_field, source_field_id in destinations
+    ]
 
 
-def save_mapping_rules(request, scan_report_concept):
+def build_mapping_rules(request, scan_report_concepts, context=None):
     """
-    function to save the rules
+    Build, without saving, the rules of many concepts: the OMOP fields, tables
+    and source fields are loaded once, and the rules built in memory.
+
     Args:
-       - request (HttpRequest): django object for the request (get/post)
-       - scan_report_concept (ScanReportConcept) : object containing the Concept and Link to source_value
+       - request (HttpRequest): django object for the request, or None
+       - scan_report_concepts (list): the ScanReportConcepts to make rules for
+       - context (MappingRuleContext): the preloaded OMOP fields, if already
+         loaded for an earlier batch of concepts
+    Returns:
+       - tuple : the unsaved MappingRules, the number of concepts with rules,
+         and the number without
     """
+    if context is None:
+        context = MappingRuleContext()
+    scan_report_concepts = list(scan_report_concepts)
+
+    # Load the source field (and its table) of each concept, in two queries
+    value_type = ContentType.objects.get_for_model(ScanReportValue)
+    value_ids = [
+        c.object_id for c in scan_report_concepts if c.content_type_id == value_type.id
+    ]
+    field_ids = [
+        c.object_id for c in scan_report_concepts if c.content_type_id != value_type.id
+    ]
+    value_fields = {
+        value.id: value.scan_report_field
+        for value in ScanReportValue.objects.filter(id__in=value_ids).select_related(
+            "scan_report_field__scan_report_table"
+        )
+    }
+    fields = ScanReportField.objects.select_related("scan_report_table").in_bulk(
+        field_ids
+    )
 
-    content_object = scan_report_concept.content_object
-    if isinstance(content_object, ScanReportValue):
-        scan_report_value = content_object
-        source_field = scan_report_value.scan_report_field
-    else:
-        source_field = content_object
-
-    scan_report = source_field.scan_report_table.scan_report
-
-    concept = scan_report_concept.concept
-
-    # start looking up what table we're looking at
-    destination_table = find_destination_table(request, concept)
-    if destination_table is None:
-        if request is not None:
-            messages.warning(
-                request,
-                f"Failed to make rules for {concept.concept_id} ({concept.concept_name})",
+    rules = []
+    ngood, nbad = 0, 0
+    for scan_report_concept in scan_report_concepts:
+        if scan_report_concept.content_type_id == value_type.id:
+            source_field = value_fields.get(scan_report_concept.object_id)
+        else:
+            source_field = fields.get(scan_report_concept.object_id)
+        concept_rules = (
+            None
+            if source_field is None
+            else get_mapping_rules_for_concept(
+                request, context, scan_report_concept, source_field
             )
-        return False
-
-    # get the omop field for the source_concept_id for this domain
-    domain = concept.domain_id.lower()
-    omop_field = get_omop_field(f"{domain}_source_concept_id")
+        )
+        if concept_rules is None:
+            nbad += 1
+        else:
+            ngood += 1
+            rules += concept_rules
+    return rules, ngood, nbad
 
-    # obtain the source table
-    source_table = source_field.scan_report_table
 
-    # check whether the person_id and date events for this table are valid
-    # if not, we dont want to create any rules for this concept
-    if not validate_person_id_and_date(request, source_table):
-        return False
+def mapping_rule_key(rule):
+    """
+    The natural key of a rule, within its scan report.
+    """
+    return (rule.omop_field_id, rule.source_field_id, rule.concept_id)
 
-    # keep a track of all rules that are being created
-    # only safe them if all are successfull
-    rules = []
 
-    # create a person_id rule
-    person_id_rule = get_person_id_rule(
-        request, scan_report, scan_report_concept, source_table, destination_table
-    )
-    rules.append(person_id_rule)
+def _bulk_create_mapping_rules(rules):
+    # `bulk_create` doesn't send signals, so update the counters here
+    with deferred_counters():
+        MappingRule.objects.bulk_create(rules, batch_size=1000)
+        for scan_report_id, count in Counter(r.scan_report_id for r in rules).items():
+            add_counts(ScanReport, scan_report_id, mapping_rule_count=count)
+            bump_rules_version(scan_report_id)
 
-    # create(potentially multiple) date_rules
-    date_rules = get_date_rules(
-        request, scan_report, scan_report_concept, source_table, destination_table
-    )
-    rules += date_rules
 
-    # create/update a model for the domain source_concept_id
-    #  - for this destination_field and source_field
-    #  - do_term_mapping is set to true:
-    #    - all term mapping rules associated need to be applied
-    rule_domain_source_concept_id, created = MappingRule.objects.update_or_create(
-        scan_report=scan_report,
-        omop_field=omop_field,
-        source_field=source_field,
-        concept=scan_report_concept,
-        approved=True,
-    )
-    rules.append(rule_domain_source_concept_id)
+def save_mapping_rules_bulk(request, scan_report_concepts):
+    """
+    Save the rules of many concepts at once, as built by
+    `build_mapping_rules()`, skipping those which already exist.
 
-    # create/update a model for the domain concept_id
-    #  - for this destination_field and source_field
-    #  - do_term_mapping is set to true:
-    #    - all term mapping rules associated need to be applied
-    rule_domain_concept_id, created = MappingRule.objects.update_or_create(
-        scan_report=scan_report,
-        omop_field=get_omop_field(f"{domain}_concept_id"),
-        source_field=source_field,
-        concept=scan_report_concept,
-        approved=True,
-    )
-    rules.append(rule_domain_concept_id)
+    Args:
+       - request (HttpRequest): django object for the request, or None
+       - scan_report_concepts (list): the ScanReportConcepts to make rules for
+    Returns:
+       - tuple : the number of concepts with rules, and the number without
+    """
+    rules, ngood, nbad = build_mapping_rules(request, scan_report_concepts)
+
+    # Don't repeat rules which already exist
+    existing = {
+        (scan_report_id, tuple(key))
+        for scan_report_id, *key in MappingRule.objects.filter(
+            scan_report_id__in={rule.scan_report_id for rule in rules}, approved=True
+        ).values_list(
+            "scan_report_id", "omop_field_id", "source_field_id", "concept_id"
+        )
+    }
+    new_rules = []
+    for rule in rules:
+        key = (rule.scan_report_id, mapping_rule_key(rule))
+        if key not in existing:
+            existing.add(key)
+            new_rules.append(rule)
 
-    # create/update a model for the domain source_value
-    #  - for this destination_field and source_field
-    #  - do_term_mapping is set to false
-    rule_domain_source_value, created = MappingRule.objects.update_or_create(
-        scan_report=scan_report,
-        omop_field=get_omop_field(f"{domain}_source_value"),
-        source_field=source_field,
-        concept=scan_report_concept,
-        approved=True,
-    )
-    # add this new concept mapping
-    # - the concept wont be used, because  do_term_mapping=False
-    # - but we need to preserve the link,
-    #   so when all associated concepts are deleted, the rule is deleted
-    rules.append(rule_domain_source_value)
+    _bulk_create_mapping_rules(new_rules)
+    return ngood, nbad
 
-    if domain == "measurement":
-        # create/update a model for the domain value_as_number
-        #  - for this destination_field and source_field
-        #  - do_term_mapping is set to false
-        rule_domain_value_as_number, created = MappingRule.objects.update_or_create(
-            scan_report=scan_report,
-            omop_field=get_omop_field("value_as_number", "measurement"),
-            source_field=source_field,
-            concept=scan_report_concept,
-            approved=True,
-        )
-        rules.append(rule_domain_value_as_number)
 
-    # now we are sure all rules have been created, we can save them safely
-    for rule in rules:
-        rule.save()
+def refresh_mapping_rules(request, scan_report_id, progress=None):
+    """
+    Bring the rules of a scan report in line with its concepts, by diffing the
+    rules its concepts should have against those it has on their natural key,
+    then inserting the missing rules and deleting the extra ones. Rules which
+    are kept keep their ids and approval.
 
-    return True
+    Args:
+       - request (HttpRequest): django object for the request, or None
+       - scan_report_id (int): the scan report to refresh
+       - progress (callable): called with the percentage done after each
+         batch of concepts, if given
+    Returns:
+       - dict : the number of concepts with and without rules, and the number
+         of rules added, removed and unchanged
+    """
+    concepts = find_existing_scan_report_concepts(request, scan_report_id)
+    context = MappingRuleContext()
+    wanted = {}
+    ngood, nbad = 0, 0
+    for start in range(0, len(concepts), REFRESH_BATCH_SIZE):
+        batch = concepts[start : start + REFRESH_BATCH_SIZE]
+        rules, batch_ngood, batch_nbad = build_mapping_rules(request, batch, context)
+        ngood += batch_ngood
+        nbad += batch_nbad
+        for rule in rules:
+            wanted.setdefault(mapping_rule_key(rule), rule)
+        if progress is not None:
+            # Saving the changes is the last tenth
+            progress(90 * (start + len(batch)) // len(concepts))
+
+    existing = {}
+    extra_ids = []
+    for rule_id, *key in MappingRule.objects.filter(
+        scan_report_id=scan_report_id
+    ).values_list("id", "omop_field_id", "source_field_id", "concept_id"):
+        key = tuple(key)
+        # Keep one of any duplicate rules, and those which are still wanted
+        if key in existing or key not in wanted:
+            extra_ids.append(rule_id)
+        else:
+            existing[key] = rule_id
+
+    new_rules = [rule for key, rule in wanted.items() if key not in existing]
+    if extra_ids or new_rules:
+        with transaction.atomic(), deferred_counters():
+            MappingRule.objects.filter(id__in=extra_ids).delete()
+            _bulk_create_mapping_rules(new_rules)
+
+    return {
+        "concepts": ngood,
+        "bad_concepts": nbad,
+        "added": len(new_rules),
+        "removed": len(extra_ids),
+        "unchanged": len(existing),
+    }
 
 
 def get_concept_from_concept_code(concept_code, vocabulary_id, no_source_concept=False):
@@ -437,6 +457,59 @@ class Concept2OMOP:
         return concept
 
 
+def _iter_mapping_rule_rows(structural_mapping_rules, chunk_size=None):
+    """
+    Fetch the rules with their destination field and table, source field and
+    table, concept, and the value of value-level concepts, in a single query.
+
+    Args:
+        qs : queryset of mapping rules
+        chunk_size: if present, stream the rules from the database in chunks of
+          this size, rather than fetching them all at once.
+    Yields:
+        tuple : (MappingRule id, rule dict) pairs, in the order of the queryset.
+    """
+    scanreportvalue_content_type = ContentType.objects.get_for_model(ScanReportValue)
+
+    structural_mapping_rules = structural_mapping_rules.select_related(
+        "omop_field__table",
+        "source_field__scan_report_table",
+        "concept__concept",
+    ).annotate(
+        # Joined on the concept's value, so null for field-level concepts
+        term_value=F("concept__scan_report_value__value")
+    )
+
+    if chunk_size is not None:
+        structural_mapping_rules = structural_mapping_rules.iterator(chunk_size)
+    for rule in structural_mapping_rules:
+        scan_report_concept = rule.concept
+        destination_field = rule.omop_field
+        concept_id = scan_report_concept.concept_id
+
+        # work out if we need term_mapping or not
+        term_mapping = None
+        if "concept_id" in destination_field.field:
+            if scan_report_concept.content_type_id == scanreportvalue_content_type.id:
+                term_mapping = {rule.term_value: concept_id}
+            else:
+                term_mapping = concept_id
+
+        yield (
+            rule.id,
+            {
+                "rule_id": scan_report_concept.id,
+                "rule_name": scan_report_concept.concept.concept_name,
+                "destination_table": destination_field.table,
+                "destination_field": destination_field,
+                "source_table": rule.source_field.scan_report_table,
+                "source_field": rule.source_field,
+                "term_mapping": term_mapping,
+                "creation_type": scan_report_concept.creation_type,
+            },
+        )
+
+
 def get_mapping_rules_list(structural_mapping_rules, page_number=None, page_size=None):
     """
     Args:
@@ -457,157 +530,62 @@ def get_mapping_rules_list(structural_mapping_rules, page_number=None, page_size
         last_index = page_number * page_size
         structural_mapping_rules = structural_mapping_rules[first_index:last_index]
 
-    # get all scan_report_concepts that are used
-    # get the ids first so we can make a batch call
-    scan_report_concepts = list(
-        set([obj.concept_id for obj in structural_mapping_rules])
-    )
-
-    nmapped_concepts = len(scan_report_concepts)
-
-    # make the batch call
-    scan_report_concepts_id_to_obj_map = {
-        x.id: x
-        for x in list(ScanReportConcept.objects.filter(pk__in=scan_report_concepts))
-    }
+    return [rule for _, rule in _iter_mapping_rule_rows(structural_mapping_rules)]
 
-    ntotal_concepts = len(scan_report_concepts_id_to_obj_map.values())
 
-    if nmapped_concepts != ntotal_concepts:
-        print(
-            "WARNING!! There are a differing number of scan report concepts"
-            " associate to the mapping rules, and those that exist as scan report concepts"
-        )
+def get_mapping_rules_page(structural_mapping_rules, page_size, after_id=None):
+    """
+    Get a page of rules by keyset pagination on the rule id, which stays fast
+    on deep pages, unlike slicing by page number.
 
-    # get all the ids for all ScanReportValues that are used (have been mapped with a concept)
-    scanreportvalue_content_type = ContentType.objects.get_for_model(ScanReportValue)
-    scan_report_values_with_scan_report_concepts = [
-        obj.object_id
-        for obj in ScanReportConcept.objects.filter(
-            pk__in=scan_report_concepts_id_to_obj_map,
-            content_type=scanreportvalue_content_type,
-        )
-    ]
-    # make a batch call to the ORM again..
-    scan_report_values_id_to_value_map = {
-        obj.id: obj.value
-        for obj in list(
-            ScanReportValue.objects.filter(
-                pk__in=scan_report_values_with_scan_report_concepts
-            )
-        )
-    }
+    Args:
+        qs : queryset of all mapping rules
+        page_size: the number of rules to return
+        after_id: if present, return the rules with ids after this one
+    Returns:
+        tuple : the list of rules, as from `get_mapping_rules_list()`, and the
+                id to pass as `after_id` for the next page, or None on the last page
+    """
+    structural_mapping_rules = structural_mapping_rules.order_by("id")
+    if after_id is not None:
+        structural_mapping_rules = structural_mapping_rules.filter(id__gt=after_id)
+    rows = list(_iter_mapping_rule_rows(structural_mapping_rules[:page_size]))
 
-    # get all destination field ids
-    destination_fields = [obj.omop_field_id for obj in structural_mapping_rules]
-    # batch call
-    destination_fields = {
-        obj.id: obj for obj in list(OmopField.objects.filter(pk__in=destination_fields))
-    }
+    next_id = rows[-1][0] if len(rows) == page_size else None
+    return [rule for _, rule in rows], next_id
 
-    # again with destination table
-    destination_tables = [obj.table_id for obj in destination_fields.values()]
-    destination_tables = {
-        obj.id: obj for obj in list(OmopTable.objects.filter(pk__in=destination_tables))
-    }
 
-    # and sources....
-    source_fields = [obj.source_field_id for obj in structural_mapping_rules]
-    source_fields = {
-        obj.id: obj
-        for obj in list(ScanReportField.objects.filter(pk__in=source_fields))
-    }
-    source_tables = [obj.scan_report_table_id for obj in source_fields.values()]
-    source_tables = {
-        obj.id: obj
-        for obj in list(ScanReportTable.objects.filter(pk__in=source_tables))
-    }
+def _get_cdm_entry(rule):
+    """
+    Get where a rule goes in the `cdm` of the rules JSON, and what it holds.
 
-    # Using select_related() means we can chain together querysets into one database
-    # query rather than using multiple
-    structural_mapping_rules_sr_concepts = structural_mapping_rules.select_related(
-        "concept"
-    )
-    # Generate rule.id to SRConcept.id map for all SRConcepts related to these rules.
-    rule_to_srconcept_id_map = {
-        obj.id: obj.concept.id for obj in structural_mapping_rules_sr_concepts
+    Args:
+        rule : a rule dict, as from `get_mapping_rules_list()`
+    Returns:
+        tuple : (cdm table name, rule object id, destination field, mapping spec)
+    """
+    # get the rule id
+    # i.e. 5 rules with have the same id as they're associated to the same object e.g. person mapping of 'F' to 8532
+    # append the rule_id to not overwrite mappings to the same concept ID
+    _id = rule["rule_name"] + " " + str(rule["rule_id"])
+
+    # make a new mapping spec for the destination table
+    spec = {
+        "source_table": rule["source_table"].name.replace("\ufeff", ""),
+        "source_field": rule["source_field"].name.replace("\ufeff", ""),
     }
-
-    structural_mapping_rules_sr_concepts_concepts = (
-        structural_mapping_rules.select_related("concept__concept")
+    # include term_mapping if it's needed
+    # will appear for destinations with _concept_id,
+    # either as a dict (value map) or as a str/int (field map)
+    if rule["term_mapping"] is not None:
+        spec["term_mapping"] = rule["term_mapping"]
+
+    return (
+        rule["destination_table"].table,
+        _id,
+        rule["destination_field"].field,
+        spec,
     )
-    # Generate MappingRule.id to Concept.id map for all Concepts related to SRConcepts
-    # related to these MappingRules.
-    rule_id_to_concept_name_map = {
-        obj.id: obj.concept.concept.concept_name
-        for obj in structural_mapping_rules_sr_concepts_concepts
-    }
-
-    # Make a single query to get all ScanReportConcepts associated to
-    # ScanReportValues. This means we avoid what would be more understandable,
-    # but extremely slow, code to check whether each object is associated to a
-    # ScanReportValue.
-    scan_report_concepts_with_values = [
-        obj.id
-        for obj in ScanReportConcept.objects.filter(
-            pk__in=scan_report_concepts_id_to_obj_map,
-            content_type=scanreportvalue_content_type,
-        )
-    ]
-
-    # now loop over the rules to actually create the list version of the rules
-    rules = []
-    for rule in structural_mapping_rules:
-        # get the fields/tables from the loop up lists
-        # the speed up comes from here as we dont need to keep hitting the DB to get this data
-        # we've already cached it in these dictionaries by making a batch call
-        destination_field = destination_fields[rule.omop_field_id]
-        destination_table = destination_tables[destination_field.table_id]
-
-        source_field = source_fields[rule.source_field_id]
-        source_table = source_tables[source_field.scan_report_table_id]
-
-        # get the concepts again
-        rule_scan_report_concept_id = rule_to_srconcept_id_map[rule.id]
-
-        if rule.concept_id not in scan_report_concepts_id_to_obj_map:
-            print(f"WARNING!! scan_report_concept {rule.concept_id} no longer exists")
-            continue
-
-        scan_report_concept = scan_report_concepts_id_to_obj_map[rule.concept_id]
-
-        concept_id = scan_report_concept.concept_id
-
-        concept_name = rule_id_to_concept_name_map[rule.id]
-
-        # work out if we need term_mapping or not
-        term_mapping = None
-        if "concept_id" in destination_field.field:
-            if scan_report_concept.id in scan_report_concepts_with_values:
-                term_mapping = {
-                    scan_report_values_id_to_value_map[
-                        scan_report_concept.object_id
-                    ]: concept_id
-                }
-            else:
-                term_mapping = concept_id
-
-        creation_type = scan_report_concept.creation_type
-
-        rules.append(
-            {
-                "rule_id": rule_scan_report_concept_id,
-                "rule_name": concept_name,
-                "destination_table": destination_table,
-                "destination_field": destination_field,
-                "source_table": source_table,
-                "source_field": source_field,
-                "term_mapping": term_mapping,
-                "creation_type": creation_type,
-            }
-        )
-
-    return rules
 
 
 def get_mapping_rules_json(structural_mapping_rules):
@@ -632,98 +610,210 @@ def get_mapping_rules_json(structural_mapping_rules):
         "dataset": first_rule.scan_report.dataset,
     }
 
-    # get the list of rules
-    # this is the same list/function that is used
-    #!NOTE: we could cache this to speed things up, as the page load will call this once already
-    all_rules = get_mapping_rules_list(structural_mapping_rules)
-
+    # reminder, json for ETL needs to be structured like:
+    # { 'cdm': {'person': [person_0, person_1], 'condition_occurence:[c1,c2,c3...] }
     cdm = {}
-    # loop over the list of rules
-    for rule in all_rules:
-        # get the rule id
-        # i.e. 5 rules with have the same id as they're associated to the same object e.g. person mapping of 'F' to 8532
-        # append the rule_id to not overwrite mappings to the same concept ID
-        _id = rule["rule_name"] + " " + str(rule["rule_id"])
-
-        # get the table name
-        table_name = rule["destination_table"].table
-
-        # make a new object if we havent come across this cdm table yet
-        if table_name not in cdm:
-            cdm[table_name] = {}
-
-        # reminder, json for ETL needs to be structured like:
-        # { 'cdm': {'person': [person_0, person_1], 'condition_occurence:[c1,c2,c3...] }
-        # if the sub-object (e.g. <person_0>) has not been made, create a new nested document
-        if _id not in cdm[table_name]:
-            cdm[table_name][_id] = {}
-
-        # make a new mapping spec for the destination table
-        destination_field = rule["destination_field"].field
-        cdm[table_name][_id][destination_field] = {
-            "source_table": rule["source_table"].name.replace("\ufeff", ""),
-            "source_field": rule["source_field"].name.replace("\ufeff", ""),
-        }
-        # include term_mapping if it's needed
-        # will appear for destinations with _concept_id,
-        # either as a dict (value map) or as a str/int (field map)
-        if rule["term_mapping"] is not None:
-            cdm[table_name][_id][destination_field]["term_mapping"] = rule[
-                "term_mapping"
-            ]
+    for rule in get_mapping_rules_list(structural_mapping_rules):
+        table_name, _id, destination_field, spec = _get_cdm_entry(rule)
+        cdm.setdefault(table_name, {}).setdefault(_id, {})[destination_field] = spec
 
     # add the metadata and cdm object together
     return {"metadata": metadata, "cdm": cdm}
 
 
-def download_mapping_rules(request, qs):
-    # get the mapping rules
-    output = get_mapping_rules_json(qs)
-    # used the first qs item to get the scan_report name the qs is associated with
-    scan_report = qs[0].scan_report
+def iter_mapping_rules_json(structural_mapping_rules, dataset, indent=None):
+    """
+    Encode the rules JSON incrementally, streaming the rules from the database,
+    so that compiling a `MappingRulesArtifact` doesn't hold every rule in
+    memory at once. The metadata has the time of encoding, so documents
+    encoded at different times differ: downloads are served from the
+    artifact instead.
+
+    The document holds the same `cdm` as `get_mapping_rules_json()`, laid out
+    as `json.dumps(..., indent=indent)` would lay it out, with the tables and
+    rule objects in sorted rather than first-seen order.
+
+    Args:
+        qs : queryset of all mapping rules of a scan report
+        dataset : the dataset name for the metadata
+        indent : as for `json.dumps()`
+    Yields:
+        str : pieces of the JSON document
+    """
+    separator = ", " if indent is None else ","
+
+    def newline(level):
+        return "" if indent is None else "\n" + " " * (indent * level)
+
+    def dumps(value, level):
+        return json.dumps(value, indent=indent).replace("\n", newline(level))
+
+    # Rules of the same cdm table and rule object are adjacent in this order
+    rows = _iter_mapping_rule_rows(
+        structural_mapping_rules.order_by(
+            "omop_field__table__table",
+            "concept__concept__concept_name",
+            "concept",
+            "id",
+        ),
+        chunk_size=2000,
+    )
+    entries = groupby(
+        (_get_cdm_entry(rule) for _, rule in rows), key=lambda entry: entry[:2]
+    )
+
+    table_name = None
+    for (entry_table_name, _id), entry in entries:
+        if table_name is None:
+            metadata = {
+                "date_created": datetime.utcnow().isoformat(),
+                "dataset": dataset,
+            }
+            yield "{" + newline(1) + '"metadata": ' + dumps(metadata, 1)
+            yield separator + newline(1) + '"cdm": {' + newline(2)
+            yield json.dumps(entry_table_name) + ": {" + newline(3)
+        elif entry_table_name != table_name:
+            yield newline(2) + "}" + separator + newline(2)
+            yield json.dumps(entry_table_name) + ": {" + newline(3)
+        else:
+            yield separator + newline(3)
+        table_name = entry_table_name
+
+        specs = {destination_field: spec for _, _, destination_field, spec in entry}
+        yield json.dumps(_id) + ": " + dumps(specs, 3)
+
+    if table_name is None:
+        # Empty metadata and cdm if there are no rules
+        yield dumps({"metadata": {}, "cdm": {}}, 0)
+    else:
+        yield newline(2) + "}" + newline(1) + "}" + newline(0) + "}"
+
+
+def get_mapping_rules_artifact(scan_report):
+    """
+    Get the compiled mapping rules JSON of a scan report, only compiling it
+    again if the rules have changed since it was last compiled.
+
+    Args:
+        scan_report : the ScanReport whose rules to get
+    Returns:
+        MappingRulesArtifact : the up to date compiled rules
+    """
+    artifact = MappingRulesArtifact.objects.filter(
+        scan_report=scan_report, rules_version=F("scan_report__rules_version")
+    ).first()
+    if artifact is not None:
+        return artifact
+
+    # Read the version before compiling, so that changes made while compiling
+    # leave the artifact out of date
+    rules_version = ScanReport.objects.values_list("rules_version", flat=True).get(
+        pk=scan_report.pk
+    )
+    rules = MappingRule.objects.filter(scan_report=scan_report)
+    artifact, _ = MappingRulesArtifact.objects.update_or_create(
+        scan_report=scan_report,
+        defaults={
+            "rules_version": rules_version,
+            "content": "".join(iter_mapping_rules_json(rules, scan_report.dataset)),
+            "svg": "",
+            "table_svgs": "{}",
+        },
+    )
+    return artifact
+
+
+def etag_matches(request, etag):
+    """
+    Whether the request's `If-None-Match` header matches `etag`.
+    """
+    etags = parse_etags(request.headers.get("If-None-Match", ""))
+    return "*" in etags or etag in etags
+
+
+def not_modified(etag):
+    response = HttpResponseNotModified()
+    response["ETag"] = etag
+    return response
+
+
+def iter_chunks(text, chunk_size=65536):
+    """
+    Yield `text` in pieces of `chunk_size` characters, for streaming.
+    """
+    for start in range(0, len(text), chunk_size):
+        yield text[start : start + chunk_size]
+
+
+def download_mapping_rules(request, scan_report):
+    """
+    Download the compiled mapping rules JSON of a scan report, streamed from
+    its `MappingRulesArtifact`, so that the same `ETag` always comes with the
+    same bytes.
+    """
+    artifact = get_mapping_rules_artifact(scan_report)
+    if etag_matches(request, artifact.etag):
+        return not_modified(artifact.etag)
     # make a file name
     return_type = "json"
     fname = f"{scan_report.parent_dataset.data_partner.name}_{scan_report.dataset}_structural_mapping.{return_type}"
-    # return a response that downloads the json file
 
-    response = HttpResponse(
-        json.dumps(output, indent=6), content_type="application/json"
+    response = StreamingHttpResponse(
+        iter_chunks(artifact.content), content_type="application/json"
     )
     response["Content-Disposition"] = f'attachment; filename="{fname}"'
+    response["ETag"] = artifact.etag
     return response
 
 
-def download_mapping_rules_as_csv(request, qs):
-    # get the mapping rules as a list
-    output = get_mapping_rules_list(qs)
+class Echo:
+    """
+    A file-like object which returns what is written to it, so that `csv.writer`
+    rows can be streamed without buffering them.
+    """
+
+    def write(self, value):
+        return value
 
-    # used the first qs item to get the scan_report name the qs is associated with
-    scan_report = qs[0].scan_report
-    # make a csv file name
-    return_type = "csv"
-    fname = f"{scan_report.parent_dataset.data_partner.name}_{scan_report.dataset}_structural_mapping.{return_type}"
-    # return a response that downloads the csv file
 
-    # make a string buffer
-    _buffer = io.StringIO()
-    # setup a csv writter
+def iter_mapping_rules_csv(structural_mapping_rules):
+    """
+    Encode the rules as CSV rows, streaming the rules from the database.
+
+    Args:
+        qs : queryset of all mapping rules
+    Yields:
+        str : a CSV line at a time, starting with the headers
+    """
+    # setup a csv writer
     writer = csv.writer(
-        _buffer,
+        Echo(),
         lineterminator="\n",
         delimiter=",",
         quoting=csv.QUOTE_MINIMAL,
     )
 
-    # setup the headers from the first object
     # replace term_mapping ({'source_value':'concept'}) with separate columns
-    headers = [str(x) for x in output[0].keys() if str(x) != "term_mapping"]
-    headers += ["source_value", "concept", "isFieldMapping"]
+    headers = [
+        "rule_id",
+        "rule_name",
+        "destination_table",
+        "destination_field",
+        "source_table",
+        "source_field",
+        "creation_type",
+        "source_value",
+        "concept",
+        "isFieldMapping",
+    ]
 
     # write the headers to the csv
-    writer.writerow(headers)
+    yield writer.writerow(headers)
 
     # loop over the content
-    for content in output:
+    for _, content in _iter_mapping_rule_rows(
+        structural_mapping_rules, chunk_size=2000
+    ):
         # replace the django model objects with string names
         content["destination_table"] = content["destination_table"].table
         content["destination_field"] = content["destination_field"].field
@@ -750,12 +840,20 @@ def download_mapping_rules_as_csv(request, qs):
             content["isFieldMapping"] = "1"
 
         # extract and write the contents now
-        content = [str(content[x]) for x in headers]
-        writer.writerow(content)
+        yield writer.writerow([str(content[x]) for x in headers])
+
+
+def download_mapping_rules_as_csv(request, qs):
+    # used the first qs item to get the scan_report name the qs is associated with
+    scan_report = qs[0].scan_report
+    # make a csv file name
+    return_type = "csv"
+    fname = f"{scan_report.parent_dataset.data_partner.name}_{scan_report.dataset}_structural_mapping.{return_type}"
+    # return a response that streams the csv file as it is written
 
-    # rewind the buffer and return the response
-    _buffer.seek(0)
-    response = HttpResponse(_buffer, content_type="text/csv")
+    response = StreamingHttpResponse(
+        iter_mapping_rules_csv(qs), content_type="text/csv"
+    )
     response["Content-Disposition"] = f'attachment; filename="{fname}"'
 
     return response
@@ -764,8 +862,75 @@ def download_mapping_rules_as_csv(request, qs):
 colorscheme = "gnbu9"
 
 
-def make_dag(data, colorscheme="gnbu9"):
+class MappingRulesDiagramTooLarge(Exception):
+    """
+    The mapping rules diagram has more nodes than MAPPING_RULES_SVG_MAX_NODES.
+    """
+
+    def __init__(self, nodes, destination_tables):
+        super().__init__(
+            f"The mapping rules diagram has {nodes} nodes, more than the "
+            f"{settings.MAPPING_RULES_SVG_MAX_NODES} that can be drawn at once. "
+            "Draw its destination tables one at a time."
+        )
+        self.destination_tables = destination_tables
 
+
+def make_graph(data):
+    """
+    Get the nodes and edges of the diagram of the "cdm" of the rules JSON.
+
+    Edges run from each source table to its fields, from the source fields to
+    the destination fields they are mapped to, and from the destination fields
+    to their tables. Mapping edges say whether any of their rules map terms.
+
+    Returns:
+        dict : {"nodes": [{id, kind, label}], "edges": [{source, target, kind, term_mapping}]}
+    """
+    nodes = {}
+    edges = {}
+
+    def add_node(kind, label, *key):
+        node = nodes.setdefault(
+            (kind, label, *key), {"id": len(nodes), "kind": kind, "label": label}
+        )
+        return node["id"]
+
+    def add_edge(kind, source, target, term_mapping=False):
+        edge = edges.setdefault(
+            (source, target),
+            {"source": source, "target": target, "kind": kind, "term_mapping": False},
+        )
+        edge["term_mapping"] |= term_mapping
+
+    for destination_table_name, destination_tables in data.items():
+        destination_table_id = add_node("destination_table", destination_table_name)
+        for destination_table in destination_tables.values():
+            for destination_field, source in destination_table.items():
+                destination_field_id = add_node(
+                    "destination_field", destination_field, destination_table_name
+                )
+                source_field_id = add_node(
+                    "source_field", source["source_field"], source["source_table"]
+                )
+                source_table_id = add_node("source_table", source["source_table"])
+                add_edge("destination", destination_field_id, destination_table_id)
+                add_edge(
+                    "mapping",
+                    source_field_id,
+                    destination_field_id,
+                    source.get("term_mapping") is not None,
+                )
+                add_edge("source", source_table_id, source_field_id)
+
+    return {"nodes": list(nodes.values()), "edges": list(edges.values())}
+
+
+def make_digraph(graph, colorscheme="gnbu9"):
+    """
+    Lay out a graph from `make_graph()` for graphviz, with the destination
+    on the left and the source on the right.
+    """
     dot = Digraph(strict=True, format="svg")
     dot.attr(rankdir="RL")
     with dot.subgraph(name="cluster_0") as dest, dot.subgraph(name="cluster_1") as inp:
@@ -783,139 +948,133 @@ def make_dag(data, colorscheme="gnbu9"):
             penwidth="0",
             label="Source",
         )
-
-        for destination_table_name, destination_tables in data.items():
-            dest.node(
-                destination_table_name,
-                shape="folder",
-                style="filled",
-                fontcolor="white",
+        styles = {
+            "destination_table": (
+                dest,
+                {"shape": "folder", "style": "filled", "fontcolor": "white"},
+                "9",
+            ),
+            "destination_field": (
+                dest,
+                {"shape": "box", "style": "filled,rounded", "fontcolor": "white"},
+                "7",
+            ),
+            "source_field": (inp, {"shape": "box", "style": "filled,rounded"}, "5"),
+            "source_table": (inp, {"shape": "tab", "style": "filled"}, "4"),
+        }
+        for node in graph["nodes"]:
+            cluster, style, fillcolor = styles[node["kind"]]
+            cluster.node(
+                f"n{node['id']}",
+                label=node["label"],
                 colorscheme=colorscheme,
-                fillcolor="9",
+                fillcolor=fillcolor,
+                **style,
             )
 
-            for ref_name, destination_table in destination_tables.items():
-                for destination_field, source in destination_table.items():
-                    source_field = source["source_field"]
-                    source_table = source["source_table"]
-
-                    table_name = f"{destination_table_name}_{destination_field}"
-                    dest.node(
-                        table_name,
-                        label=destination_field,
-                        style="filled,rounded",
-                        colorscheme=colorscheme,
-                        fillcolor="7",
-                        shape="box",
-                        fontcolor="white",
-                    )
-
-                    dest.edge(destination_table_name, table_name, arrowhead="none")
-
-                    source_field_name = f"{source_table}_{source_field}"
-                    inp.node(
-                        source_field_name,
-                        source_field,
-                        colorscheme=colorscheme,
-                        style="filled,rounded",
-                        fillcolor="5",
-                        shape="box",
-                    )
-
-                    if "term_mapping" in source and source["term_mapping"] is not None:
-                        dot.edge(
-                            table_name,
-                            source_field_name,
-                            dir="back",
-                            color="red",
-                            penwidth="2",
-                        )
-                    else:
-                        dot.edge(
-                            table_name, source_field_name, dir="back", penwidth="2"
-                        )
-
-                    inp.node(
-                        source_table,
-                        shape="tab",
-                        fillcolor="4",
-                        colorscheme=colorscheme,
-                        style="filled",
-                    )
-                    inp.edge(source_field_name, source_table, arrowhead="none")
-
-    return dot.pipe().decode("utf-8")
-
-
-# this is here as we should move it out of coconnect.tools
-def view_mapping_rules(request, qs):
-    # get the rules
-    output = get_mapping_rules_json(qs)
-    # use make dag svg image
-    svg = make_dag(output["cdm"])
-    # return a svg response
-    response = HttpResponse(svg, content_type="image/svg+xml")
-    return response
+        # Edges are drawn from the destination back to the source
+        for edge in graph["edges"]:
+            source, target = f"n{edge['source']}", f"n{edge['target']}"
+            if edge["kind"] == "destination":
+                dest.edge(target, source, arrowhead="none")
+            elif edge["kind"] == "source":
+                inp.edge(target, source, arrowhead="none")
+
+    # Mapping edges go between the clusters, once their nodes are placed
+    for edge in graph["edges"]:
+        if edge["kind"] == "mapping":
+            source, target = f"n{edge['source']}", f"n{edge['target']}"
+            if edge["term_mapping"]:
+                dot.edge(target, source, dir="back", color="red", penwidth="2")
+            else:
+                dot.edge(target, source, dir="back", penwidth="2")
 
+    return dot
 
-def find_existing_scan_report_concepts(request, table_id):
 
-    # find ScanReportValue associated to this table_id
-    # that have at least one concept added to them
-    values = (
-        ScanReportValue.objects.all()
-        .filter(scan_report_field__scan_report_table__scan_report=table_id)
-        .filter(concepts__isnull=False)
-    )
+def make_dag(data, colorscheme="gnbu9"):
+    return make_digraph(make_graph(data), colorscheme).pipe().decode("utf-8")
 
-    # find ScanReportField associated to this table_id
-    # that have at least one concept added to them
-    fields = (
-        ScanReportField.objects.all()
-        .filter(scan_report_table__scan_report=table_id)
-        .filter(concepts__isnull=False)
-    )
 
-    # retrieve all value concepts
-    all_concepts = [concept for obj in values for concept in obj.concepts.all()]
-    # retrieve all field concepts
-    all_concepts += [concept for obj in fields for concept in obj.concepts.all()]
-    return all_concepts
+def _get_artifact_cdm(artifact, destination_table=None):
+    cdm = json.loads(artifact.content)["cdm"]
+    if destination_table is not None:
+        cdm = {name: cdm[name] for name in cdm if name == destination_table}
+    return cdm
 
 
-#! NOTE
-# this could be slow if there are 100s of concepts to be added
-def save_multiple_mapping_rules(request, all_concepts):
-    # now loop over all concepts and save new rules
-    for concept in all_concepts:
-        save_mapping_rules(request, concept)
+def get_mapping_rules_graph(scan_report, destination_table=None):
+    """
+    Get the nodes and edges of the mapping rules diagram of a scan report, or
+    of only those rules mapped to `destination_table`, for the client to lay
+    out, from its compiled rules.
+    """
+    artifact = get_mapping_rules_artifact(scan_report)
+    return make_graph(_get_artifact_cdm(artifact, destination_table))
 
 
-def remove_mapping_rules(request, scan_report_id):
+def get_mapping_rules_svg(scan_report, destination_table=None):
     """
-    Function given a scan_report_id that will find all
-    associated mappings and delete them
+    Draw the mapping rules diagram of a scan report, or of only those rules
+    mapped to `destination_table`. The whole diagram, and that of each
+    destination table, is stored with the compiled rules, and only drawn
+    again once the rules change.
+
+    Raises:
+        MappingRulesDiagramTooLarge : if the diagram has more nodes than
+            MAPPING_RULES_SVG_MAX_NODES.
     """
-    rules = MappingRule.objects.all().filter(scan_report__id=scan_report_id)
+    artifact = get_mapping_rules_artifact(scan_report)
+    if destination_table is None and artifact.svg:
+        return artifact.svg
+    table_svgs = json.loads(artifact.table_svgs)
+    if destination_table is not None and destination_table in table_svgs:
+        return table_svgs[destination_table]
+
+    cdm = _get_artifact_cdm(artifact, destination_table)
+    graph = make_graph(cdm)
+    if len(graph["nodes"]) > settings.MAPPING_RULES_SVG_MAX_NODES:
+        raise MappingRulesDiagramTooLarge(len(graph["nodes"]), sorted(cdm))
+    svg = make_digraph(graph).pipe().decode("utf-8")
+    # Unless the rules have changed while drawing
+    current = MappingRulesArtifact.objects.filter(
+        pk=artifact.pk, rules_version=artifact.rules_version
+    )
+    if destination_table is None:
+        current.update(svg=svg)
+    else:
+        table_svgs[destination_table] = svg
+        current.update(table_svgs=json.dumps(table_svgs))
+    return svg
 
-    rules.delete()
+
+def find_existing_scan_report_concepts(request, table_id):
+
+    # retrieve all the concepts on values of this scan report, then all those
+    # on its fields, in one query each
+    all_concepts = list(
+        ScanReportConcept.objects.filter(
+            scan_report_value__scan_report=table_id
+        ).select_related("concept")
+    )
+    all_concepts += list(
+        ScanReportConcept.objects.filter(
+            scan_report_field__scan_report=table_id
+        ).select_related("concept")
+    )
+    return all_concepts
 
 
-def get_concept_details(h_concept_id):
+def get_concept_sources(concept_ids):
     """
-    Given a mapping rule and its descendant/ancestor concept id
-    Find the source field/value that the descendant/ancestor is mapped to,
-    Return the mapping rule name, the descendant/ancestor name, and the source fields/tables
+    Given a set of descendant/ancestor concept ids,
+    find the source fields/tables that each of them is mapped to, in one query.
+    Return {concept id: [source field/table details]}
     """
-    # Get the descendant/ancestor concept name
-    concept_name = Concept.objects.get(concept_id=h_concept_id).concept_name
-
-    # Get the source field id, source field name, source table id,
-    # source table name and the content type of the descendant/ancestor
     # Filter out mapping rules pointing to omop fields:
     # person id, datetime, or source_concept_id to account for duplicated mapping rules
     source_ids = (
-        MappingRule.objects.filter(concept__concept=h_concept_id)
+        MappingRule.objects.filter(concept__concept__in=concept_ids)
         .exclude(
             Q(omop_field__field__icontains="person_id")
             | Q(omop_field__field__icontains="datetime")
@@ -928,109 +1087,143 @@ def get_concept_details(h_concept_id):
             "source_field__scan_report_table__name",
             "source_field__scan_report_table__scan_report",
             "concept__content_type",
+            "concept__concept",
         )
-    ).distinct()
-    return (concept_name, source_ids)
+        .distinct()
+    )
+    sources = defaultdict(list)
+    for source in source_ids:
+        sources[source.pop("concept__concept")].append(source)
+    return sources
 
 
-def analyse_concepts(scan_report_id):
+def analyse_concepts(scan_report_id, progress=None):
     """
     Given a scan_report_id get all the mapping rules in that Scan Report.
     Get all the mapping rules from every other Scan Report and compare them against the current ones
     If there are any ancestors/descendants of the current mapping rules mapped in another Scan Report
     Find where those ancestors/descendants are mapped to
+
+    The concept hierarchy is joined against the concepts mapped in the other
+    Scan Reports in the database, or looked up in the concept hierarchy index
+    if there is one, so this takes four queries however many mapping rules
+    there are. `progress`, if given, is called with the percentage done
+    after each of them.
     """
 
-    # Get mapping rules for current scan report
-    mapping_rules = (
-        MappingRule.objects.all()
-        .filter(scan_report_id=scan_report_id)
-        .values_list("concept__concept", flat=True)
-        .distinct()
+    # Concepts of the mapping rules for current scan report
+    concepts = MappingRule.objects.filter(scan_report_id=scan_report_id).values(
+        "concept__concept"
+    )
+    # Concepts of the mapping rules for all other scan reports
+    other_concepts = MappingRule.objects.exclude(scan_report_id=scan_report_id).values(
+        "concept__concept"
     )
-    # Get mapping rules for all other scan reports
-    all_mapping_rules = MappingRule.objects.exclude(
-        scan_report_id=scan_report_id
-    ).values_list("concept__concept", flat=True)
 
-    data = []
-    descendant_list = []
-    ancestors_list = []
-    # For every mapping rule in the current scan report
-    for rule in mapping_rules:
-        # Get the name of the mapping rule concept
-        rule_name = Concept.objects.get(concept_id=rule).concept_name
-        # Find the descendants of that rule
-        descendants = ConceptAncestor.objects.filter(ancestor_concept_id=rule)
-        # Find the ancestors of that rule
-        ancestors = ConceptAncestor.objects.filter(descendant_concept_id=rule)
-
-        # For each descendant found
-        for descendant in descendants:
-            # get the concept id
-            desc = descendant.descendant_concept_id
-            desc_level = (
-                str(descendant.min_levels_of_separation) + "/",
-                str(descendant.max_levels_of_separation),
+    concept_hierarchy = get_concept_hierarchy()
+    if concept_hierarchy is not None:
+        # Look the relatives up in the concept hierarchy index instead
+        rule_concepts = set(concepts.values_list("concept__concept", flat=True))
+        mapped = set(
+            other_concepts.distinct().values_list("concept__concept", flat=True)
+        )
+        descendants = concept_hierarchy.find_descendants(rule_concepts, mapped)
+        ancestors = concept_hierarchy.find_ancestors(rule_concepts, mapped)
+    else:
+        # Leave out the concepts themselves
+        hierarchy = ConceptAncestor.objects.exclude(
+            ancestor_concept_id=F("descendant_concept_id")
+        )
+        # The descendants of the current mapping rules mapped in any other scan report
+        descendants = (
+            hierarchy.filter(
+                ancestor_concept_id__in=concepts,
+                descendant_concept_id__in=other_concepts,
             )
-            # Check if the descendant is a mapped concept in any other scan report
-            # and that it's not the same as the original concept
-            if (desc in all_mapping_rules) and (desc != rule):
-
-                # Get all the details for that descendant:
-                # descendant name, current mapping rule name, where that descendant is mapped to
-                desc_name, source_ids = get_concept_details(desc)
-                # Append all descendant details to a list
-                descendant_list.append(
-                    {
-                        "d_id": desc,
-                        "d_name": desc_name,
-                        "source": source_ids,
-                        "level": desc_level,
-                    }
-                )
-        # For each ancestor found
-        for ancestor in ancestors:
-            # get the concept_id
-            anc = ancestor.ancestor_concept_id
-            anc_level = (
-                str(ancestor.min_levels_of_separation) + "/",
-                str(ancestor.max_levels_of_separation),
+            .order_by("descendant_concept_id")
+            .values_list(
+                "ancestor_concept_id",
+                "descendant_concept_id",
+                "min_levels_of_separation",
+                "max_levels_of_separation",
+            )
+        )
+        # The ancestors of the current mapping rules mapped in any other scan report
+        ancestors = (
+            hierarchy.filter(
+                descendant_concept_id__in=concepts,
+                ancestor_concept_id__in=other_concepts,
             )
-            # If ancestor is a mapping rule in any other scan report,
-            # and is not the same rule as the current one
-            if (anc in all_mapping_rules) and (anc != rule):
-
-                # Get all the details for that ancestor:
-                # ancestor name, current mapping rule name, where that ancestor is mapped to
-                concept, source_ids = get_concept_details(anc)
-                # Append all the ancestor details to a list
-                ancestors_list.append(
+            .order_by("ancestor_concept_id")
+            .values_list(
+                "descendant_concept_id",
+                "ancestor_concept_id",
+                "min_levels_of_separation",
+                "max_levels_of_separation",
+            )
+        )
+
+    # {rule: {"descendants"|"ancestors": [(concept id, min level, max level)]}}
+    found = defaultdict(lambda: {"descendants": [], "ancestors": []})
+    for key, relatives in (("descendants", descendants), ("ancestors", ancestors)):
+        for rule, concept_id, min_level, max_level in relatives:
+            found[rule][key].append((concept_id, min_level, max_level))
+        if progress is not None:
+            progress(25 if key == "descendants" else 50)
+    if not found:
+        return {"data": []}
+
+    # Get the names of the rules and their descendants/ancestors, and where
+    # the descendants/ancestors are mapped to, in bulk
+    relatives = {
+        concept_id
+        for relations in found.values()
+        for related in relations.values()
+        for concept_id, _, _ in related
+    }
+    names = dict(
+        Concept.objects.filter(concept_id__in=relatives | set(found)).values_list(
+            "concept_id", "concept_name"
+        )
+    )
+    if progress is not None:
+        progress(75)
+    sources = get_concept_sources(relatives)
+
+    def level(min_level, max_level):
+        return (str(min_level) + "/", str(max_level))
+
+    data = []
+    # Only the mapping rules with any descendants/ancestors are listed
+    for rule in sorted(found):
+        relations = found[rule]
+        data.append(
+            {
+                "rule_id": rule,
+                "rule_name": names[rule],
+                "anc_desc": [
                     {
-                        "a_id": anc,
-                        "a_name": concept,
-                        "source": source_ids,
-                        "level": anc_level,
+                        "descendants": [
+                            {
+                                "d_id": desc,
+                                "d_name": names[desc],
+                                "source": sources[desc],
+                                "level": level(min_level, max_level),
+                            }
+                            for desc, min_level, max_level in relations["descendants"]
+                        ],
+                        "ancestors": [
+                            {
+                                "a_id": anc,
+                                "a_name": names[anc],
+                                "source": sources[anc],
+                                "level": level(min_level, max_level),
+                            }
+                            for anc, min_level, max_level in relations["ancestors"]
+                        ],
                     }
-                )
-
-        # Append all the descendants/ancestors of the current mapping rule in a dict
-        # Do not append if both lists are empty
-        if ancestors_list or descendant_list:
-            data.append(
-                {
-                    "rule_id": rule,
-                    "rule_name": rule_name,
-                    "anc_desc": [
-                        {
-                            "descendants": descendant_list,
-                            "ancestors": ancestors_list,
-                        }
-                    ],
-                }
-            )
-        # Reset lists before moving on to the next mapping rule
-        descendant_list = []
-        ancestors_list = []
+                ],
+            }
+        )
 
     return {"data": data}
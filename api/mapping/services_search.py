@@ -0,0 +1,228 @@
+"""
+Concept search by name, code and synonym, ranked by how well each concept
+matches.
+
+On Postgres the search runs against the `pg_trgm` indexes created by
+`manage.py concept_search_index`. Other databases (the SQLite test runs)
+are searched through an in-process trigram index of the same rows, which
+ranks concepts the same way, and is rebuilt as they change (see
+`get_concept_search_index()`).
+
+Concepts are ranked by:
+  - 2 for an exact (case-insensitive) `concept_code` match,
+  - 1 + similarity for a `concept_name` starting with the query,
+  - otherwise the trigram similarity of the name or its best synonym,
+leaving out concepts less similar than `SIMILARITY_THRESHOLD`, the default
+threshold of `pg_trgm`.
+"""
+import re
+import threading
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connection
+from django.db.models import Case, Count, F, FloatField, Max, OuterRef, Q
+from django.db.models import Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from data.models import Concept, ConceptSynonym
+
+from .services_vocabulary import get_vocabulary_version
+
+SIMILARITY_THRESHOLD = 0.3
+MAX_RESULTS = 100
+
+_index = None
+_index_lock = threading.Lock()
+
+# The statements `manage.py concept_search_index` runs, in order
+SEARCH_INDEXES = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    # Trigram matches (`%`) and similarity on names and synonyms
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS concept_name_trgm "
+    "ON omop.concept USING gin (concept_name gin_trgm_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS concept_synonym_name_trgm "
+    "ON omop.concept_synonym USING gin (concept_synonym_name gin_trgm_ops)",
+    # `istartswith` on names, which Django compares as UPPER(...::text)
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS concept_name_upper_trgm "
+    "ON omop.concept USING gin (UPPER(concept_name::text) gin_trgm_ops)",
+    # `iexact` on codes
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS concept_code_upper "
+    "ON omop.concept (UPPER(concept_code::text))",
+]
+
+
+def trigrams(text):
+    """
+    Get the trigrams of `text` as `pg_trgm` does: each lowercased word is
+    padded with two spaces before and one after.
+    """
+    grams = set()
+    for word in re.findall(r"[^\W_]+", text.lower()):
+        word = f"  {word} "
+        grams.update(word[i : i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+class ConceptSearchIndex:
+    """
+    An in-process trigram index of concept names and synonyms, for
+    databases without `pg_trgm`.
+    """
+
+    def __init__(self, state=None):
+        self.state = state
+        self.concepts = {}
+        self.codes = defaultdict(list)
+        # Entries are (concept id, number of trigrams)
+        self.entries = []
+        self.postings = defaultdict(list)
+
+        rows = Concept.objects.values_list(
+            "concept_id",
+            "concept_name",
+            "concept_code",
+            "vocabulary_id",
+            "domain_id",
+            "standard_concept",
+        ).iterator()
+        for concept_id, name, code, vocabulary_id, domain_id, standard in rows:
+            self.concepts[concept_id] = (name, vocabulary_id, domain_id, standard)
+            self.codes[code.lower()].append(concept_id)
+            self._add(concept_id, name)
+        self.names = sorted(
+            (name.lower(), concept_id)
+            for concept_id, (name, *_) in self.concepts.items()
+        )
+        rows = ConceptSynonym.objects.values_list(
+            "concept_id", "concept_synonym_name"
+        ).iterator()
+        for concept_id, name in rows:
+            self._add(concept_id, name)
+
+    def _add(self, concept_id, text):
+        grams = trigrams(text)
+        entry = len(self.entries)
+        self.entries.append((concept_id, len(grams)))
+        for gram in grams:
+            self.postings[gram].append(entry)
+
+    def search(self, query, filters=None, limit=MAX_RESULTS):
+        """
+        Get the ids and ranks of the best matches for `query` among the
+        concepts with the given {field: value} `filters`.
+
+        Returns:
+            list: (concept id, rank), best first.
+        """
+        filters = filters or {}
+        fields = ("vocabulary_id", "domain_id", "standard_concept")
+        wanted = [(fields.index(name) + 1, value) for name, value in filters.items()]
+
+        grams = trigrams(query)
+        shared = Counter(
+            entry for gram in grams for entry in self.postings.get(gram, ())
+        )
+        ranks = {}
+        for entry, n_shared in shared.items():
+            concept_id, n_grams = self.entries[entry]
+            similarity = n_shared / (len(grams) + n_grams - n_shared)
+            if similarity >= SIMILARITY_THRESHOLD:
+                ranks[concept_id] = max(ranks.get(concept_id, 0), similarity)
+        # Name prefixes and codes are ranked above any similarity
+        prefix = query.lower()
+        i = bisect_left(self.names, (prefix,))
+        while i < len(self.names) and self.names[i][0].startswith(prefix):
+            concept_id = self.names[i][1]
+            ranks[concept_id] = ranks.get(concept_id, 0) + 1
+            i += 1
+        for concept_id in self.codes.get(query.lower(), ()):
+            ranks[concept_id] = 2
+
+        matches = [
+            (concept_id, rank)
+            for concept_id, rank in ranks.items()
+            if concept_id in self.concepts
+            and all(self.concepts[concept_id][i] == value for i, value in wanted)
+        ]
+        matches.sort(key=lambda match: (-match[1], match[0]))
+        return matches[:limit]
+
+
+def get_concept_search_index():
+    """
+    Get the in-process index, rebuilding it when concepts or synonyms are
+    added or removed, or a new vocabulary is loaded. Concepts edited in
+    place without a change to the vocabulary version keep their old names
+    in the index until the process restarts.
+    """
+    global _index
+    state = (
+        get_vocabulary_version(),
+        Concept.objects.aggregate(n=Count("concept_id"), last=Max("concept_id")),
+        ConceptSynonym.objects.aggregate(n=Count("concept_id")),
+    )
+    with _index_lock:
+        if _index is None or _index.state != state:
+            _index = ConceptSearchIndex(state)
+    return _index
+
+
+def search_concepts(query, filters=None, limit=MAX_RESULTS):
+    """
+    Search for concepts by name, code and synonym.
+
+    Args:
+        query (str): the text to look for.
+        filters (dict): any of `vocabulary_id`, `domain_id` and
+            `standard_concept`, with the value the concepts must have.
+        limit (int): the most concepts to return.
+
+    Returns:
+        list: (Concept, rank), best first.
+    """
+    query = query.strip()
+    if not query:
+        return []
+    filters = filters or {}
+
+    if connection.vendor != "postgresql":
+        matches = get_concept_search_index().search(query, filters, limit)
+        concepts = Concept.objects.in_bulk([concept_id for concept_id, _ in matches])
+        return [(concepts[concept_id], rank) for concept_id, rank in matches]
+
+    synonym_similarity = (
+        ConceptSynonym.objects.filter(concept_id=OuterRef("concept_id"))
+        .annotate(similarity=TrigramSimilarity("concept_synonym_name", query))
+        .order_by("-similarity")
+        .values("similarity")[:1]
+    )
+    concepts = (
+        Concept.objects.filter(**filters)
+        .filter(
+            Q(concept_name__trigram_similar=query)
+            | Q(concept_name__istartswith=query)
+            | Q(concept_code__iexact=query)
+            | Q(
+                concept_id__in=ConceptSynonym.objects.filter(
+                    concept_synonym_name__trigram_similar=query
+                ).values("concept_id")
+            )
+        )
+        .annotate(
+            similarity=Greatest(
+                TrigramSimilarity("concept_name", query),
+                Coalesce(Subquery(synonym_similarity, output_field=FloatField()), 0.0),
+            )
+        )
+        .annotate(
+            rank=Case(
+                When(concept_code__iexact=query, then=Value(2.0)),
+                When(concept_name__istartswith=query, then=F("similarity") + 1),
+                default=F("similarity"),
+                output_field=FloatField(),
+            )
+        )
+        .order_by("-rank", "concept_id")[:limit]
+    )
+    return [(concept, concept.rank) for concept in concepts]
@@ -0,0 +1,49 @@
+"""
+Caching of the read-only OMOP vocabulary endpoints.
+
+Their responses only change when a new vocabulary is loaded, so they are
+kept in the `vocabulary` cache (see `CACHES`) under keys which include the
+vocabulary version, and sent with an `ETag` of the same version. Loading a
+new vocabulary changes the version, so old entries are never served again
+and expire on their own.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from data.models import Vocabulary
+
+# How long the version read from the vocabulary table is trusted for
+VERSION_SECONDS = 300
+
+
+def get_vocabulary_cache():
+    return caches["vocabulary"]
+
+
+def get_vocabulary_version():
+    """
+    Get a token of the loaded vocabularies: `VOCABULARY_VERSION` if set, or
+    else a hash of the versions in the vocabulary table, which is read again
+    every `VERSION_SECONDS`.
+    """
+    if settings.VOCABULARY_VERSION:
+        return settings.VOCABULARY_VERSION
+    cache = get_vocabulary_cache()
+    version = cache.get("vocabulary-version")
+    if version is None:
+        versions = Vocabulary.objects.order_by("vocabulary_id").values_list(
+            "vocabulary_id", "vocabulary_version"
+        )
+        version = hashlib.sha1(repr(list(versions)).encode()).hexdigest()[:16]
+        cache.set("vocabulary-version", version, VERSION_SECONDS)
+    return version
+
+
+def get_vocabulary_etag(version, name, path):
+    """
+    Get the ETag of the response of the endpoint `name` to `path` (with its
+    query string) for a vocabulary version.
+    """
+    digest = hashlib.sha1(f"{version}:{name}:{path}".encode()).hexdigest()
+    return f'"{digest}"'
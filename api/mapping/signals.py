@@ -0,0 +1,346 @@
+"""
+Signal handlers maintaining:
+
+- the `DatasetAccess` and `ScanReportAccess` tables, as visibility,
+  authorship, roles and project membership change;
+- the scan report, table and field counters, as their rows change;
+- the scan report of fields and values, and the typed foreign keys of scan
+  report concepts;
+- the materialised active concepts.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save
+from django.db.models.signals import pre_delete, pre_save
+from django.dispatch import receiver
+
+from .models import (
+    Dataset,
+    MappingRule,
+    Project,
+    ScanReport,
+    ScanReportConcept,
+    ScanReportField,
+    ScanReportTable,
+    ScanReportValue,
+)
+from .services_access import refresh_dataset_access, refresh_scan_report_access
+from .services_active_concepts import (
+    is_active_concept,
+    refresh_active_concepts,
+    refresh_concepts,
+    update_field_name,
+    update_value,
+)
+from .services_counters import (
+    add_counts,
+    bump_rules_version,
+    concept_counted_on_value,
+    count_values,
+    deleting_value,
+    get_concept_scan_report,
+    get_field_parents,
+    get_table_parent,
+    set_concept_object,
+)
+
+
+def changed_ids(sender, instance, action, reverse, pk_set, field, side):
+    """
+    Get the ids on one side of an M2M relation changed by `m2m_changed`.
+
+    Args:
+        sender: The through model of the relation.
+        instance: The instance the relation was changed from.
+        action (str): The `m2m_changed` action.
+        reverse (bool): Whether the relation was changed from the related side.
+        pk_set (set): The primary keys added or removed.
+        field: The `ManyToManyField` of the relation.
+        side (str): "source" for the model declaring `field`, else "target".
+
+    Returns:
+        set: The ids on `side` which changed, or `None` if the change
+        has not been made yet.
+    """
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    instance_name = target if reverse else source
+    wanted_name = source if side == "source" else target
+
+    if action == "pre_clear" and wanted_name != instance_name:
+        # Remember what is about to be cleared, as `pk_set` is empty on clear
+        instance._access_cleared_ids = set(
+            sender.objects.filter(**{f"{instance_name}_id": instance.pk}).values_list(
+                f"{wanted_name}_id", flat=True
+            )
+        )
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return None
+    if wanted_name == instance_name:
+        return {instance.pk}
+    if action == "post_clear":
+        return getattr(instance, "_access_cleared_ids", set())
+    return set(pk_set)
+
+
+# Fields of scan reports and datasets which affect access
+SCAN_REPORT_ACCESS_FIELDS = ("visibility", "author_id", "parent_dataset_id")
+DATASET_ACCESS_FIELDS = ("visibility",)
+
+
+@receiver(post_init, sender=ScanReport)
+@receiver(post_init, sender=Dataset)
+def remember_access_fields(sender, instance, **kwargs):
+    fields = (
+        SCAN_REPORT_ACCESS_FIELDS if sender is ScanReport else DATASET_ACCESS_FIELDS
+    )
+    instance._access_fields = {field: instance.__dict__.get(field) for field in fields}
+
+
+def access_fields_changed(instance, created, fields):
+    if created:
+        return True
+    changed = any(
+        instance._access_fields.get(field) != getattr(instance, field)
+        for field in fields
+    )
+    instance._access_fields = {field: getattr(instance, field) for field in fields}
+    return changed
+
+
+@receiver(post_save, sender=ScanReport)
+def scan_report_saved(sender, instance, created, **kwargs):
+    if access_fields_changed(instance, created, SCAN_REPORT_ACCESS_FIELDS):
+        refresh_scan_report_access([instance.pk])
+
+
+@receiver(post_save, sender=Dataset)
+def dataset_saved(sender, instance, created, **kwargs):
+    if access_fields_changed(instance, created, DATASET_ACCESS_FIELDS):
+        refresh_dataset_access([instance.pk])
+
+
+# Fields of scan reports and datasets which decide whether the concepts of a
+# scan report are active
+ACTIVE_FIELDS = {
+    ScanReport: ("status", "hidden", "parent_dataset_id"),
+    Dataset: ("hidden",),
+}
+
+
+@receiver(post_init, sender=ScanReport)
+@receiver(post_init, sender=Dataset)
+def remember_active_fields(sender, instance, **kwargs):
+    instance._active_fields = {
+        field: instance.__dict__.get(field) for field in ACTIVE_FIELDS[sender]
+    }
+
+
+@receiver(post_save, sender=ScanReport)
+@receiver(post_save, sender=Dataset)
+def active_fields_saved(sender, instance, created, **kwargs):
+    fields = ACTIVE_FIELDS[sender]
+    changed = any(
+        instance._active_fields.get(field) != getattr(instance, field)
+        for field in fields
+    )
+    instance._active_fields = {field: getattr(instance, field) for field in fields}
+    # New scan reports have no concepts yet
+    if created or not changed:
+        return
+    if sender is ScanReport:
+        refresh_active_concepts([instance.pk])
+    else:
+        refresh_active_concepts(instance.scan_reports.values_list("id", flat=True))
+
+
+@receiver(m2m_changed, sender=ScanReport.viewers.through)
+@receiver(m2m_changed, sender=ScanReport.editors.through)
+def scan_report_roles_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    field = (
+        ScanReport.viewers.field
+        if sender is ScanReport.viewers.through
+        else ScanReport.editors.field
+    )
+    if ids := changed_ids(sender, instance, action, reverse, pk_set, field, "source"):
+        refresh_scan_report_access(ids)
+
+
+@receiver(m2m_changed, sender=Dataset.viewers.through)
+@receiver(m2m_changed, sender=Dataset.editors.through)
+@receiver(m2m_changed, sender=Dataset.admins.through)
+def dataset_roles_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    field = next(
+        m2m.field
+        for m2m in (Dataset.viewers, Dataset.editors, Dataset.admins)
+        if m2m.through is sender
+    )
+    if ids := changed_ids(sender, instance, action, reverse, pk_set, field, "source"):
+        refresh_dataset_access(ids)
+
+
+@receiver(m2m_changed, sender=Project.members.through)
+def project_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    field = Project.members.field
+    if ids := changed_ids(sender, instance, action, reverse, pk_set, field, "source"):
+        refresh_dataset_access(
+            Project.datasets.through.objects.filter(project_id__in=ids).values_list(
+                "dataset_id", flat=True
+            )
+        )
+
+
+@receiver(m2m_changed, sender=Project.datasets.through)
+def project_datasets_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    field = Project.datasets.field
+    if ids := changed_ids(sender, instance, action, reverse, pk_set, field, "target"):
+        refresh_dataset_access(ids)
+
+
+@receiver(pre_delete, sender=Project)
+def project_deleting(sender, instance, **kwargs):
+    # The project's datasets can't be looked up once it has been deleted
+    instance._access_dataset_ids = list(instance.datasets.values_list("id", flat=True))
+
+
+@receiver(post_delete, sender=Project)
+def project_deleted(sender, instance, **kwargs):
+    refresh_dataset_access(getattr(instance, "_access_dataset_ids", []))
+
+
+def counted_change(kwargs):
+    """
+    Get the change in count for a `post_save` or `post_delete` of a counted row:
+    1 if it was created, -1 if it was deleted and 0 if it was updated.
+    """
+    if kwargs["signal"] is post_delete:
+        return -1
+    return 1 if kwargs["created"] else 0
+
+
+@receiver(pre_save, sender=ScanReportField)
+def field_saving(sender, instance, **kwargs):
+    if instance.scan_report_id is None:
+        instance.scan_report_id = get_table_parent(instance.scan_report_table_id)
+
+
+@receiver(pre_save, sender=ScanReportValue)
+def value_saving(sender, instance, **kwargs):
+    if instance.scan_report_id is None:
+        instance.scan_report_id = get_field_parents(instance.scan_report_field_id)[1]
+
+
+@receiver(pre_save, sender=ScanReportConcept)
+def concept_saving(sender, instance, **kwargs):
+    set_concept_object(instance)
+
+
+@receiver(post_save, sender=ScanReportTable)
+@receiver(post_delete, sender=ScanReportTable)
+def table_counted(sender, instance, **kwargs):
+    if n := counted_change(kwargs):
+        add_counts(ScanReport, instance.scan_report_id, table_count=n)
+
+
+@receiver(post_save, sender=ScanReportField)
+@receiver(post_delete, sender=ScanReportField)
+def field_counted(sender, instance, **kwargs):
+    if n := counted_change(kwargs):
+        add_counts(ScanReportTable, instance.scan_report_table_id, field_count=n)
+        add_counts(
+            ScanReport, get_table_parent(instance.scan_report_table_id), field_count=n
+        )
+
+
+@receiver(pre_delete, sender=ScanReportValue)
+def value_deleting(sender, instance, **kwargs):
+    deleting_value(instance.pk, instance.scan_report_field_id)
+
+
+@receiver(post_save, sender=ScanReportValue)
+@receiver(post_delete, sender=ScanReportValue)
+def value_counted(sender, instance, **kwargs):
+    if n := counted_change(kwargs):
+        count_values(instance.scan_report_field_id, n)
+
+
+@receiver(post_save, sender=MappingRule)
+@receiver(post_delete, sender=MappingRule)
+def mapping_rule_counted(sender, instance, **kwargs):
+    if n := counted_change(kwargs):
+        add_counts(ScanReport, instance.scan_report_id, mapping_rule_count=n)
+    bump_rules_version(instance.scan_report_id)
+
+
+@receiver(post_save, sender=ScanReportConcept)
+@receiver(post_delete, sender=ScanReportConcept)
+def concept_counted(sender, instance, **kwargs):
+    n = counted_change(kwargs)
+    value_type = ContentType.objects.get_for_model(ScanReportValue)
+    if n and instance.content_type_id == value_type.id:
+        concept_counted_on_value(instance.object_id, n)
+    elif not n:
+        # The concept of existing rules may have changed
+        bump_rules_version(get_concept_scan_report(instance))
+
+
+# Fields which appear in the compiled mapping rules, by model
+RULES_FIELDS = {
+    ScanReport: ("dataset",),
+    ScanReportTable: ("name", "person_id_id", "date_event_id"),
+    ScanReportField: ("name",),
+    ScanReportValue: ("value",),
+}
+
+
+@receiver(post_init, sender=ScanReport)
+@receiver(post_init, sender=ScanReportTable)
+@receiver(post_init, sender=ScanReportField)
+@receiver(post_init, sender=ScanReportValue)
+def remember_rules_fields(sender, instance, **kwargs):
+    instance._rules_fields = {
+        field: instance.__dict__.get(field) for field in RULES_FIELDS[sender]
+    }
+
+
+@receiver(post_save, sender=ScanReport)
+@receiver(post_save, sender=ScanReportTable)
+@receiver(post_save, sender=ScanReportField)
+@receiver(post_save, sender=ScanReportValue)
+def rules_fields_saved(sender, instance, created, **kwargs):
+    fields = RULES_FIELDS[sender]
+    changed = any(
+        instance._rules_fields.get(field) != getattr(instance, field)
+        for field in fields
+    )
+    instance._rules_fields = {field: getattr(instance, field) for field in fields}
+    # New rows aren't in any rules yet
+    if created or not changed:
+        return
+    if sender is ScanReport:
+        bump_rules_version(instance.pk)
+    elif sender is ScanReportTable:
+        bump_rules_version(instance.scan_report_id)
+    elif sender is ScanReportField:
+        bump_rules_version(get_table_parent(instance.scan_report_table_id))
+    else:
+        bump_rules_version(get_field_parents(instance.scan_report_field_id)[1])
+
+
+@receiver(post_save, sender=ScanReportConcept)
+def concept_saved(sender, instance, **kwargs):
+    # Concepts of inactive scan reports have no rows, which saves refreshing
+    # the concepts the worker posts while a scan report is uploading. Rows of
+    # deleted concepts are deleted with them.
+    if is_active_concept(instance):
+        refresh_concepts([instance.pk])
+
+
+@receiver(post_save, sender=ScanReportField)
+def field_saved(sender, instance, created, **kwargs):
+    if not created:
+        update_field_name(instance)
+
+
+@receiver(post_save, sender=ScanReportValue)
+def value_saved(sender, instance, created, **kwargs):
+    if not created:
+        update_value(instance)
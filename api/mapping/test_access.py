@@ -0,0 +1,111 @@
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from .models import (
+    AccessRoleChoices,
+    DataPartner,
+    Dataset,
+    DatasetAccess,
+    Project,
+    ScanReport,
+    ScanReportAccess,
+    VisibilityChoices,
+)
+from .services_access import check_access, rebuild_access
+
+
+class TestAccessTables(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.aragorn = User.objects.create(username="aragorn", password="strider")
+        self.boromir = User.objects.create(username="boromir", password="gondor")
+        self.project = Project.objects.create(name="The Fellowship of the Ring")
+        self.project.members.add(self.aragorn, self.boromir)
+        self.data_partner = DataPartner.objects.create(name="Dunedain")
+        self.dataset = Dataset.objects.create(
+            name="Gondor",
+            visibility=VisibilityChoices.RESTRICTED,
+            data_partner=self.data_partner,
+        )
+        self.project.datasets.add(self.dataset)
+        self.scan_report = ScanReport.objects.create(
+            dataset="Minas Tirith",
+            visibility=VisibilityChoices.PUBLIC,
+            parent_dataset=self.dataset,
+        )
+
+    def assertConsistent(self):
+        self.assertFalse(any(check_access().values()))
+
+    def scan_report_roles(self, user):
+        return set(
+            ScanReportAccess.objects.filter(
+                user=user, scan_report=self.scan_report
+            ).values_list("role", flat=True)
+        )
+
+    def visible_scan_reports(self, user):
+        return list(
+            ScanReport.objects.filter(
+                access__user=user, access__role=AccessRoleChoices.VIEW
+            )
+        )
+
+    def test_dataset_roles(self):
+        self.assertEqual(self.visible_scan_reports(self.aragorn), [])
+        self.dataset.viewers.add(self.aragorn)
+        self.assertEqual(self.visible_scan_reports(self.aragorn), [self.scan_report])
+        self.assertEqual(self.scan_report_roles(self.aragorn), {"VIEW"})
+
+        # Add from the reverse side of the relation
+        self.aragorn.dataset_admins.add(self.dataset)
+        self.assertEqual(self.scan_report_roles(self.aragorn), {"VIEW", "ADMIN"})
+        self.assertConsistent()
+
+        self.dataset.viewers.clear()
+        self.dataset.admins.clear()
+        self.assertEqual(self.scan_report_roles(self.aragorn), set())
+        self.assertConsistent()
+
+    def test_visibility(self):
+        self.scan_report.viewers.add(self.boromir)
+        self.assertEqual(self.scan_report_roles(self.boromir), set())
+
+        self.scan_report.visibility = VisibilityChoices.RESTRICTED
+        self.scan_report.save()
+        self.assertEqual(self.scan_report_roles(self.boromir), {"VIEW"})
+
+        self.dataset.visibility = VisibilityChoices.PUBLIC
+        self.dataset.save()
+        self.assertTrue(
+            DatasetAccess.objects.filter(user=self.aragorn, dataset=self.dataset)
+        )
+        self.assertEqual(self.scan_report_roles(self.aragorn), set())
+        self.assertConsistent()
+
+    def test_project_membership(self):
+        self.dataset.editors.add(self.aragorn)
+        self.assertEqual(self.scan_report_roles(self.aragorn), {"VIEW", "EDIT"})
+
+        self.aragorn.projects.clear()
+        self.assertEqual(self.scan_report_roles(self.aragorn), set())
+        self.assertConsistent()
+
+        self.project.members.add(self.aragorn)
+        self.assertEqual(self.scan_report_roles(self.aragorn), {"VIEW", "EDIT"})
+
+        self.project.delete()
+        self.assertEqual(self.scan_report_roles(self.aragorn), set())
+        self.assertConsistent()
+
+    def test_rebuild_and_check(self):
+        self.dataset.editors.add(self.aragorn)
+        ScanReportAccess.objects.all().delete()
+        with self.assertRaises(CommandError):
+            call_command("check_access")
+
+        rebuild_access()
+        self.assertConsistent()
+        self.assertEqual(self.scan_report_roles(self.aragorn), {"VIEW", "EDIT"})
+        call_command("check_access")
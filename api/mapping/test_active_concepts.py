@@ -0,0 +1,154 @@
+import os
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.test import TestCase
+from rest_framework.test import APIClient
+from data.models import Concept
+from .models import (
+    ActiveScanReportConcept,
+    DataPartner,
+    Dataset,
+    ScanReport,
+    ScanReportConcept,
+    ScanReportTable,
+    ScanReportValue,
+)
+from .test_counters import make_field
+
+
+class TestActiveScanReportConcepts(TestCase):
+    def setUp(self):
+        data_partner = DataPartner.objects.create(name="Ents")
+        self.dataset = Dataset.objects.create(name="Fangorn", data_partner=data_partner)
+        self.scan_report = ScanReport.objects.create(
+            dataset="Wellinghall", parent_dataset=self.dataset, status="COMPLET"
+        )
+        table = ScanReportTable.objects.create(
+            scan_report=self.scan_report, name="Entmoot"
+        )
+        self.field = make_field(table, "Sex")
+        self.value = ScanReportValue.objects.create(
+            scan_report_field=self.field,
+            value="M",
+            value_description="Male",
+            frequency=1,
+        )
+        # MALE, from the OMOP vocabulary
+        self.concept, _ = Concept.objects.get_or_create(
+            concept_id=8507,
+            defaults={
+                "concept_name": "MALE",
+                "domain_id": "Gender",
+                "vocabulary_id": "Gender",
+                "concept_class_id": "Gender",
+                "standard_concept": "S",
+                "concept_code": "M",
+                "valid_start_date": "1970-01-01",
+                "valid_end_date": "2099-12-31",
+            },
+        )
+        self.on_value = ScanReportConcept.objects.create(
+            concept=self.concept, content_object=self.value
+        )
+        self.on_field = ScanReportConcept.objects.create(
+            concept=self.concept, content_object=self.field
+        )
+
+    def rows(self):
+        return sorted(
+            ActiveScanReportConcept.objects.values_list(
+                "scan_report_concept_id", "field_name", "value", "value_description"
+            )
+        )
+
+    def test_concepts(self):
+        expected = [
+            (self.on_value.id, "Sex", "M", "Male"),
+            (self.on_field.id, "Sex", None, None),
+        ]
+        self.assertEqual(self.rows(), expected)
+
+        # Renamed fields and values are copied
+        self.field.name = "Gender"
+        self.field.save()
+        self.value.value_description = "Man"
+        self.value.save()
+        self.assertEqual(
+            self.rows(),
+            [
+                (self.on_value.id, "Gender", "M", "Man"),
+                (self.on_field.id, "Gender", None, None),
+            ],
+        )
+
+        self.on_field.delete()
+        self.assertEqual(len(self.rows()), 1)
+
+    def test_activity(self):
+        self.assertEqual(len(self.rows()), 2)
+
+        self.scan_report.hidden = True
+        self.scan_report.save()
+        self.assertEqual(self.rows(), [])
+        self.scan_report.hidden = False
+        self.scan_report.save()
+        self.assertEqual(len(self.rows()), 2)
+
+        self.dataset.hidden = True
+        self.dataset.save()
+        self.assertEqual(self.rows(), [])
+        self.dataset.hidden = False
+        self.dataset.save()
+        self.assertEqual(len(self.rows()), 2)
+
+        self.scan_report.status = "INPRO"
+        self.scan_report.save()
+        self.assertEqual(self.rows(), [])
+
+        # Concepts of inactive scan reports aren't added
+        ScanReportConcept.objects.create(
+            concept=self.concept, content_object=self.value
+        )
+        self.assertEqual(self.rows(), [])
+
+    def test_inactive_concepts(self):
+        self.scan_report.status = "INPRO"
+        self.scan_report.save()
+        # The insert, counting the value's concepts, and checking whether the
+        # scan report is active
+        with self.assertNumQueries(3):
+            ScanReportConcept.objects.create(
+                concept=self.concept, content_object=self.value
+            )
+        self.assertEqual(self.rows(), [])
+
+    def test_refresh_command(self):
+        expected = self.rows()
+        ActiveScanReportConcept.objects.all().delete()
+        call_command("refresh_active_concepts")
+        self.assertEqual(self.rows(), expected)
+
+    @mock.patch.dict(os.environ, {"AZ_FUNCTION_USER": "az_functions"}, clear=True)
+    def test_view(self):
+        client = APIClient()
+        client.force_authenticate(
+            get_user_model().objects.create(username=os.getenv("AZ_FUNCTION_USER"))
+        )
+        content_type = ContentType.objects.get_for_model(ScanReportValue)
+        response = client.get(
+            "/api/scanreportactiveconceptfilter/"
+            f"?content_type={content_type.id}&fields=id,object_id,concept"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            [
+                {
+                    "id": self.on_value.id,
+                    "object_id": self.value.id,
+                    "concept": self.concept.concept_id,
+                }
+            ],
+        )
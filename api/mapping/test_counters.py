@@ -0,0 +1,193 @@
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from data.models import Concept
+from .models import (
+    DataPartner,
+    Dataset,
+    ScanReport,
+    ScanReportConcept,
+    ScanReportField,
+    ScanReportTable,
+    ScanReportValue,
+)
+from .services_counters import deferred_counters, reconcile_counters
+
+
+def make_field(table, name):
+    return ScanReportField.objects.create(
+        scan_report_table=table,
+        name=name,
+        description_column="",
+        type_column="",
+        max_length=32,
+        nrows=0,
+        nrows_checked=0,
+        fraction_empty=0.0,
+        nunique_values=0,
+        fraction_unique=0.0,
+    )
+
+
+class TestCounters(TestCase):
+    def setUp(self):
+        data_partner = DataPartner.objects.create(name="Elves")
+        dataset = Dataset.objects.create(name="Lothlorien", data_partner=data_partner)
+        self.scan_report = ScanReport.objects.create(
+            dataset="Caras Galadhon", parent_dataset=dataset
+        )
+        # MALE, from the OMOP vocabulary
+        self.concept, _ = Concept.objects.get_or_create(
+            concept_id=8507,
+            defaults={
+                "concept_name": "MALE",
+                "domain_id": "Gender",
+                "vocabulary_id": "Gender",
+                "concept_class_id": "Gender",
+                "standard_concept": "S",
+                "concept_code": "M",
+                "valid_start_date": "1970-01-01",
+                "valid_end_date": "2099-12-31",
+            },
+        )
+        with deferred_counters():
+            self.table = ScanReportTable.objects.create(
+                scan_report=self.scan_report, name="Mirror"
+            )
+            self.fields = [make_field(self.table, name) for name in ("Sex", "Ring")]
+            self.values = [
+                ScanReportValue.objects.create(
+                    scan_report_field=field, value=value, frequency=1
+                )
+                for field in self.fields
+                for value in ("Nenya", "Vilya")
+            ]
+
+    def counters(self, obj):
+        obj.refresh_from_db()
+        return {
+            name: getattr(obj, name)
+            for name in obj.COUNTER_FIELDS
+            if name != "rules_version"
+        }
+
+    def test_ingest(self):
+        self.assertEqual(
+            self.counters(self.scan_report),
+            {
+                "table_count": 1,
+                "field_count": 2,
+                "value_count": 4,
+                "mapping_rule_count": 0,
+                "mapped_value_count": 0,
+            },
+        )
+        self.assertEqual(self.counters(self.fields[0])["value_count"], 2)
+        self.assertEqual(reconcile_counters(), [])
+
+    def test_batched_updates(self):
+        # A savepoint, one memoised parent lookup, the inserts, and one counter
+        # update per counted row
+        with self.assertNumQueries(2 + 1 + 10 + 3):
+            with deferred_counters():
+                for i in range(10):
+                    ScanReportValue.objects.create(
+                        scan_report_field=self.fields[1], value=str(i), frequency=1
+                    )
+        self.assertEqual(self.counters(self.table)["value_count"], 14)
+        self.assertEqual(reconcile_counters(), [])
+
+    def test_mapped_values(self):
+        value = self.values[0]
+        for _ in range(2):
+            ScanReportConcept.objects.create(concept=self.concept, content_object=value)
+        self.assertEqual(self.counters(self.scan_report)["mapped_value_count"], 1)
+
+        ScanReportConcept.objects.filter(object_id=value.id).first().delete()
+        self.assertEqual(self.counters(self.table)["mapped_value_count"], 1)
+        ScanReportConcept.objects.filter(object_id=value.id).first().delete()
+        self.assertEqual(self.counters(self.table)["mapped_value_count"], 0)
+        self.assertEqual(reconcile_counters(), [])
+
+    def test_cascade_delete(self):
+        ScanReportConcept.objects.create(
+            concept=self.concept, content_object=self.values[0]
+        )
+        self.fields[0].delete()
+        self.assertEqual(
+            self.counters(self.scan_report),
+            {
+                "table_count": 1,
+                "field_count": 1,
+                "value_count": 2,
+                "mapping_rule_count": 0,
+                "mapped_value_count": 0,
+            },
+        )
+        self.assertEqual(reconcile_counters(), [])
+
+    def test_stale_save_keeps_counts(self):
+        stale = ScanReport.objects.get(pk=self.scan_report.pk)
+        ScanReportTable.objects.create(scan_report=self.scan_report, name="Phial")
+        stale.name = "Galadriel"
+        stale.save()
+        self.assertEqual(self.counters(self.scan_report)["table_count"], 2)
+
+    def test_scan_report_filled_in(self):
+        for model in (ScanReportField, ScanReportValue):
+            self.assertEqual(
+                set(model.objects.values_list("scan_report", flat=True)),
+                {self.scan_report.id},
+            )
+            model.objects.update(scan_report=None)
+
+        call_command("backfill_scan_reports", batch_size=2)
+        for model in (ScanReportField, ScanReportValue):
+            self.assertEqual(
+                set(model.objects.values_list("scan_report", flat=True)),
+                {self.scan_report.id},
+            )
+
+    def test_concept_objects(self):
+        value_concept = ScanReportConcept.objects.create(
+            concept=self.concept, content_object=self.values[0]
+        )
+        field_concept = ScanReportConcept.objects.create(
+            concept=self.concept, content_object=self.fields[0]
+        )
+        self.assertEqual(
+            list(self.values[0].scan_report_concepts.all()), [value_concept]
+        )
+        self.assertEqual(
+            list(self.fields[0].scan_report_concepts.all()), [field_concept]
+        )
+
+        # Moved to another value
+        value_concept.content_object = self.values[1]
+        value_concept.save()
+        self.assertEqual(value_concept.scan_report_value_id, self.values[1].id)
+
+        ScanReportConcept.objects.update(scan_report_field=None, scan_report_value=None)
+        self.scan_report.refresh_from_db()
+        rules_version = self.scan_report.rules_version
+        call_command("backfill_concept_objects", batch_size=1)
+        # Rules compiled without the keys are compiled again
+        self.scan_report.refresh_from_db()
+        self.assertEqual(self.scan_report.rules_version, rules_version + 1)
+        self.assertEqual(
+            list(self.values[1].scan_report_concepts.all()), [value_concept]
+        )
+        self.assertEqual(
+            list(self.fields[0].scan_report_concepts.all()), [field_concept]
+        )
+
+    def test_reconcile_command(self):
+        ScanReport.objects.filter(pk=self.scan_report.pk).update(value_count=0)
+        ScanReportField.objects.filter(pk=self.fields[0].pk).update(value_count=7)
+        with self.assertRaises(CommandError):
+            call_command("reconcile_counters")
+
+        call_command("reconcile_counters", fix=True)
+        self.assertEqual(reconcile_counters(), [])
+        self.assertEqual(self.counters(self.scan_report)["value_count"], 4)
+        call_command("reconcile_counters", scan_reports=[self.scan_report.pk])
@@ -0,0 +1,120 @@
+from io import BytesIO
+import openpyxl
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from .forms import ScanReportForm
+
+FIELD_OVERVIEW_HEADERS = [
+    "Table",
+    "Field",
+    "Description",
+    "Type",
+    "Max length",
+    "N rows",
+    "N rows checked",
+    "Fraction empty",
+    "N unique values",
+    "Fraction unique",
+]
+
+
+def make_scan_report(field_overview, tables):
+    """
+    Make an uploaded scan report with the given Field Overview rows of
+    (table, field), and {table: fields} sheets.
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    fo_ws = wb.create_sheet("Field Overview")
+    fo_ws.append(FIELD_OVERVIEW_HEADERS)
+    for row in field_overview:
+        fo_ws.append(row)
+    wb.create_sheet("Table Overview").append(["Table"])
+    for table, fields in tables.items():
+        ws = wb.create_sheet(table)
+        ws.append([name for field in fields for name in (field, "Frequency")])
+        ws.append([value for field in fields for value in (f"{field} value", 1)])
+    f = BytesIO()
+    wb.save(f)
+    return SimpleUploadedFile("scan_report.xlsx", f.getvalue())
+
+
+class TestScanReportForm(TestCase):
+    tables = {"Hobbits": ["Name", "Height"], "Dwarves": ["Name", "Beard"]}
+    field_overview = [
+        ["Hobbits", "Name"],
+        ["Hobbits", "Height"],
+        [],
+        ["Dwarves", "Name"],
+        ["Dwarves", "Beard"],
+        [],
+    ]
+
+    def clean(self, scan_report):
+        form = ScanReportForm()
+        form.cleaned_data = {"scan_report_file": scan_report}
+        return form.clean_scan_report_file()
+
+    def errors(self, scan_report):
+        with self.assertRaises(ValidationError) as raised:
+            self.clean(scan_report)
+        return raised.exception.messages
+
+    def test_valid(self):
+        scan_report = make_scan_report(self.field_overview, self.tables)
+        self.assertIs(self.clean(scan_report), scan_report)
+        # The upload is left ready to be sent on
+        self.assertEqual(scan_report.tell(), 0)
+
+    def test_separators(self):
+        field_overview = [row for row in self.field_overview if row]
+        self.assertEqual(
+            self.errors(make_scan_report(field_overview, self.tables)),
+            [
+                "At <Cell 'Field Overview'.A4>, tables in Field Overview table are "
+                "not correctly separated by a single line. Note: There should be no "
+                "separator line between the header row and the first row of the "
+                "first table."
+            ],
+        )
+
+    def test_sheets(self):
+        tables = {"Hobbits": self.tables["Hobbits"], "Ents": ["Name"]}
+        self.assertEqual(
+            self.errors(make_scan_report(self.field_overview, tables)),
+            [
+                "Tables in Field Overview sheet do not match the sheets supplied.",
+                "{'Ents'} are sheets that do not have matching entries in first "
+                "column of the Field Overview sheet. ",
+                "{'Dwarves'} are table names in first column of Field Overview "
+                "sheet but do not have matching sheets supplied.",
+            ],
+        )
+
+    def test_fields(self):
+        tables = {"Hobbits": ["Name", "Name"], "Dwarves": ["Name", "Beard"]}
+        # The last table is checked without an empty line after it
+        field_overview = self.field_overview[:3] + [
+            ["Dwarves", "Name"],
+            ["Dwarves", "Axe"],
+        ]
+        self.assertEqual(
+            self.errors(make_scan_report(field_overview, tables)),
+            [
+                "Sheet 'Hobbits' contains more than one field with the name 'Name'. "
+                "Field names must be unique within a table.",
+                "Fields in Field Overview against table Hobbits do not match fields "
+                "in the associated sheet. ",
+                "{'Height'} exist in second column of Field Overview sheet against "
+                "the table 'Hobbits' but there are no matching column names in the "
+                "associated sheet 'Hobbits'.",
+                "Fields in Field Overview against table Dwarves do not match fields "
+                "in the associated sheet. ",
+                "{'Beard'} exist in the 'Dwarves' sheet but there are no matching "
+                "entries in the second column of the Field Overview sheet in the "
+                "rows associated to the table 'Dwarves'. ",
+                "{'Axe'} exist in second column of Field Overview sheet against the "
+                "table 'Dwarves' but there are no matching column names in the "
+                "associated sheet 'Dwarves'.",
+            ],
+        )
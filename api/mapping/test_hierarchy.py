@@ -0,0 +1,86 @@
+import os
+import tempfile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from django.contrib.auth import get_user_model
+from data.models import ConceptAncestor
+from .services_hierarchy import (
+    ConceptHierarchy,
+    build_concept_hierarchy,
+    get_concept_hierarchy,
+)
+
+
+class TestConceptHierarchy(TestCase):
+    def setUp(self):
+        # The Line of Durin: Thorin II, son of Thrain II, son of Thror, and
+        # ten generations (1-10) above Thorin III (100), with their levels
+        rows = [(3, 2, 1, 1), (2, 1, 1, 2), (1, 1, 0, 0)]
+        rows += [(n, 100, n, n + 1) for n in range(4, 14)]
+        ConceptAncestor.objects.bulk_create(
+            ConceptAncestor(
+                ancestor_concept_id=ancestor,
+                descendant_concept_id=descendant,
+                min_levels_of_separation=min_level,
+                max_levels_of_separation=max_level,
+            )
+            for ancestor, descendant, min_level, max_level in rows
+        )
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "hierarchy.idx")
+        self.assertEqual(build_concept_hierarchy(self.path), len(rows))
+        self.hierarchy = ConceptHierarchy(self.path)
+
+    def test_lookups(self):
+        self.assertEqual(self.hierarchy.descendants(3), [(2, 1, 1)])
+        self.assertEqual(self.hierarchy.ancestors(1), [(1, 0, 0), (2, 1, 2)])
+        self.assertEqual(len(self.hierarchy.ancestors(100)), 10)
+        self.assertEqual(self.hierarchy.descendants(100), [])
+        self.assertEqual(self.hierarchy.ancestors(99), [])
+        self.assertEqual(list(self.hierarchy.ancestor_ids()), list(range(1, 14)))
+
+    def test_find(self):
+        self.assertEqual(
+            list(self.hierarchy.find_descendants({1, 2, 3}, {1, 2})),
+            [(2, 1, 1, 2), (3, 2, 1, 1)],
+        )
+        # A big row is searched for the few concepts looked for
+        self.assertEqual(
+            list(self.hierarchy.find_ancestors({100, 1}, {7})),
+            [(100, 7, 7, 8)],
+        )
+
+    def test_get_concept_hierarchy(self):
+        with override_settings(CONCEPT_HIERARCHY_PATH=None):
+            self.assertIsNone(get_concept_hierarchy())
+        with override_settings(CONCEPT_HIERARCHY_PATH=self.path):
+            hierarchy = get_concept_hierarchy()
+            self.assertIs(get_concept_hierarchy(), hierarchy)
+
+            # Rebuilt indexes are reloaded
+            ConceptAncestor.objects.filter(ancestor_concept_id=3).delete()
+            build_concept_hierarchy(self.path)
+            os.utime(self.path, ns=(0, 0))
+            self.assertEqual(get_concept_hierarchy().descendants(3), [])
+
+    def test_view(self):
+        client = APIClient()
+        client.force_authenticate(
+            get_user_model().objects.create(username="dain", password="ironfoot")
+        )
+        with override_settings(CONCEPT_HIERARCHY_PATH=self.path):
+            with self.assertNumQueries(0):
+                indexed = client.get(
+                    "/api/omop/conceptancestors/?descendant_concept_id=1"
+                )
+        queried = client.get("/api/omop/conceptancestors/?descendant_concept_id=1")
+        self.assertEqual(len(indexed.data), 2)
+        self.assertEqual(
+            sorted(indexed.data, key=lambda row: row["ancestor_concept_id"]),
+            sorted(queried.data, key=lambda row: row["ancestor_concept_id"]),
+        )
+
+    def test_benchmark(self):
+        call_command("concept_hierarchy", "benchmark", path=self.path, sample=5)
@@ -0,0 +1,153 @@
+import re
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test import TestCase
+from data.models import Concept
+from .models import (
+    DataPartner,
+    Dataset,
+    MappingRule,
+    OmopField,
+    OmopTable,
+    ScanReport,
+    ScanReportConcept,
+    ScanReportField,
+    ScanReportTable,
+    ScanReportValue,
+)
+
+ROWS = 2000
+
+
+class TestQueryPlans(TestCase):
+    """
+    Check that the main filters on the mapping tables are answered from an
+    index rather than by scanning the whole table.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        data_partner = DataPartner.objects.create(name="Rohan")
+        dataset = Dataset.objects.create(name="Edoras", data_partner=data_partner)
+        ScanReport.objects.bulk_create(
+            ScanReport(
+                dataset=f"Muster {i}",
+                parent_dataset=dataset,
+                status="COMPLET" if i % 2 else "INPRO",
+                hidden=i % 10 == 0,
+            )
+            for i in range(ROWS // 10)
+        )
+        cls.scan_report = ScanReport.objects.first()
+        table = ScanReportTable.objects.create(
+            scan_report=cls.scan_report, name="Riders"
+        )
+        field = ScanReportField.objects.create(
+            scan_report_table=table,
+            name="Horse",
+            description_column="",
+            type_column="",
+            max_length=32,
+            nrows=0,
+            nrows_checked=0,
+            fraction_empty=0.0,
+            nunique_values=0,
+            fraction_unique=0.0,
+        )
+        cls.field = field
+        ScanReportValue.objects.bulk_create(
+            ScanReportValue(scan_report_field=field, value=f"Mearas {i}", frequency=i)
+            for i in range(ROWS)
+        )
+        concept, _ = Concept.objects.get_or_create(
+            concept_id=8507,
+            defaults={
+                "concept_name": "MALE",
+                "domain_id": "Gender",
+                "vocabulary_id": "Gender",
+                "concept_class_id": "Gender",
+                "standard_concept": "S",
+                "concept_code": "M",
+                "valid_start_date": "1970-01-01",
+                "valid_end_date": "2099-12-31",
+            },
+        )
+        cls.content_type = ContentType.objects.get_for_model(ScanReportValue)
+        ScanReportConcept.objects.bulk_create(
+            ScanReportConcept(
+                concept=concept, content_type=cls.content_type, object_id=value_id
+            )
+            for value_id in ScanReportValue.objects.values_list("id", flat=True)
+        )
+        omop_field = OmopField.objects.create(
+            table=OmopTable.objects.create(table="person"),
+            field="gender_concept_id",
+        )
+        cls.omop_field = omop_field
+        MappingRule.objects.bulk_create(
+            MappingRule(
+                scan_report_id=scan_report_id,
+                omop_field=omop_field,
+                source_field=field,
+                concept=scan_report_concept,
+            )
+            for scan_report_id, scan_report_concept in zip(
+                ScanReport.objects.values_list("id", flat=True)
+                .order_by("?")
+                .iterator(),
+                ScanReportConcept.objects.all()[: ROWS // 10],
+            )
+        )
+        cls.concept = ScanReportConcept.objects.first()
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def assertNoTableScan(self, queryset):
+        plan = queryset.explain()
+        table = re.escape(queryset.model._meta.db_table)
+        if connection.vendor == "postgresql":
+            scan = rf"Seq Scan on {table}\b"
+        else:
+            scan = rf"\bSCAN (TABLE )?{table}\b(?! USING)"
+        self.assertNotRegex(plan, scan)
+
+    def test_scan_report_concepts(self):
+        self.assertNoTableScan(
+            ScanReportConcept.objects.filter(
+                content_type=self.content_type, object_id=self.concept.object_id
+            )
+        )
+        self.assertNoTableScan(
+            ScanReportConcept.objects.filter(
+                concept_id=8507,
+                content_type=self.content_type,
+                object_id__in=[self.concept.object_id],
+            )
+        )
+
+    def test_scan_report_values(self):
+        self.assertNoTableScan(
+            ScanReportValue.objects.filter(
+                scan_report_field=self.field, value="Mearas 7"
+            )
+        )
+
+    def test_mapping_rules(self):
+        self.assertNoTableScan(
+            MappingRule.objects.filter(
+                scan_report=self.scan_report, concept=self.concept
+            )
+        )
+        self.assertNoTableScan(
+            MappingRule.objects.filter(
+                scan_report=self.scan_report,
+                omop_field=self.omop_field,
+                source_field=self.field,
+                concept=self.concept,
+            )
+        )
+
+    def test_scan_reports(self):
+        self.assertNoTableScan(
+            ScanReport.objects.filter(status="COMPLET", hidden=False)
+        )
@@ -0,0 +1,184 @@
+import json
+from datetime import timedelta
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from rest_framework.test import APIClient
+from .models import (
+    DataPartner,
+    Dataset,
+    Job,
+    JobKind,
+    JobStatus,
+    Project,
+    ScanReport,
+    VisibilityChoices,
+)
+from .services_counters import bump_rules_version
+from .services_jobs import (
+    JOB_RUNNERS,
+    report_progress,
+    requeue_stale_jobs,
+    run_pending_jobs,
+    submit_job,
+)
+
+
+def fail(job, request):
+    raise RuntimeError("The Ring cannot be destroyed here")
+
+
+class TestJobs(TestCase):
+    def setUp(self):
+        data_partner = DataPartner.objects.create(name="Dwarves")
+        dataset = Dataset.objects.create(name="Erebor", data_partner=data_partner)
+        self.scan_report = ScanReport.objects.create(
+            dataset="The Arkenstone", parent_dataset=dataset
+        )
+
+    def test_run(self):
+        job = submit_job(JobKind.REFRESH_RULES, self.scan_report.id)
+        self.assertEqual(job.status, JobStatus.PENDING)
+        # Waiting jobs are shared
+        self.assertEqual(submit_job(JobKind.REFRESH_RULES, self.scan_report.id), job)
+
+        self.assertEqual(run_pending_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.progress), (JobStatus.COMPLETE, 100))
+        self.assertEqual(json.loads(job.result)["added"], 0)
+        # Refreshing is never reused
+        self.assertNotEqual(submit_job(JobKind.REFRESH_RULES, self.scan_report.id), job)
+
+    def test_cached_result(self):
+        job = submit_job(JobKind.ANALYSE_CONCEPTS, self.scan_report.id)
+        run_pending_jobs()
+        job.refresh_from_db()
+        self.assertEqual(json.loads(job.result), {"data": []})
+        self.assertEqual(submit_job(JobKind.ANALYSE_CONCEPTS, self.scan_report.id), job)
+
+        # Any change to the rules makes a new analysis
+        bump_rules_version(self.scan_report.id)
+        self.assertNotEqual(
+            submit_job(JobKind.ANALYSE_CONCEPTS, self.scan_report.id), job
+        )
+
+    def test_progress(self):
+        seen = []
+
+        def refresh(job, request):
+            progress = report_progress(job)
+            for percent in (40, 80):
+                progress(percent)
+                # As pollers see it
+                seen.append(Job.objects.get(pk=job.pk).progress)
+            return "{}"
+
+        with mock.patch.dict(
+            JOB_RUNNERS, {JobKind.REFRESH_RULES: (refresh, "application/json")}
+        ):
+            job = submit_job(JobKind.REFRESH_RULES, self.scan_report.id)
+            run_pending_jobs()
+        self.assertEqual(seen, [40, 80])
+        job.refresh_from_db()
+        self.assertEqual(job.progress, 100)
+
+    def test_failure(self):
+        with mock.patch.dict(
+            JOB_RUNNERS, {JobKind.ANALYSE_CONCEPTS: (fail, "application/json")}
+        ):
+            job = submit_job(JobKind.ANALYSE_CONCEPTS, self.scan_report.id)
+            run_pending_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, JobStatus.FAILED)
+        self.assertEqual(job.error, "The Ring cannot be destroyed here")
+        self.assertNotEqual(
+            submit_job(JobKind.ANALYSE_CONCEPTS, self.scan_report.id), job
+        )
+
+    def test_one_at_a_time(self):
+        running = submit_job(JobKind.REFRESH_RULES, self.scan_report.id)
+        Job.objects.filter(pk=running.pk).update(status=JobStatus.RUNNING)
+        queued = submit_job(JobKind.REFRESH_RULES, self.scan_report.id)
+        self.assertNotEqual(queued, running)
+        # Held back while the other refresh runs
+        self.assertEqual(run_pending_jobs(), 0)
+
+        # Until its worker is found to have died
+        self.assertEqual(requeue_stale_jobs(), 0)
+        Job.objects.filter(pk=running.pk).update(started_at=self.scan_report.created_at)
+        self.assertEqual(requeue_stale_jobs(timedelta(0)), 1)
+        self.assertEqual(run_pending_jobs(), 2)
+
+    def test_dead_worker(self):
+        # A job left running by a worker which was killed
+        stale = submit_job(JobKind.REFRESH_RULES, self.scan_report.id)
+        Job.objects.filter(pk=stale.pk).update(
+            status=JobStatus.RUNNING,
+            started_at=self.scan_report.created_at - timedelta(days=1),
+        )
+        with mock.patch(
+            "mapping.services_jobs.transaction.on_commit", lambda start: start()
+        ), mock.patch("mapping.services_jobs.start_job") as start_job:
+            job = submit_job(JobKind.REFRESH_RULES, self.scan_report.id)
+        # It is put back in the queue, and started again
+        self.assertEqual((job, job.status), (stale, JobStatus.PENDING))
+        start_job.assert_called_once_with(job.id)
+        self.assertEqual(run_pending_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, JobStatus.COMPLETE)
+
+
+class TestJobViewSet(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.gimli = User.objects.create(username="gimli", password="axe")
+        self.legolas = User.objects.create(username="legolas", password="bow")
+        data_partner = DataPartner.objects.create(name="Dwarves")
+        dataset = Dataset.objects.create(
+            name="Erebor",
+            visibility=VisibilityChoices.PUBLIC,
+            data_partner=data_partner,
+        )
+        project = Project.objects.create(name="The Fellowship of the Ring")
+        project.datasets.add(dataset)
+        project.members.add(self.gimli, self.legolas)
+        dataset.editors.add(self.gimli)
+        self.scan_report = ScanReport.objects.create(
+            dataset="The Arkenstone",
+            visibility=VisibilityChoices.PUBLIC,
+            parent_dataset=dataset,
+        )
+        self.client = APIClient()
+
+    def test_poll(self):
+        self.client.force_authenticate(self.gimli)
+        response = self.client.post(
+            "/api/jobs/",
+            {"kind": JobKind.REFRESH_RULES, "scan_report": self.scan_report.id},
+        )
+        self.assertEqual(response.status_code, 202)
+        job_id = response.data["id"]
+        self.assertEqual(
+            self.client.get(f"/api/jobs/{job_id}/result/").status_code, 409
+        )
+
+        run_pending_jobs()
+        response = self.client.get(f"/api/jobs/{job_id}/")
+        self.assertEqual(response.data["status"], JobStatus.COMPLETE)
+        response = self.client.get(f"/api/jobs/{job_id}/result/")
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(json.loads(response.content)["removed"], 0)
+
+    def test_permissions(self):
+        self.client.force_authenticate(self.legolas)
+        response = self.client.post(
+            "/api/jobs/",
+            {"kind": JobKind.REFRESH_RULES, "scan_report": self.scan_report.id},
+        )
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post(
+            "/api/jobs/",
+            {"kind": JobKind.ANALYSE_CONCEPTS, "scan_report": self.scan_report.id},
+        )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(self.client.get("/api/jobs/").data), 1)
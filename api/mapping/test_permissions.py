@@ -17,7 +17,16 @@ from .permissions import (
 from .views import (
     ProjectRetrieveView,
 )
-from .models import Project, Dataset, ScanReport, VisibilityChoices, DataPartner
+from .models import (
+    Project,
+    Dataset,
+    ScanReport,
+    ScanReportField,
+    ScanReportTable,
+    ScanReportValue,
+    VisibilityChoices,
+    DataPartner,
+)
 
 
 class TestHasViewership(TestCase):
@@ -362,6 +371,69 @@ class TestIsAdmin(TestCase):
         self.assertFalse(is_admin(self.restricted_scanreport, self.request))
 
 
+class TestPermissionResolver(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create(username="frodo", password="ringbearer")
+        self.project = Project.objects.create(name="The Fellowship of the Ring")
+        self.project.members.add(self.user)
+        self.data_partner = DataPartner.objects.create(name="Hobbits")
+        self.dataset = Dataset.objects.create(
+            name="The Shire",
+            visibility=VisibilityChoices.RESTRICTED,
+            data_partner=self.data_partner,
+        )
+        self.dataset.editors.add(self.user)
+        self.project.datasets.add(self.dataset)
+        self.scan_report = ScanReport.objects.create(
+            dataset="Bag End",
+            visibility=VisibilityChoices.PUBLIC,
+            parent_dataset=self.dataset,
+        )
+        self.table = ScanReportTable.objects.create(
+            scan_report=self.scan_report, name="Residents"
+        )
+        self.field = ScanReportField.objects.create(
+            scan_report_table=self.table,
+            name="Name",
+            description_column="",
+            type_column="",
+            max_length=0,
+            nrows=0,
+            nrows_checked=0,
+            fraction_empty=0,
+            nunique_values=0,
+            fraction_unique=0,
+        )
+        self.values = [
+            ScanReportValue.objects.create(
+                scan_report_field=self.field, value=name, frequency=1
+            )
+            for name in ["Bilbo", "Frodo", "Lobelia"]
+        ]
+        self.request = APIRequestFactory().get("/there/and/back/again")
+        self.request.user = self.user
+
+    def test_checks_are_memoised(self):
+        # Values and fields know their scan report, so one query for the
+        # user's roles on it
+        with self.assertNumQueries(1):
+            for value in self.values:
+                self.assertTrue(has_viewership(value, self.request))
+                self.assertTrue(has_editorship(value, self.request))
+                self.assertFalse(is_admin(value, self.request))
+            self.assertTrue(has_editorship(self.field, self.request))
+            self.assertTrue(has_editorship(self.table, self.request))
+            self.assertTrue(has_editorship(self.scan_report, self.request))
+
+    def test_resolver_follows_request_user(self):
+        self.assertTrue(has_viewership(self.scan_report, self.request))
+        self.request.user = get_user_model().objects.create(
+            username="gollum", password="precious"
+        )
+        self.assertFalse(has_viewership(self.scan_report, self.request))
+
+
 class TestCanViewProject(TestCase):
     def setUp(self):
         User = get_user_model()
@@ -0,0 +1,97 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from data.models import Concept, ConceptSynonym
+from .services_search import search_concepts, trigrams
+
+
+class TestConceptSearch(TestCase):
+    def setUp(self):
+        concepts = [
+            (1, "Elven cloak", "CLOAK", "Lorien", "Device", "S"),
+            (2, "Elven rope", "ROPE", "Lorien", "Device", "S"),
+            (3, "Lembas bread", "LEMBAS", "Lorien", "Observation", "S"),
+            (4, "Cloak of Elven make", "ELF", "Lorien", "Device", None),
+            (5, "Mithril coat", "MITHRIL", "Erebor", "Device", "S"),
+        ]
+        Concept.objects.bulk_create(
+            Concept(
+                concept_id=concept_id,
+                concept_name=name,
+                concept_code=code,
+                vocabulary_id=vocabulary_id,
+                domain_id=domain_id,
+                concept_class_id="Gift",
+                standard_concept=standard,
+                valid_start_date="1970-01-01",
+                valid_end_date="2099-12-31",
+            )
+            for concept_id, name, code, vocabulary_id, domain_id, standard in concepts
+        )
+        ConceptSynonym.objects.create(
+            concept_id=3, concept_synonym_name="Waybread", language_concept_id=0
+        )
+
+    def search(self, query, **filters):
+        return [concept.concept_id for concept, _ in search_concepts(query, filters)]
+
+    def test_trigrams(self):
+        self.assertEqual(
+            trigrams("Elf"),
+            {"  e", " el", "elf", "lf "},
+        )
+
+    def test_search(self):
+        # Names starting with the query come first, the closest first
+        self.assertEqual(self.search("elven"), [2, 1, 4])
+        self.assertEqual(self.search("elven cloak"), [1, 4, 2])
+        # Codes, synonyms and misspellings
+        self.assertEqual(self.search("mithril")[0], 5)
+        self.assertEqual(self.search("elf"), [4])
+        self.assertEqual(self.search("waybread"), [3])
+        self.assertEqual(self.search("lembass"), [3])
+        self.assertEqual(self.search("Balrog"), [])
+        self.assertEqual(self.search(" "), [])
+
+    def test_filters(self):
+        self.assertEqual(self.search("elven", standard_concept="S"), [2, 1])
+        # An exact code outranks a name
+        self.assertEqual(self.search("cloak", domain_id="Device"), [1, 4])
+        self.assertEqual(self.search("coat", vocabulary_id="Lorien"), [])
+
+    def test_rebuilt_on_new_concepts(self):
+        self.assertEqual(self.search("sting"), [])
+        Concept.objects.create(
+            concept_id=6,
+            concept_name="Sting",
+            concept_code="STING",
+            vocabulary_id="Gondolin",
+            domain_id="Device",
+            concept_class_id="Gift",
+            valid_start_date="1970-01-01",
+            valid_end_date="2099-12-31",
+        )
+        self.assertEqual(self.search("sting"), [6])
+
+    def test_rebuilt_on_new_vocabulary(self):
+        with override_settings(VOCABULARY_VERSION="v1"):
+            self.assertEqual(self.search("sting"), [])
+        # A rename alone, loaded with a new vocabulary
+        Concept.objects.filter(concept_id=2).update(concept_name="Sting")
+        with override_settings(VOCABULARY_VERSION="v2"):
+            self.assertEqual(self.search("sting"), [2])
+
+    def test_view(self):
+        client = APIClient()
+        client.force_authenticate(
+            get_user_model().objects.create(username="galadriel", password="nenya")
+        )
+        response = client.get("/api/omop/conceptsearch/?q=elven&limit=2")
+        self.assertEqual(
+            [(row["concept_id"], row["rank"] > 1) for row in response.data],
+            [(2, True), (1, True)],
+        )
+        response = client.get("/api/omop/conceptsearch/?q=elven&limit=many")
+        self.assertEqual(response.status_code, 400)
+        response = client.get("/api/omop/conceptsearch/?q=elven&limit=-5")
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,260 @@
+import json
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+from data.models import Concept, ConceptRelationship
+from .models import (
+    DataPartner,
+    Dataset,
+    NLPCacheEntry,
+    ScanReport,
+    ScanReportConcept,
+    ScanReportTable,
+    ScanReportValue,
+)
+from .services_nlp import (
+    NLP_MAX_DOCUMENTS_PER_REQUEST,
+    NLP_MAX_MESSAGE_BYTES,
+    batch_nlp_documents,
+    concept_code_to_id,
+    get_nlp_cache_key,
+    lookup_nlp_cache,
+    save_cached_nlp_concepts,
+    store_nlp_cache,
+)
+from .test_counters import make_field
+from .views import NLPCacheLookupView, NLPCacheStoreView
+
+
+def make_documents(n, text="Sex, Male"):
+    return [
+        {"language": "en", "id": f"{i}_value", "text": text} for i in range(1, n + 1)
+    ]
+
+
+class TestBatchNLPDocuments(TestCase):
+    def test_no_documents(self):
+        self.assertEqual(batch_nlp_documents([]), [])
+
+    def test_document_limit(self):
+        documents = make_documents(5000)
+        batches = batch_nlp_documents(documents)
+        # 5000 documents fit into 200 requests rather than 5000
+        self.assertEqual(len(batches), 5000 // NLP_MAX_DOCUMENTS_PER_REQUEST)
+        self.assertTrue(
+            all(len(batch) <= NLP_MAX_DOCUMENTS_PER_REQUEST for batch in batches)
+        )
+        # All documents are sent, in order, exactly once
+        self.assertEqual([doc for batch in batches for doc in batch], documents)
+
+    def test_char_limit(self):
+        documents = make_documents(10, text="a" * 100)
+        batches = batch_nlp_documents(documents, max_chars=250)
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 2, 2, 2])
+
+    def test_message_size_limit(self):
+        documents = make_documents(25, text="a" * 5000)
+        batches = batch_nlp_documents(documents)
+        self.assertGreater(len(batches), 1)
+        for batch in batches:
+            payload = json.dumps({"documents": batch})
+            self.assertLessEqual(len(payload), NLP_MAX_MESSAGE_BYTES)
+
+
+class TestNLPCache(TestCase):
+    def setUp(self):
+        self.codes = [["diabetes", "Diagnosis", 0.98, "SNOMEDCT_US", "44054006"]]
+        store_nlp_cache([{"text": "Type 2  Diabetes", "codes": self.codes}])
+
+    def test_key_normalisation(self):
+        self.assertEqual(
+            get_nlp_cache_key("Type 2  Diabetes "), get_nlp_cache_key("type 2 diabetes")
+        )
+        self.assertNotEqual(
+            get_nlp_cache_key("type 2 diabetes", model_version="a"),
+            get_nlp_cache_key("type 2 diabetes", model_version="b"),
+        )
+
+    def test_lookup(self):
+        hits = lookup_nlp_cache(
+            [
+                {"id": "1_value", "text": "type 2 diabetes"},
+                {"id": "2_value", "text": "Smoker: yes"},
+            ]
+        )
+        self.assertEqual(hits, {"1_value": self.codes})
+        entry = NLPCacheEntry.objects.get()
+        self.assertEqual(entry.hits, 1)
+        self.assertIsNotNone(entry.last_hit_at)
+
+    def test_other_model_version_misses(self):
+        with override_settings(NLP_MODEL_VERSION="other"):
+            hits = lookup_nlp_cache([{"id": "1_value", "text": "type 2 diabetes"}])
+        self.assertEqual(hits, {})
+
+    def test_expiry(self):
+        NLPCacheEntry.objects.update(updated_at=timezone.now() - timedelta(days=365))
+        with override_settings(NLP_CACHE_TTL_DAYS=30):
+            hits = lookup_nlp_cache([{"id": "1_value", "text": "type 2 diabetes"}])
+        self.assertEqual(hits, {})
+
+        # Storing the text again refreshes the entry
+        store_nlp_cache([{"text": "type 2 diabetes", "codes": []}])
+        with override_settings(NLP_CACHE_TTL_DAYS=30):
+            hits = lookup_nlp_cache([{"id": "1_value", "text": "type 2 diabetes"}])
+        self.assertEqual(hits, {"1_value": []})
+        self.assertEqual(NLPCacheEntry.objects.get().misses, 2)
+
+    def test_prune(self):
+        store_nlp_cache([{"text": "Male", "codes": []}])
+        lookup_nlp_cache([{"id": "1_value", "text": "Male"}])
+        NLPCacheEntry.objects.filter(key=get_nlp_cache_key("Male")).update(
+            updated_at=timezone.now() - timedelta(days=365)
+        )
+        store_nlp_cache([{"text": "Female", "codes": []}])
+        lookup_nlp_cache([{"id": "1_value", "text": "Female"}])
+
+        call_command("nlp_cache", prune=True, max_entries=1)
+        # The expired entry is evicted, then the least recently hit
+        self.assertEqual(
+            list(NLPCacheEntry.objects.values_list("key", flat=True)),
+            [get_nlp_cache_key("Female")],
+        )
+
+    def test_views(self):
+        User = get_user_model()
+        user = User.objects.create(username="gandalf", password="fjjsdjsfjsdf")
+        factory = APIRequestFactory()
+
+        request = factory.post(
+            "/api/nlpcache/lookup/",
+            {"documents": [{"id": "1_field", "text": "Type 2 diabetes"}]},
+            format="json",
+        )
+        force_authenticate(request, user=user)
+        response = NLPCacheLookupView.as_view()(request)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(NLPCacheEntry.objects.get().hits, 0)
+
+        documents = {"documents": [{"text": "Male", "codes": []}]}
+        request = factory.post("/api/nlpcache/", documents, format="json")
+        force_authenticate(request, user=user)
+        response = NLPCacheStoreView.as_view()(request)
+        self.assertEqual(response.status_code, 403)
+
+        user.is_staff = True
+        user.save()
+        request = factory.post(
+            "/api/nlpcache/lookup/",
+            {"documents": [{"id": "1_field", "text": "Type 2 diabetes"}]},
+            format="json",
+        )
+        force_authenticate(request, user=user)
+        response = NLPCacheLookupView.as_view()(request)
+        self.assertEqual(response.data, {"hits": {"1_field": self.codes}})
+
+        request = factory.post("/api/nlpcache/", documents, format="json")
+        force_authenticate(request, user=user)
+        response = NLPCacheStoreView.as_view()(request)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(NLPCacheEntry.objects.count(), 2)
+
+
+class TestSaveCachedNLPConcepts(TestCase):
+    def setUp(self):
+        data_partner = DataPartner.objects.create(name="Men")
+        dataset = Dataset.objects.create(name="Gondor", data_partner=data_partner)
+        scan_report = ScanReport.objects.create(
+            dataset="Houses of Healing", parent_dataset=dataset
+        )
+        table = ScanReportTable.objects.create(scan_report=scan_report, name="Ward")
+        self.field = make_field(table, "Illness")
+        self.values = [
+            ScanReportValue.objects.create(
+                scan_report_field=self.field, value=value, frequency=1
+            )
+            for value in ("Black Breath", "Sugar sickness")
+        ]
+        # Type 2 diabetes mellitus, from the OMOP vocabulary
+        self.concept, _ = Concept.objects.get_or_create(
+            concept_id=201826,
+            defaults={
+                "concept_name": "Type 2 diabetes mellitus",
+                "domain_id": "Condition",
+                "vocabulary_id": "SNOMED",
+                "concept_class_id": "Clinical Finding",
+                "standard_concept": "S",
+                "concept_code": "44054006",
+                "valid_start_date": "1970-01-01",
+                "valid_end_date": "2099-12-31",
+            },
+        )
+        self.codes = [["diabetes", "Diagnosis", 0.98, "SNOMEDCT_US", "44054006"]]
+
+    def test_duplicates(self):
+        ScanReportConcept.objects.create(
+            concept=self.concept, content_object=self.values[0]
+        )
+        hits = {
+            f"{self.values[0].id}_value": self.codes,
+            f"{self.values[1].id}_value": self.codes + self.codes,
+            f"{self.field.id}_field": self.codes,
+        }
+        save_cached_nlp_concepts(hits)
+        self.assertEqual(
+            sorted(
+                ScanReportConcept.objects.values_list(
+                    "object_id", "content_type__model"
+                )
+            ),
+            sorted(
+                [
+                    (self.values[0].id, "scanreportvalue"),
+                    (self.values[1].id, "scanreportvalue"),
+                    (self.field.id, "scanreportfield"),
+                ]
+            ),
+        )
+
+    def test_concept_codes(self):
+        # Type 2 diabetes mellitus, from ICD10CM, which maps to SNOMED
+        Concept.objects.get_or_create(
+            concept_id=45552385,
+            defaults={
+                "concept_name": "Type 2 diabetes mellitus",
+                "domain_id": "Condition",
+                "vocabulary_id": "ICD10CM",
+                "concept_class_id": "3-char nonbill code",
+                "concept_code": "E11",
+                "valid_start_date": "1970-01-01",
+                "valid_end_date": "2099-12-31",
+            },
+        )
+        ConceptRelationship.objects.get_or_create(
+            concept_id_1=45552385,
+            defaults={
+                "concept_id_2": self.concept.concept_id,
+                "relationship_id": "Maps to",
+                "valid_start_date": "1970-01-01",
+                "valid_end_date": "2099-12-31",
+            },
+        )
+        codes = [
+            [f"{self.field.id}_field"] + code
+            for code in [
+                self.codes[0],
+                ["diabetes", "Diagnosis", 0.9, "ICD10CM", "E11"],
+                ["dragon sickness", "Diagnosis", 0.5, "SNOMEDCT_US", "0"],
+            ]
+        ]
+        # The source concepts, then the standard concepts, however many codes
+        with self.assertNumQueries(2):
+            found = concept_code_to_id(codes * 10)
+        self.assertEqual(len(found), 20)
+        self.assertEqual(
+            {(item["nlp_vocab"], item["conceptid"]) for item in found},
+            {("SNOMEDCT_US", 201826), ("ICD10CM", 201826)},
+        )
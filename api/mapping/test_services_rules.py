@@ -1,9 +1,33 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+from unittest import mock
+from django.test import TestCase, override_settings
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
-from data.models import Concept
-from .services_rules import analyse_concepts
+from data.models import Concept, ConceptAncestor
+from .services_rules import (
+    analyse_concepts,
+    download_mapping_rules,
+    MappingRulesDiagramTooLarge,
+    get_mapping_rules_artifact,
+    get_mapping_rules_graph,
+    get_mapping_rules_json,
+    get_mapping_rules_list,
+    get_mapping_rules_page,
+    get_mapping_rules_svg,
+    iter_mapping_rules_csv,
+    iter_mapping_rules_json,
+    make_digraph,
+    refresh_mapping_rules,
+    save_mapping_rules_bulk,
+)
+from .services_counters import reconcile_counters
+from .services_jobs import run_pending_jobs
+from .services_hierarchy import build_concept_hierarchy
 from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from .views import DownloadJSON
 from .models import (
     DataPartner,
     MappingRule,
@@ -280,3 +304,634 @@ class TestMisalignedMappings(TestCase):
         self.assertEqual(
             test_data["anc_desc"][0]["ancestors"][0]["a_id"], expected_ancestor
         )
+
+
+class TestMappingRulesList(TestCase):
+    def setUp(self):
+        data_partner = DataPartner.objects.create(name="Hobbits")
+        dataset = Dataset.objects.create(name="The Shire", data_partner=data_partner)
+        self.scan_report = ScanReport.objects.create(
+            dataset="Hobbiton", parent_dataset=dataset
+        )
+        self.table = ScanReportTable.objects.create(
+            scan_report=self.scan_report, name="Bag End"
+        )
+        self.field = ScanReportField.objects.create(
+            scan_report_table=self.table,
+            name="Sex",
+            description_column="",
+            type_column="VARCHAR",
+            max_length=1,
+            nrows=0,
+            nrows_checked=0,
+            fraction_empty=0.0,
+            nunique_values=0,
+            fraction_unique=0.0,
+        )
+        self.value = ScanReportValue.objects.create(
+            scan_report_field=self.field, value="M", frequency=1
+        )
+        omop_table = OmopTable.objects.create(table="person")
+        self.concept_field = OmopField.objects.create(
+            table=omop_table, field="gender_concept_id"
+        )
+        self.source_field = OmopField.objects.create(
+            table=omop_table, field="gender_source_value"
+        )
+        # MALE, from the OMOP vocabulary
+        concept, _ = Concept.objects.get_or_create(
+            concept_id=8507,
+            defaults={
+                "concept_name": "MALE",
+                "domain_id": "Gender",
+                "vocabulary_id": "Gender",
+                "concept_class_id": "Gender",
+                "standard_concept": "S",
+                "concept_code": "M",
+                "valid_start_date": "1970-01-01",
+                "valid_end_date": "2099-12-31",
+            },
+        )
+        self.value_concept = ScanReportConcept.objects.create(
+            concept=concept, content_object=self.value, creation_type="M"
+        )
+        self.field_concept = ScanReportConcept.objects.create(
+            concept=concept, content_object=self.field, creation_type="V"
+        )
+        for sr_concept in (self.value_concept, self.field_concept):
+            for omop_field in (self.concept_field, self.source_field):
+                MappingRule.objects.create(
+                    scan_report=self.scan_report,
+                    omop_field=omop_field,
+                    source_field=self.field,
+                    concept=sr_concept,
+                )
+        self.rules = MappingRule.objects.filter(scan_report=self.scan_report)
+
+    def test_rules_list(self):
+        ContentType.objects.get_for_model(ScanReportValue)
+        with self.assertNumQueries(1):
+            rules = get_mapping_rules_list(self.rules.order_by("id"))
+        self.assertEqual(
+            [(rule["rule_id"], rule["term_mapping"]) for rule in rules],
+            [
+                (self.value_concept.id, {"M": 8507}),
+                (self.value_concept.id, None),
+                (self.field_concept.id, 8507),
+                (self.field_concept.id, None),
+            ],
+        )
+        self.assertEqual(rules[0]["rule_name"], "MALE")
+        self.assertEqual(rules[0]["destination_table"].table, "person")
+        self.assertEqual(rules[0]["destination_field"], self.concept_field)
+        self.assertEqual(rules[0]["source_table"], self.table)
+        self.assertEqual(rules[0]["source_field"], self.field)
+        self.assertEqual(rules[2]["creation_type"], "V")
+
+        cdm = get_mapping_rules_json(self.rules.order_by("id"))["cdm"]
+        self.assertEqual(
+            cdm["person"][f"MALE {self.value_concept.id}"]["gender_concept_id"],
+            {
+                "source_table": "Bag End",
+                "source_field": "Sex",
+                "term_mapping": {"M": 8507},
+            },
+        )
+
+    def test_keyset_pages(self):
+        expected = get_mapping_rules_list(self.rules.order_by("id"))
+        pages, after_id = [], None
+        while True:
+            rules, after_id = get_mapping_rules_page(self.rules, 3, after_id=after_id)
+            pages.append(rules)
+            if after_id is None:
+                break
+        self.assertEqual([len(page) for page in pages], [3, 1])
+        self.assertEqual(pages[0] + pages[1], expected)
+        self.assertEqual(
+            get_mapping_rules_list(
+                self.rules.order_by("id"), page_number=2, page_size=3
+            ),
+            pages[1],
+        )
+
+    def test_rules_artifact(self):
+        artifact = get_mapping_rules_artifact(self.scan_report)
+        # Unchanged rules are served from the artifact
+        with self.assertNumQueries(1):
+            self.assertEqual(get_mapping_rules_artifact(self.scan_report), artifact)
+
+        self.field.name = "Gender"
+        self.field.save()
+        changed = get_mapping_rules_artifact(self.scan_report)
+        self.assertNotEqual(changed.etag, artifact.etag)
+        self.assertIn('"source_field": "Gender"', changed.content)
+
+        MappingRule.objects.filter(omop_field=self.source_field).delete()
+        self.assertNotEqual(
+            get_mapping_rules_artifact(self.scan_report).etag, changed.etag
+        )
+
+    def test_download_etag(self):
+        User = get_user_model()
+        user = User.objects.create(username="frodo", password="baggins")
+        factory = APIRequestFactory()
+
+        request = factory.get(f"/api/json/?id={self.scan_report.id}")
+        force_authenticate(request, user=user)
+        response = DownloadJSON.as_view({"get": "list"})(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            json.loads(response.content)[0]["metadata"]["dataset"], "Hobbiton"
+        )
+        etag = response["ETag"]
+
+        request = factory.get(
+            f"/api/json/?id={self.scan_report.id}", HTTP_IF_NONE_MATCH=etag
+        )
+        force_authenticate(request, user=user)
+        response = DownloadJSON.as_view({"get": "list"})(request)
+        self.assertEqual(response.status_code, 304)
+
+    def test_download(self):
+        factory = APIRequestFactory()
+        first = download_mapping_rules(factory.post("/"), self.scan_report)
+        second = download_mapping_rules(factory.post("/"), self.scan_report)
+        artifact = get_mapping_rules_artifact(self.scan_report)
+        # The same bytes under the same ETag, however long apart
+        self.assertEqual(first["ETag"], artifact.etag)
+        self.assertEqual(second["ETag"], artifact.etag)
+        content = b"".join(first.streaming_content)
+        self.assertEqual(content, b"".join(second.streaming_content))
+        self.assertEqual(content.decode(), artifact.content)
+        self.assertEqual(json.loads(content)["metadata"]["dataset"], "Hobbiton")
+
+        response = download_mapping_rules(
+            factory.post("/", HTTP_IF_NONE_MATCH=artifact.etag), self.scan_report
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_streamed_json(self):
+        observation = OmopTable.objects.create(table="observation")
+        MappingRule.objects.create(
+            scan_report=self.scan_report,
+            omop_field=OmopField.objects.create(
+                table=observation, field="observation_concept_id"
+            ),
+            source_field=self.field,
+            concept=self.value_concept,
+        )
+        expected = get_mapping_rules_json(self.rules)
+        self.assertEqual(len(expected["cdm"]), 2)
+        for indent in (None, 6):
+            streamed = "".join(
+                iter_mapping_rules_json(self.rules, "Hobbiton", indent=indent)
+            )
+            document = json.loads(streamed)
+            # Laid out as json.dumps would lay it out
+            self.assertEqual(streamed, json.dumps(document, indent=indent))
+            self.assertEqual(document["cdm"], expected["cdm"])
+            self.assertEqual(document["metadata"]["dataset"], "Hobbiton")
+
+        empty = "".join(iter_mapping_rules_json(self.rules.none(), "Hobbiton"))
+        self.assertEqual(json.loads(empty), {"metadata": {}, "cdm": {}})
+
+    def test_graph(self):
+        graph = get_mapping_rules_graph(self.scan_report)
+        nodes = {node["id"]: (node["kind"], node["label"]) for node in graph["nodes"]}
+        self.assertEqual(
+            sorted(nodes.values()),
+            [
+                ("destination_field", "gender_concept_id"),
+                ("destination_field", "gender_source_value"),
+                ("destination_table", "person"),
+                ("source_field", "Sex"),
+                ("source_table", "Bag End"),
+            ],
+        )
+        self.assertEqual(
+            sorted(
+                (
+                    nodes[edge["source"]][1],
+                    nodes[edge["target"]][1],
+                    edge["term_mapping"],
+                )
+                for edge in graph["edges"]
+            ),
+            [
+                ("Bag End", "Sex", False),
+                ("Sex", "gender_concept_id", True),
+                ("Sex", "gender_source_value", False),
+                ("gender_concept_id", "person", False),
+                ("gender_source_value", "person", False),
+            ],
+        )
+        self.assertEqual(
+            get_mapping_rules_graph(self.scan_report, "observation"),
+            {"nodes": [], "edges": []},
+        )
+        source = make_digraph(graph).source
+        self.assertIn('label="Bag End"', source)
+        self.assertIn("color=red", source)
+
+    def test_cached_svg(self):
+        artifact = get_mapping_rules_artifact(self.scan_report)
+        artifact.svg = "<svg>Bag End</svg>"
+        artifact.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                get_mapping_rules_svg(self.scan_report), "<svg>Bag End</svg>"
+            )
+
+        # Changed rules are drawn again
+        self.field.name = "Gender"
+        self.field.save()
+        self.assertEqual(get_mapping_rules_artifact(self.scan_report).svg, "")
+        with override_settings(MAPPING_RULES_SVG_MAX_NODES=4):
+            with self.assertRaises(MappingRulesDiagramTooLarge) as raised:
+                get_mapping_rules_svg(self.scan_report)
+        self.assertEqual(raised.exception.destination_tables, ["person"])
+
+    def test_cached_table_svg(self):
+        with mock.patch(
+            "graphviz.Digraph.pipe", return_value=b"<svg>person</svg>"
+        ) as pipe:
+            for _ in range(2):
+                self.assertEqual(
+                    get_mapping_rules_svg(self.scan_report, "person"),
+                    "<svg>person</svg>",
+                )
+            # Drawn once, and not stored as the whole diagram
+            self.assertEqual(pipe.call_count, 1)
+            self.assertEqual(get_mapping_rules_artifact(self.scan_report).svg, "")
+
+            # Changed rules are drawn again
+            self.field.name = "Gender"
+            self.field.save()
+            get_mapping_rules_svg(self.scan_report, "person")
+            self.assertEqual(pipe.call_count, 2)
+
+    def test_graph_views(self):
+        user = get_user_model().objects.create(username="sam", password="gamgee")
+        client = APIClient()
+        client.force_authenticate(user)
+        url = f"/api/mappingrulesgraph/{self.scan_report.id}/"
+        self.assertEqual(client.get(url).status_code, 403)
+
+        project = Project.objects.create(name="The Fellowship of the Ring")
+        project.datasets.add(self.scan_report.parent_dataset)
+        project.members.add(user)
+        response = client.get(url, {"destination_table": "person"})
+        self.assertEqual(len(response.data["nodes"]), 5)
+
+        # The diagram is drawn as a job
+        url = f"/api/mappingrulessvg/{self.scan_report.id}/"
+        response = client.get(url)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data["kind"], "RULES_SVG")
+        with override_settings(MAPPING_RULES_SVG_MAX_NODES=4):
+            run_pending_jobs()
+        response = client.get(f"/api/jobs/{response.data['id']}/")
+        self.assertEqual(response.data["status"], "FAILED")
+        self.assertEqual(
+            response.data["error_details"], {"destination_tables": ["person"]}
+        )
+
+        # Which the client can then offer to draw one at a time
+        response = client.get(url, {"destination_table": "person"})
+        self.assertEqual(response.data["destination_table"], "person")
+        with override_settings(MAPPING_RULES_SVG_MAX_NODES=5), mock.patch(
+            "graphviz.Digraph.pipe", return_value=b"<svg>person</svg>"
+        ):
+            run_pending_jobs()
+        response = client.get(f"/api/jobs/{response.data['id']}/result/")
+        self.assertEqual(response.content, b"<svg>person</svg>")
+
+    def test_streamed_csv(self):
+        lines = list(iter_mapping_rules_csv(self.rules.order_by("id")))
+        self.assertEqual(
+            lines[0],
+            "rule_id,rule_name,destination_table,destination_field,source_table,"
+            "source_field,creation_type,source_value,concept,isFieldMapping\n",
+        )
+        self.assertEqual(
+            lines[1],
+            f"{self.value_concept.id},MALE,person,gender_concept_id,Bag End,Sex,M,M,8507,0\n",
+        )
+        self.assertEqual(len(lines), 5)
+
+
+class TestSaveMappingRulesBulk(TestCase):
+    def setUp(self):
+        data_partner = DataPartner.objects.create(name="Ents")
+        dataset = Dataset.objects.create(name="Fangorn", data_partner=data_partner)
+        self.scan_report = ScanReport.objects.create(
+            dataset="Wellinghall", parent_dataset=dataset
+        )
+        self.table = ScanReportTable.objects.create(
+            scan_report=self.scan_report, name="Entmoot"
+        )
+        self.fields = {
+            name: ScanReportField.objects.create(
+                scan_report_table=self.table,
+                name=name,
+                description_column="",
+                type_column="VARCHAR",
+                max_length=1,
+                nrows=0,
+                nrows_checked=0,
+                fraction_empty=0.0,
+                nunique_values=0,
+                fraction_unique=0.0,
+            )
+            for name in ("ID", "Date", "Sex")
+        }
+        self.table.person_id = self.fields["ID"]
+        self.table.date_event = self.fields["Date"]
+        self.table.save()
+        person = OmopTable.objects.create(table="person")
+        for field in (
+            "person_id",
+            "birth_datetime",
+            "gender_concept_id",
+            "gender_source_concept_id",
+            "gender_source_value",
+        ):
+            OmopField.objects.create(table=person, field=field)
+        # MALE, from the OMOP vocabulary
+        concept, _ = Concept.objects.get_or_create(
+            concept_id=8507,
+            defaults={
+                "concept_name": "MALE",
+                "domain_id": "Gender",
+                "vocabulary_id": "Gender",
+                "concept_class_id": "Gender",
+                "standard_concept": "S",
+                "concept_code": "M",
+                "valid_start_date": "1970-01-01",
+                "valid_end_date": "2099-12-31",
+            },
+        )
+        self.concepts = [
+            ScanReportConcept.objects.create(
+                concept=concept,
+                content_object=ScanReportValue.objects.create(
+                    scan_report_field=self.fields["Sex"], value=value, frequency=1
+                ),
+            )
+            for value in ("M", "Male")
+        ]
+        self.concepts.append(
+            ScanReportConcept.objects.create(
+                concept=concept, content_object=self.fields["Sex"]
+            )
+        )
+
+    def saved_rules(self):
+        return set(
+            MappingRule.objects.values_list(
+                "scan_report_id",
+                "omop_field__field",
+                "source_field__name",
+                "concept_id",
+                "approved",
+            )
+        )
+
+    def test_rules(self):
+        # The person id and date event, and the gender fields, of each concept
+        expected = {
+            (self.scan_report.id, destination_field, source_field, concept.id, True)
+            for concept in self.concepts
+            for destination_field, source_field in (
+                ("person_id", "ID"),
+                ("birth_datetime", "Date"),
+                ("gender_source_concept_id", "Sex"),
+                ("gender_concept_id", "Sex"),
+                ("gender_source_value", "Sex"),
+            )
+        }
+        self.assertEqual(len(expected), 15)
+
+        # The OMOP fields, the source fields and the existing rules are each
+        # loaded once, however many concepts there are
+        with self.assertNumQueries(8):
+            self.assertEqual(save_mapping_rules_bulk(None, self.concepts), (3, 0))
+        self.assertEqual(self.saved_rules(), expected)
+        self.assertEqual(reconcile_counters(), [])
+
+        # Existing rules aren't repeated
+        self.assertEqual(save_mapping_rules_bulk(None, self.concepts), (3, 0))
+        self.assertEqual(MappingRule.objects.count(), 15)
+
+    def test_failures(self):
+        self.table.date_event = None
+        self.table.save()
+        self.assertEqual(save_mapping_rules_bulk(None, self.concepts), (0, 3))
+        self.assertFalse(MappingRule.objects.exists())
+
+    def test_refresh(self):
+        summary = refresh_mapping_rules(None, self.scan_report.id)
+        self.assertEqual(
+            summary,
+            {
+                "concepts": 3,
+                "bad_concepts": 0,
+                "added": 15,
+                "removed": 0,
+                "unchanged": 0,
+            },
+        )
+        MappingRule.objects.filter(id=MappingRule.objects.first().id).update(
+            approved=False
+        )
+        ids = set(MappingRule.objects.values_list("id", "approved"))
+
+        # An unchanged report is only read
+        with self.assertNumQueries(6):
+            summary = refresh_mapping_rules(None, self.scan_report.id)
+        self.assertEqual((summary["added"], summary["unchanged"]), (0, 15))
+        self.assertEqual(set(MappingRule.objects.values_list("id", "approved")), ids)
+
+        # Only the differences are written
+        stray = MappingRule.objects.first()
+        MappingRule.objects.create(
+            scan_report=self.scan_report,
+            omop_field=stray.omop_field,
+            source_field=self.fields["Date"],
+            concept=stray.concept,
+        )
+        MappingRule.objects.filter(id=stray.id).delete()
+        summary = refresh_mapping_rules(None, self.scan_report.id)
+        self.assertEqual((summary["added"], summary["removed"]), (1, 1))
+        self.assertEqual(len(self.saved_rules()), 15)
+        self.assertEqual(reconcile_counters(), [])
+
+    def test_refresh_progress(self):
+        progress = []
+        with mock.patch("mapping.services_rules.REFRESH_BATCH_SIZE", 2):
+            summary = refresh_mapping_rules(
+                None, self.scan_report.id, progress=progress.append
+            )
+        self.assertEqual(summary["added"], 15)
+        # After each batch of concepts, leaving the last tenth for saving
+        self.assertEqual(progress, [60, 90])
+
+
+class TestAnalyseConcepts(TestCase):
+    def setUp(self):
+        data_partner = DataPartner.objects.create(name="Rohirrim")
+        dataset = Dataset.objects.create(name="Rohan", data_partner=data_partner)
+        self.edoras, self.helms_deep = (
+            ScanReport.objects.create(dataset=name, parent_dataset=dataset)
+            for name in ("Edoras", "Helm's Deep")
+        )
+        condition = OmopTable.objects.create(table="condition_occurrence")
+        self.concept_field = OmopField.objects.create(
+            table=condition, field="condition_concept_id"
+        )
+        self.source_field = OmopField.objects.create(
+            table=condition, field="condition_source_concept_id"
+        )
+        # Cough, Productive cough and Productive cough -clear sputum, in turn
+        # descended from each other
+        self.cough, self.productive, self.sputum = (
+            Concept.objects.get_or_create(
+                concept_id=concept_id,
+                defaults={
+                    "concept_name": name,
+                    "domain_id": "Condition",
+                    "vocabulary_id": "SNOMED",
+                    "concept_class_id": "Clinical Finding",
+                    "standard_concept": "S",
+                    "concept_code": str(concept_id),
+                    "valid_start_date": "1970-01-01",
+                    "valid_end_date": "2099-12-31",
+                },
+            )[0]
+            for concept_id, name in (
+                (254761, "Cough"),
+                (4102774, "Productive cough"),
+                (4060224, "Productive cough -clear sputum"),
+            )
+        )
+        for ancestor, descendant in (
+            (self.cough, self.productive),
+            (self.productive, self.sputum),
+        ):
+            ConceptAncestor.objects.get_or_create(
+                ancestor_concept_id=ancestor.concept_id,
+                descendant_concept_id=descendant.concept_id,
+                defaults={
+                    "min_levels_of_separation": 1,
+                    "max_levels_of_separation": 1,
+                },
+            )
+
+        self.add_rule(self.edoras, "Cough", self.productive)
+        self.fields = {
+            "Cough": self.add_rule(self.helms_deep, "Cough", self.cough),
+            "Sputum": self.add_rule(self.helms_deep, "Sputum", self.sputum),
+        }
+        # Left out of the sources, as it duplicates the rule above
+        self.add_rule(
+            self.helms_deep, "Sputum", self.sputum, omop_field=self.source_field
+        )
+
+    def add_rule(self, scan_report, name, concept, omop_field=None):
+        table, _ = ScanReportTable.objects.get_or_create(
+            scan_report=scan_report, name="Meduseld"
+        )
+        field, _ = ScanReportField.objects.get_or_create(
+            scan_report_table=table,
+            name=name,
+            defaults={
+                "description_column": "",
+                "type_column": "VARCHAR",
+                "max_length": 1,
+                "nrows": 0,
+                "nrows_checked": 0,
+                "fraction_empty": 0.0,
+                "nunique_values": 0,
+                "fraction_unique": 0.0,
+            },
+        )
+        MappingRule.objects.create(
+            scan_report=scan_report,
+            omop_field=omop_field or self.concept_field,
+            source_field=field,
+            concept=ScanReportConcept.objects.create(
+                concept=concept, content_object=field
+            ),
+        )
+        return field
+
+    def source(self, field):
+        return {
+            "source_field__id": field.id,
+            "source_field__name": field.name,
+            "source_field__scan_report_table__id": field.scan_report_table_id,
+            "source_field__scan_report_table__name": "Meduseld",
+            "source_field__scan_report_table__scan_report": self.helms_deep.id,
+            "concept__content_type": ContentType.objects.get_for_model(
+                ScanReportField
+            ).id,
+        }
+
+    def test_analysis(self):
+        progress = []
+        with self.assertNumQueries(4):
+            data = analyse_concepts(self.edoras.id, progress=progress.append)
+        self.assertEqual(progress, [25, 50, 75])
+        self.assertEqual(
+            data,
+            {
+                "data": [
+                    {
+                        "rule_id": self.productive.concept_id,
+                        "rule_name": self.productive.concept_name,
+                        "anc_desc": [
+                            {
+                                "descendants": [
+                                    {
+                                        "d_id": self.sputum.concept_id,
+                                        "d_name": self.sputum.concept_name,
+                                        "source": [self.source(self.fields["Sputum"])],
+                                        "level": ("1/", "1"),
+                                    }
+                                ],
+                                "ancestors": [
+                                    {
+                                        "a_id": self.cough.concept_id,
+                                        "a_name": self.cough.concept_name,
+                                        "source": [self.source(self.fields["Cough"])],
+                                        "level": ("1/", "1"),
+                                    }
+                                ],
+                            }
+                        ],
+                    }
+                ]
+            },
+        )
+
+    def test_nothing_related(self):
+        MappingRule.objects.filter(scan_report=self.helms_deep).delete()
+        with self.assertNumQueries(2):
+            self.assertEqual(analyse_concepts(self.edoras.id), {"data": []})
+
+
+class TestAnalyseConceptsIndexed(TestAnalyseConcepts):
+    """
+    The same analysis, with the hierarchy looked up in the index.
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "hierarchy.idx")
+        build_concept_hierarchy(path)
+        settings = override_settings(CONCEPT_HIERARCHY_PATH=path)
+        settings.enable()
+        self.addCleanup(settings.disable)
@@ -1,3 +1,4 @@
+import json
 import os
 from unittest import mock
 from django.test import TestCase
@@ -5,7 +6,14 @@ from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
 from rest_framework.test import APIRequestFactory, APIClient, force_authenticate
 from rest_framework.authtoken.models import Token
-from .views import DatasetListView, ScanReportListViewSet
+from .views import (
+    CountStats,
+    CountStatsScanReport,
+    CountStatsScanReportTable,
+    CountStatsScanReportTableField,
+    DatasetListView,
+    ScanReportListViewSet,
+)
 from .models import (
     Project,
     Dataset,
@@ -17,6 +25,9 @@ from .models import (
     ScanReportValue,
     ScanReportConcept,
     Concept,
+    MappingRule,
+    OmopTable,
+    OmopField,
 )
 
 
@@ -895,3 +906,230 @@ class TestScanReportActiveConceptFilterViewSet(TestCase):
         az_response_ids = [item["id"] for item in az_response.data]
         self.assertTrue(self.scanreportconcept2.id in az_response_ids)
         self.assertTrue(self.scanreportconcept4.id in az_response_ids)
+
+
+class TestCountStatsViews(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create(username="gimli", password="axe")
+        self.data_partner = DataPartner.objects.create(name="Dwarves")
+        self.dataset = Dataset.objects.create(
+            name="Erebor",
+            visibility=VisibilityChoices.PUBLIC,
+            data_partner=self.data_partner,
+        )
+        omop_table = OmopTable.objects.create(table="person")
+        omop_field = OmopField.objects.create(
+            table=omop_table, field="gender_concept_id"
+        )
+        # MALE, from the OMOP vocabulary
+        concept, _ = Concept.objects.get_or_create(
+            concept_id=8507,
+            defaults={
+                "concept_name": "MALE",
+                "domain_id": "Gender",
+                "vocabulary_id": "Gender",
+                "concept_class_id": "Gender",
+                "standard_concept": "S",
+                "concept_code": "M",
+                "valid_start_date": "1970-01-01",
+                "valid_end_date": "2099-12-31",
+            },
+        )
+
+        # Scan report i has i tables, each with 2 fields of 3 values, and
+        # one mapping rule per table
+        self.scanreports = []
+        self.tables = []
+        self.fields = []
+        for i in range(1, 4):
+            scanreport = ScanReport.objects.create(
+                dataset=f"The Lonely Mountain {i}", parent_dataset=self.dataset
+            )
+            self.scanreports.append(scanreport)
+            for j in range(i):
+                table = ScanReportTable.objects.create(
+                    scan_report=scanreport, name=f"Table{j}"
+                )
+                self.tables.append(table)
+                for k in range(2):
+                    field = ScanReportField.objects.create(
+                        scan_report_table=table,
+                        name=f"Field{k}",
+                        description_column="",
+                        type_column="",
+                        max_length=32,
+                        nrows=0,
+                        nrows_checked=0,
+                        fraction_empty=0.0,
+                        nunique_values=0,
+                        fraction_unique=0.0,
+                    )
+                    self.fields.append(field)
+                    for value in ["Mithril", "Gold", "Arkenstone"]:
+                        ScanReportValue.objects.create(
+                            scan_report_field=field, value=value, frequency=1
+                        )
+                MappingRule.objects.create(
+                    scan_report=scanreport,
+                    omop_field=omop_field,
+                    source_field=field,
+                    concept=ScanReportConcept.objects.create(
+                        concept=concept, content_object=field
+                    ),
+                )
+        self.factory = APIRequestFactory()
+
+    def get(self, view, param, ids):
+        ids = ",".join(str(id) for id in ids)
+        request = self.factory.get(f"/api/countstats/?{param}={ids}")
+        force_authenticate(request, user=self.user)
+        return view.as_view()(request)
+
+    def test_scan_report_counts(self):
+        ids = [scanreport.id for scanreport in self.scanreports] + [999999]
+        # The counters are read in one query, however many scan reports are asked for
+        with self.assertNumQueries(1):
+            response = self.get(CountStatsScanReport, "scan_report", ids)
+        self.assertEqual(
+            response.data,
+            [
+                {
+                    "scanreport": id,
+                    "scanreporttable_count": i,
+                    "scanreportfield_count": 2 * i,
+                    "scanreportvalue_count": 6 * i,
+                    "scanreportmappingrule_count": i,
+                }
+                for i, id in enumerate(ids[:3], start=1)
+            ]
+            + [
+                {
+                    "scanreport": 999999,
+                    "scanreporttable_count": 0,
+                    "scanreportfield_count": 0,
+                    "scanreportvalue_count": 0,
+                    "scanreportmappingrule_count": 0,
+                }
+            ],
+        )
+
+    def test_table_counts(self):
+        ids = [table.id for table in self.tables]
+        with self.assertNumQueries(1):
+            response = self.get(CountStatsScanReportTable, "scan_report_table", ids)
+        self.assertEqual(
+            response.data,
+            [
+                {
+                    "scanreporttable": id,
+                    "scanreportfield_count": 2,
+                    "scanreportvalue_count": 6,
+                }
+                for id in ids
+            ],
+        )
+
+    def test_field_counts(self):
+        ids = [field.id for field in self.fields]
+        with self.assertNumQueries(1):
+            response = self.get(
+                CountStatsScanReportTableField, "scan_report_field", ids
+            )
+        self.assertEqual(
+            response.data,
+            [{"scanreportfield": id, "scanreportvalue_count": 3} for id in ids],
+        )
+
+    def test_total_counts(self):
+        request = self.factory.get("/api/countstats/")
+        force_authenticate(request, user=self.user)
+        with self.assertNumQueries(1):
+            response = CountStats.as_view()(request)
+        self.assertEqual(
+            response.data,
+            {
+                "scanreport_count": 3,
+                "scanreporttable_count": 6,
+                "scanreportfield_count": 12,
+                "scanreportvalue_count": 36,
+                "scanreportmappingrule_count": 6,
+            },
+        )
+
+
+class TestScanReportValueListings(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username="bilbo", password="sting")
+        data_partner = DataPartner.objects.create(name="Hobbits")
+        dataset = Dataset.objects.create(name="The Shire", data_partner=data_partner)
+        self.scan_report = ScanReport.objects.create(
+            dataset="Red Book of Westmarch", parent_dataset=dataset
+        )
+        self.table = ScanReportTable.objects.create(
+            scan_report=self.scan_report, name="Hobbiton"
+        )
+        field = ScanReportField.objects.create(
+            scan_report_table=self.table,
+            name="Family",
+            description_column="",
+            type_column="",
+            max_length=32,
+            nrows=0,
+            nrows_checked=0,
+            fraction_empty=0.0,
+            nunique_values=0,
+            fraction_unique=0.0,
+        )
+        families = ["Baggins", "Took", "Brandybuck", "Gamgee", "Proudfoot"]
+        ScanReportValue.objects.bulk_create(
+            ScanReportValue(
+                scan_report_field=field,
+                scan_report=self.scan_report,
+                value=family,
+                frequency=i,
+            )
+            for i, family in enumerate(families)
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = (
+            f"/api/scanreportvaluesfilterscanreport/?scan_report={self.scan_report.id}"
+        )
+
+    def test_all_at_once(self):
+        response = self.client.get(self.url)
+        self.assertEqual(len(response.data), 5)
+
+    def test_cursor(self):
+        response = self.client.get(f"{self.url}&page_size=2")
+        values = [value["value"] for value in response.data["results"]]
+        while response.data["next"]:
+            response = self.client.get(response.data["next"])
+            values += [value["value"] for value in response.data["results"]]
+        self.assertEqual(
+            values, ["Baggins", "Took", "Brandybuck", "Gamgee", "Proudfoot"]
+        )
+
+    def test_ndjson(self):
+        response = self.client.get(
+            f"/api/scanreportvaluesfilterscanreporttable/"
+            f"?scan_report_table={self.table.id}&format=ndjson&fields=value,frequency"
+        )
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(
+            [json.loads(line) for line in lines][:2],
+            [{"value": "Baggins", "frequency": 0}, {"value": "Took", "frequency": 1}],
+        )
+        self.assertEqual(len(lines), 5)
+
+        # Streamed values are the same as those listed at once
+        ScanReportValue.objects.filter(value="Took").update(conceptID=8507)
+        url = f"/api/scanreportvaluepks/?scan_report={self.scan_report.id}"
+        response = self.client.get(url, HTTP_ACCEPT="application/x-ndjson")
+        lines = b"".join(response.streaming_content).splitlines()
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            json.loads(self.client.get(url, HTTP_ACCEPT="application/json").content),
+        )
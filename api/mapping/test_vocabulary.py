@@ -0,0 +1,71 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from data.models import Concept, Vocabulary
+from .services_vocabulary import get_vocabulary_cache, get_vocabulary_version
+
+
+class TestVocabularyCache(TestCase):
+    def setUp(self):
+        get_vocabulary_cache().clear()
+        self.addCleanup(get_vocabulary_cache().clear)
+        Vocabulary.objects.create(
+            vocabulary_id="Quenya",
+            vocabulary_name="High-elven",
+            vocabulary_reference="Valinor",
+            vocabulary_version="First Age",
+            vocabulary_concept_id=0,
+        )
+        Concept.objects.create(
+            concept_id=1,
+            concept_name="Mellon",
+            concept_code="FRIEND",
+            vocabulary_id="Quenya",
+            domain_id="Observation",
+            concept_class_id="Word",
+            valid_start_date="1970-01-01",
+            valid_end_date="2099-12-31",
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(
+            get_user_model().objects.create(username="gandalf", password="mellon")
+        )
+
+    def test_cached(self):
+        url = "/api/omop/conceptsfilter/?concept_code=FRIEND"
+        response = self.client.get(url)
+        self.assertEqual(response.data[0]["concept_name"], "Mellon")
+        self.assertIn("max-age=86400", response["Cache-Control"])
+        etag = response["ETag"]
+
+        Concept.objects.filter(concept_id=1).update(concept_name="Friend")
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.data[0]["concept_name"], "Mellon")
+        self.assertEqual(response["ETag"], etag)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Each query is cached on its own
+        response = self.client.get("/api/omop/concepts/1/")
+        self.assertEqual(response.data["concept_name"], "Friend")
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_new_vocabulary(self):
+        url = "/api/omop/vocabularies/"
+        etag = self.client.get(url)["ETag"]
+        version = get_vocabulary_version()
+        Vocabulary.objects.filter(pk="Quenya").update(vocabulary_version="Third Age")
+        get_vocabulary_cache().delete("vocabulary-version")
+        self.assertNotEqual(get_vocabulary_version(), version)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data[0]["vocabulary_version"], "Third Age")
+
+        with override_settings(VOCABULARY_VERSION="Fourth Age"):
+            self.assertEqual(get_vocabulary_version(), "Fourth Age")
+
+    def test_not_found(self):
+        self.assertEqual(self.client.get("/api/omop/concepts/2/").status_code, 404)
+        Concept.objects.filter(concept_id=1).update(concept_id=2)
+        self.assertEqual(self.client.get("/api/omop/concepts/2/").status_code, 200)
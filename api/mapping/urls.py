@@ -134,6 +134,7 @@ routers.register(
     r"mappingrulesfilter", views.MappingRuleFilterViewSet, basename="mappingrulefilter"
 )
 routers.register(r"analyse", views.AnalyseRules, basename="getanalysis")
+routers.register(r"jobs", views.JobViewSet, basename="jobs")
 
 urlpatterns = [
     path(
@@ -142,6 +143,21 @@ urlpatterns = [
         name="countprojects",
     ),
     path(r"api/countstats/", views.CountStats.as_view(), name="countstats"),
+    path(
+        r"api/omop/conceptsearch/",
+        views.ConceptSearchView.as_view(),
+        name="conceptsearch",
+    ),
+    path(
+        r"api/mappingrulesgraph/<int:pk>/",
+        views.MappingRulesGraphView.as_view(),
+        name="mappingrulesgraph",
+    ),
+    path(
+        r"api/mappingrulessvg/<int:pk>/",
+        views.MappingRulesSVGView.as_view(),
+        name="mappingrulessvg",
+    ),
     path(
         r"api/countstatsscanreport/",
         views.CountStatsScanReport.as_view(),
@@ -251,6 +267,16 @@ urlpatterns = [
         views.ScanReportAssertionsUpdateView.as_view(),
         name="scan-report-assertion-update",
     ),
+    path(
+        r"api/nlpcache/lookup/",
+        views.NLPCacheLookupView.as_view(),
+        name="nlp_cache_lookup",
+    ),
+    path(
+        r"api/nlpcache/",
+        views.NLPCacheStoreView.as_view(),
+        name="nlp_cache_store",
+    ),
     path("nlp/run", views.run_nlp_field_level, name="run-nlp"),
     path("nlp/table/run", views.run_nlp_table_level, name="run-nlp-table"),
     path(
@@ -9,6 +9,8 @@ from azure.storage.queue import QueueClient
 from azure.storage.blob import BlobServiceClient, ContentSettings
 
 from rest_framework import status, viewsets, generics
+from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.generics import (
@@ -16,11 +18,12 @@ from rest_framework.generics import (
     RetrieveAPIView,
 )
 from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
 
-from .paginations import CustomPagination
+from .paginations import CustomPagination, ValueCursorPagination
+from .renderers import NDJSONRenderer, iter_ndjson
 
 from .serializers import (
-    GetRulesAnalysis,
     ScanReportEditSerializer,
     ScanReportViewSerializer,
     ScanReportTableEditSerializer,
@@ -30,6 +33,7 @@ from .serializers import (
     ScanReportValueEditSerializer,
     ScanReportValueViewSerializer,
     ScanReportConceptSerializer,
+    ActiveScanReportConceptSerializer,
     ClassificationSystemSerializer,
     DataDictionarySerializer,
     DataPartnerSerializer,
@@ -44,6 +48,7 @@ from .serializers import (
     ProjectSerializer,
     ProjectNameSerializer,
     ProjectDatasetSerializer,
+    JobSerializer,
 )
 from .serializers import (
     ConceptSerializer,
@@ -68,6 +73,7 @@ from data.models import (
 )
 
 from data.models import Concept
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import PasswordChangeForm, PasswordResetForm
@@ -75,15 +81,17 @@ from django.contrib.auth.models import User
 from django.contrib.auth.tokens import default_token_generator
 from django.contrib.auth.views import PasswordChangeDoneView
 from django.core.mail import BadHeaderError, send_mail
+from django.db.models import Count, Sum
 from django.db.models.query_utils import Q
 from django.core.exceptions import ObjectDoesNotExist
-from django.http import HttpResponse, JsonResponse
-from django.shortcuts import redirect, render
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
 from django.urls import reverse, reverse_lazy
 from django.utils.decorators import method_decorator
 from django.utils.encoding import force_bytes
-from django.utils.http import urlsafe_base64_encode
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, urlsafe_base64_encode
 from django.views.decorators.csrf import csrf_protect
 from django.views.decorators.debug import sensitive_post_parameters
 from django.views.generic import ListView
@@ -106,9 +114,13 @@ from .models import (
     ScanReportValue,
     MappingRule,
     ScanReportConcept,
+    ActiveScanReportConcept,
     ClassificationSystem,
     Dataset,
-    VisibilityChoices,
+    AccessRoleChoices,
+    Job,
+    JobKind,
+    JobStatus,
 )
 from .permissions import (
     CanViewProject,
@@ -118,29 +130,93 @@ from .permissions import (
     has_editorship,
     has_viewership,
     is_admin,
+    is_az_function_user,
 )
 from .services import download_data_dictionary_blob
 
-from .services_nlp import start_nlp_field_level
+from .services_nlp import start_nlp_field_level, lookup_nlp_cache, store_nlp_cache
+from .services_counters import deferred_counters
+from .services_jobs import submit_job
+from .services_hierarchy import get_concept_hierarchy
+from .services_search import MAX_RESULTS, search_concepts
+from .services_vocabulary import (
+    get_vocabulary_cache,
+    get_vocabulary_etag,
+    get_vocabulary_version,
+)
 
 from .services_rules import (
-    save_mapping_rules,
-    remove_mapping_rules,
-    find_existing_scan_report_concepts,
     download_mapping_rules,
     download_mapping_rules_as_csv,
+    etag_matches,
+    get_mapping_rules_artifact,
+    get_mapping_rules_graph,
     get_mapping_rules_list,
-    view_mapping_rules,
+    get_mapping_rules_page,
     m_allowed_tables,
+    not_modified,
 )
 
 
-class ConceptViewSet(viewsets.ReadOnlyModelViewSet):
+class DeferredCountersViewMixin:
+    """
+    Create and delete rows with their counter changes summed and applied
+    once, in the same transaction, rather than once per row.
+    """
+
+    def perform_create(self, serializer):
+        with deferred_counters():
+            super().perform_create(serializer)
+
+    def perform_destroy(self, instance):
+        with deferred_counters():
+            super().perform_destroy(instance)
+
+
+class VocabularyCacheMixin:
+    """
+    Caches the responses of a read-only vocabulary viewset for the loaded
+    vocabulary version, and lets clients reuse them with `ETag` and
+    `Cache-Control`.
+    """
+
+    def get_cached_response(self, respond, request, *args, **kwargs):
+        etag = get_vocabulary_etag(
+            get_vocabulary_version(), type(self).__name__, request.get_full_path()
+        )
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            cache = get_vocabulary_cache()
+            key = f"vocabulary:{etag[1:-1]}"
+            data = cache.get(key)
+            if data is None:
+                response = respond(request, *args, **kwargs)
+                if response.status_code != status.HTTP_200_OK:
+                    return response
+                cache.set(key, response.data)
+            else:
+                response = Response(data)
+        response["ETag"] = etag
+        # Responses depend on the user being logged in, so only they reuse them
+        patch_cache_control(
+            response, private=True, max_age=settings.VOCABULARY_CACHE_SECONDS
+        )
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.get_cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.get_cached_response(super().retrieve, request, *args, **kwargs)
+
+
+class ConceptViewSet(VocabularyCacheMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Concept.objects.all()
     serializer_class = ConceptSerializer
 
 
-class ConceptFilterViewSet(viewsets.ReadOnlyModelViewSet):
+class ConceptFilterViewSet(VocabularyCacheMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Concept.objects.all()
     serializer_class = ConceptSerializer
     filter_backends = [DjangoFilterBackend]
@@ -151,19 +227,55 @@ class ConceptFilterViewSet(viewsets.ReadOnlyModelViewSet):
     }
 
 
-class VocabularyViewSet(viewsets.ReadOnlyModelViewSet):
+class ConceptSearchView(APIView):
+    """
+    Search for concepts by name, code or synonym with `q`, best matches first,
+    optionally only those with the given `vocabulary_id`, `domain_id` and
+    `standard_concept`. Each concept has the `rank` of its match.
+    """
+
+    def get(self, request):
+        filters = {
+            name: request.query_params[name]
+            for name in ("vocabulary_id", "domain_id", "standard_concept")
+            if name in request.query_params
+        }
+        try:
+            limit = int(request.query_params.get("limit", 20))
+        except ValueError:
+            return Response(
+                {"limit": "Must be a number."}, status=status.HTTP_400_BAD_REQUEST
+            )
+        if limit < 1:
+            return Response(
+                {"limit": "Must be at least 1."}, status=status.HTTP_400_BAD_REQUEST
+            )
+        limit = min(limit, MAX_RESULTS)
+        results = []
+        for concept, rank in search_concepts(
+            request.query_params.get("q", ""), filters, limit
+        ):
+            result = ConceptSerializer(concept).data
+            result["rank"] = rank
+            results.append(result)
+        return Response(results)
+
+
+class VocabularyViewSet(VocabularyCacheMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Vocabulary.objects.all()
     serializer_class = VocabularySerializer
 
 
-class ConceptRelationshipViewSet(viewsets.ReadOnlyModelViewSet):
+class ConceptRelationshipViewSet(VocabularyCacheMixin, viewsets.ReadOnlyModelViewSet):
     queryset = ConceptRelationship.objects.all()
     serializer_class = ConceptRelationshipSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["concept_id_1", "concept_id_2", "relationship_id"]
 
 
-class ConceptRelationshipFilterViewSet(viewsets.ReadOnlyModelViewSet):
+class ConceptRelationshipFilterViewSet(
+    VocabularyCacheMixin, viewsets.ReadOnlyModelViewSet
+):
     queryset = ConceptRelationship.objects.all()
     serializer_class = ConceptRelationshipSerializer
     filter_backends = [DjangoFilterBackend]
@@ -174,29 +286,76 @@ class ConceptRelationshipFilterViewSet(viewsets.ReadOnlyModelViewSet):
     }
 
 
-class ConceptAncestorViewSet(viewsets.ReadOnlyModelViewSet):
+class ConceptAncestorViewSet(VocabularyCacheMixin, viewsets.ReadOnlyModelViewSet):
     queryset = ConceptAncestor.objects.all()
     serializer_class = ConceptAncestorSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["ancestor_concept_id", "descendant_concept_id"]
 
+    def list(self, request, *args, **kwargs):
+        """
+        Look up the descendants or the ancestors of a single concept in the
+        concept hierarchy index, if there is one.
+        """
+        concept_hierarchy = get_concept_hierarchy()
+        params = {
+            name: request.query_params[name]
+            for name in self.filterset_fields
+            if name in request.query_params
+        }
+        if (
+            concept_hierarchy is None
+            or len(params) != 1
+            or len(request.query_params) != 1
+            or not next(iter(params.values())).isdigit()
+        ):
+            return super().list(request, *args, **kwargs)
+
+        name, concept_id = next(iter(params.items()))
+        concept_id = int(concept_id)
+        if name == "ancestor_concept_id":
+            rows = [
+                (concept_id, descendant, min_level, max_level)
+                for descendant, min_level, max_level in concept_hierarchy.descendants(
+                    concept_id
+                )
+            ]
+        else:
+            rows = [
+                (ancestor, concept_id, min_level, max_level)
+                for ancestor, min_level, max_level in concept_hierarchy.ancestors(
+                    concept_id
+                )
+            ]
+        return Response(
+            [
+                {
+                    "ancestor_concept_id": ancestor,
+                    "descendant_concept_id": descendant,
+                    "min_levels_of_separation": min_level,
+                    "max_levels_of_separation": max_level,
+                }
+                for ancestor, descendant, min_level, max_level in rows
+            ]
+        )
 
-class ConceptClassViewSet(viewsets.ReadOnlyModelViewSet):
+
+class ConceptClassViewSet(VocabularyCacheMixin, viewsets.ReadOnlyModelViewSet):
     queryset = ConceptClass.objects.all()
     serializer_class = ConceptClassSerializer
 
 
-class ConceptSynonymViewSet(viewsets.ReadOnlyModelViewSet):
+class ConceptSynonymViewSet(VocabularyCacheMixin, viewsets.ReadOnlyModelViewSet):
     queryset = ConceptSynonym.objects.all()
     serializer_class = ConceptSynonymSerializer
 
 
-class DomainViewSet(viewsets.ReadOnlyModelViewSet):
+class DomainViewSet(VocabularyCacheMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Domain.objects.all()
     serializer_class = DomainSerializer
 
 
-class DrugStrengthViewSet(viewsets.ReadOnlyModelViewSet):
+class DrugStrengthViewSet(VocabularyCacheMixin, viewsets.ReadOnlyModelViewSet):
     queryset = DrugStrength.objects.all()
     serializer_class = DrugStrengthSerializer
     filter_backends = [DjangoFilterBackend]
@@ -309,108 +468,8 @@ class ScanReportListViewSet(viewsets.ModelViewSet):
             return ScanReport.objects.all().distinct()
 
         return ScanReport.objects.filter(
-            # parent dataset and SR are public checks
-            Q(
-                # parent dataset and SR are public
-                parent_dataset__visibility=VisibilityChoices.PUBLIC,
-                visibility=VisibilityChoices.PUBLIC,
-            )
-            # parent dataset is public but SR restricted checks
-            | Q(
-                # parent dataset is public
-                # SR is restricted and user is in SR viewers
-                parent_dataset__visibility=VisibilityChoices.PUBLIC,
-                viewers=self.request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset is public
-                # SR is restricted and user is in SR editors
-                parent_dataset__visibility=VisibilityChoices.PUBLIC,
-                editors=self.request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset is public
-                # SR is restricted and user is SR author
-                parent_dataset__visibility=VisibilityChoices.PUBLIC,
-                author=self.request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset is public
-                # SR is restricted and user is in parent dataset editors
-                parent_dataset__visibility=VisibilityChoices.PUBLIC,
-                parent_dataset__editors=self.request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset is public
-                # SR is restricted and user is in parent dataset admins
-                parent_dataset__visibility=VisibilityChoices.PUBLIC,
-                parent_dataset__admins=self.request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            # parent dataset and SR are restricted checks
-            | Q(
-                # parent dataset and SR are restricted
-                # user is in SR viewers
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                viewers=self.request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset and SR are restricted
-                # user is in SR editors
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                editors=self.request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset and SR are restricted
-                # user is SR author
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                author=self.request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset and SR are restricted
-                # user is in parent dataset admins
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                parent_dataset__admins=self.request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                # parent dataset and SR are restricted
-                # user is in parent dataset editors
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                parent_dataset__editors=self.request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            # parent dataset is restricted but SR is public checks
-            | Q(
-                # parent dataset is restricted and SR public
-                # user is in parent dataset editors
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                parent_dataset__editors=self.request.user.id,
-                visibility=VisibilityChoices.PUBLIC,
-            )
-            | Q(
-                # parent dataset is restricted and SR public
-                # user is in parent dataset admins
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                parent_dataset__admins=self.request.user.id,
-                visibility=VisibilityChoices.PUBLIC,
-            )
-            | Q(
-                # parent dataset is restricted and SR public
-                # user is in parent dataset viewers
-                parent_dataset__visibility=VisibilityChoices.RESTRICTED,
-                parent_dataset__viewers=self.request.user.id,
-                visibility=VisibilityChoices.PUBLIC,
-            ),
-            parent_dataset__project__members=self.request.user.id,
-        ).distinct()
+            access__user=self.request.user.id, access__role=AccessRoleChoices.VIEW
+        )
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(
@@ -448,21 +507,8 @@ class DatasetListView(generics.ListAPIView):
             return Dataset.objects.all().distinct()
 
         return Dataset.objects.filter(
-            Q(visibility=VisibilityChoices.PUBLIC)
-            | Q(
-                viewers=self.request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                editors=self.request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            )
-            | Q(
-                admins=self.request.user.id,
-                visibility=VisibilityChoices.RESTRICTED,
-            ),
-            project__members=self.request.user.id,
-        ).distinct()
+            access__user=self.request.user.id, access__role=AccessRoleChoices.VIEW
+        )
 
 
 class DatasetAndDataPartnerListView(generics.ListAPIView):
@@ -492,23 +538,9 @@ class DatasetAndDataPartnerListView(generics.ListAPIView):
 
         return (
             Dataset.objects.filter(
-                Q(visibility=VisibilityChoices.PUBLIC)
-                | Q(
-                    viewers=self.request.user.id,
-                    visibility=VisibilityChoices.RESTRICTED,
-                )
-                | Q(
-                    editors=self.request.user.id,
-                    visibility=VisibilityChoices.RESTRICTED,
-                )
-                | Q(
-                    admins=self.request.user.id,
-                    visibility=VisibilityChoices.RESTRICTED,
-                ),
-                project__members=self.request.user.id,
+                access__user=self.request.user.id, access__role=AccessRoleChoices.VIEW
             )
             .prefetch_related("data_partner")
-            .distinct()
             .order_by("-id")
         )
 
@@ -563,7 +595,7 @@ class DatasetDeleteView(generics.DestroyAPIView):
         return qs
 
 
-class ScanReportTableViewSet(viewsets.ModelViewSet):
+class ScanReportTableViewSet(DeferredCountersViewMixin, viewsets.ModelViewSet):
     queryset = ScanReportTable.objects.all()
     filter_backends = [DjangoFilterBackend]
     filterset_fields = {
@@ -616,7 +648,7 @@ class ScanReportTableViewSet(viewsets.ModelViewSet):
 #     }
 
 
-class ScanReportFieldViewSet(viewsets.ModelViewSet):
+class ScanReportFieldViewSet(DeferredCountersViewMixin, viewsets.ModelViewSet):
     queryset = ScanReportField.objects.all()
     filter_backends = [DjangoFilterBackend]
     filterset_fields = {
@@ -669,7 +701,7 @@ class ScanReportFieldViewSet(viewsets.ModelViewSet):
 #     }
 
 
-class ScanReportConceptViewSet(viewsets.ModelViewSet):
+class ScanReportConceptViewSet(DeferredCountersViewMixin, viewsets.ModelViewSet):
     queryset = ScanReportConcept.objects.all()
     serializer_class = ScanReportConceptSerializer
 
@@ -693,16 +725,23 @@ class ScanReportConceptViewSet(viewsets.ModelViewSet):
                 response.status_code = 403
                 return response
         else:
-            # for each item in the list, identify any existing SRConcepts that clash, and block their creation
-            # this method may be quite slow as it has to wait for each query
+            # identify any existing SRConcepts that clash with items in the list, in one
+            # query, and block their creation, along with repeats within the list
+            existing = set(
+                ScanReportConcept.objects.filter(
+                    concept__in={item["concept"] for item in body},
+                    object_id__in={item["object_id"] for item in body},
+                ).values_list("concept", "object_id", "content_type")
+            )
             filtered = []
             for item in body:
-                concept = ScanReportConcept.objects.filter(
-                    concept=item["concept"],
-                    object_id=item["object_id"],
-                    content_type=item["content_type"],
+                key = (
+                    int(item["concept"]),
+                    int(item["object_id"]),
+                    int(item["content_type"]),
                 )
-                if concept.count() == 0:
+                if key not in existing:
+                    existing.add(key)
                     filtered.append(item)
             body = filtered
 
@@ -727,48 +766,23 @@ class ScanReportConceptFilterViewSet(viewsets.ModelViewSet):
     }
 
 
-class ScanReportActiveConceptFilterViewSet(viewsets.ModelViewSet):
+class ScanReportActiveConceptFilterViewSet(viewsets.ReadOnlyModelViewSet):
     """
     This returns details of ScanReportConcepts that have the given content_type and are
     in ScanReports that are "active" - that is, not hidden, with unhidden parent
-    dataset, and marked with status "Mapping Complete".
+    dataset, and marked with status "Mapping Complete" - along with the name of
+    their field, and their value for concepts on values.
+    They are read from the materialised `ActiveScanReportConcept` table.
     This is only retrievable by AZ_FUNCTION_USER.
     """
 
-    serializer_class = ScanReportConceptSerializer
+    serializer_class = ActiveScanReportConceptSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["content_type"]
 
     def get_queryset(self):
         if self.request.user.username == os.getenv("AZ_FUNCTION_USER"):
-
-            if self.request.GET["content_type"] == "15":
-                # ScanReportField
-                # we have SRCs with content_type 15, grab all SRFields in active SRs,
-                # and then filter ScanReportConcepts by those object_ids
-                field_ids = ScanReportField.objects.filter(
-                    scan_report_table__scan_report__hidden=False,
-                    scan_report_table__scan_report__parent_dataset__hidden=False,
-                    scan_report_table__scan_report__status="COMPLET",
-                )
-                qs = ScanReportConcept.objects.filter(
-                    content_type=15, object_id__in=field_ids
-                )
-                return qs
-            elif self.request.GET["content_type"] == "17":  #
-                # ScanReportValue
-                # we have SRCs with content_type 17, grab all SRValues in active SRs,
-                # and then filter ScanReportConcepts by those object_ids
-                value_ids = ScanReportValue.objects.filter(
-                    scan_report_field__scan_report_table__scan_report__hidden=False,
-                    scan_report_field__scan_report_table__scan_report__parent_dataset__hidden=False,
-                    scan_report_field__scan_report_table__scan_report__status="COMPLET",
-                )
-                qs = ScanReportConcept.objects.filter(
-                    content_type=17, object_id__in=value_ids
-                )
-                return qs
-            return None
+            return ActiveScanReportConcept.objects.all()
         return None
 
 
@@ -829,7 +843,7 @@ class OmopFieldFilterViewSet(viewsets.ModelViewSet):
     filterset_fields = {"id": ["in", "exact"]}
 
 
-class MappingRuleViewSet(viewsets.ModelViewSet):
+class MappingRuleViewSet(DeferredCountersViewMixin, viewsets.ModelViewSet):
     queryset = MappingRule.objects.all()
     serializer_class = MappingRuleSerializer
 
@@ -840,6 +854,24 @@ class DownloadJSON(viewsets.ModelViewSet):
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["id"]
 
+    def list(self, request, *args, **kwargs):
+        """
+        Serve the stored rules of a single scan report as they are, with an
+        `ETag` so that clients polling for unchanged rules get a 304.
+        """
+        scan_reports = list(self.filter_queryset(self.get_queryset())[:2])
+        if len(scan_reports) != 1:
+            return super().list(request, *args, **kwargs)
+
+        artifact = get_mapping_rules_artifact(scan_reports[0])
+        if etag_matches(request, artifact.etag):
+            return not_modified(artifact.etag)
+        response = HttpResponse(
+            f"[{artifact.content}]", content_type="application/json"
+        )
+        response["ETag"] = artifact.etag
+        return response
+
 
 class RulesList(viewsets.ModelViewSet):
     queryset = MappingRule.objects.all().order_by("id")
@@ -871,12 +903,19 @@ class RulesList(viewsets.ModelViewSet):
             queryset = queryset.filter(scan_report__id=_id)
         count = queryset.count()
 
-        # Get subset of mapping rules that fit onto the page to be displayed
+        # Get subset of mapping rules that fit onto the page to be displayed,
+        # either after the rule id given by `cursor`, or by page number
+        cursor = self.request.query_params.get("cursor", None)
         p = self.request.query_params.get("p", None)
-        page_size = self.request.query_params.get("page_size", None)
-        rules = get_mapping_rules_list(
-            queryset, page_number=int(p), page_size=int(page_size)
-        )
+        page_size = int(self.request.query_params.get("page_size", None))
+        if cursor is not None:
+            rules, next_cursor = get_mapping_rules_page(
+                queryset, page_size, after_id=int(cursor) if cursor else None
+            )
+        else:
+            rules = get_mapping_rules_list(
+                queryset, page_number=int(p), page_size=page_size
+            )
 
         # Process all rules
         for rule in rules:
@@ -900,14 +939,131 @@ class RulesList(viewsets.ModelViewSet):
                 "name": rule["source_field"].name,
             }
 
-        return Response(data={"count": count, "results": rules})
+        data = {"count": count, "results": rules}
+        if cursor is not None:
+            data["next_cursor"] = next_cursor
+        return Response(data=data)
 
 
-class AnalyseRules(viewsets.ModelViewSet):
-    queryset = ScanReport.objects.all()
-    serializer_class = GetRulesAnalysis
+def submit_job_response(request, data):
+    """
+    Validate and submit the job described by `data`, and return the job to
+    poll: complete (200) if its result can be reused, else accepted (202).
+    """
+    serializer = JobSerializer(data=data, context={"request": request})
+    serializer.is_valid(raise_exception=True)
+    job = submit_job(
+        serializer.validated_data["kind"],
+        serializer.validated_data["scan_report"].id,
+        user=request.user,
+        destination_table=serializer.validated_data.get("destination_table", ""),
+    )
+    return Response(
+        JobSerializer(job).data,
+        status=status.HTTP_200_OK
+        if job.status == JobStatus.COMPLETE
+        else status.HTTP_202_ACCEPTED,
+    )
+
+
+class AnalyseRules(viewsets.GenericViewSet):
+    """
+    Analyse the concepts of the scan report `id` as a job, returning the job
+    to poll. Its result is the analysis.
+    """
+
+    def list(self, request):
+        return submit_job_response(
+            request,
+            {
+                "kind": JobKind.ANALYSE_CONCEPTS,
+                "scan_report": request.query_params.get("id"),
+            },
+        )
+
+
+class JobViewSet(viewsets.ModelViewSet):
+    """
+    Start the long mapping operations on a scan report as jobs, and poll them
+    for their progress and result.
+    """
+
+    serializer_class = JobSerializer
     filter_backends = [DjangoFilterBackend]
-    filterset_fields = ["id"]
+    filterset_fields = ["scan_report", "kind", "status"]
+    http_method_names = ["get", "post"]
+
+    def get_queryset(self):
+        """
+        If the User is the `AZ_FUNCTION_USER`, return all Jobs.
+
+        Else, return only the Jobs on ScanReports the user can view.
+        """
+        if is_az_function_user(self.request.user):
+            return Job.objects.all().order_by("-id")
+
+        return Job.objects.filter(
+            scan_report__access__user=self.request.user.id,
+            scan_report__access__role=AccessRoleChoices.VIEW,
+        ).order_by("-id")
+
+    def create(self, request, *args, **kwargs):
+        """
+        Return the job to poll at once, reusing a job waiting to run or a
+        complete job whose result is still valid.
+        """
+        return submit_job_response(request, request.data)
+
+    @action(detail=True)
+    def result(self, request, pk=None):
+        job = self.get_object()
+        if job.status != JobStatus.COMPLETE:
+            return Response(
+                {"detail": f"Job {job.id} is {job.get_status_display().lower()}."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        return HttpResponse(job.result, content_type=job.content_type)
+
+
+class MappingRulesGraphView(APIView):
+    """
+    The nodes and edges of the mapping rules diagram of a scan report, for the
+    client to lay out, or its diagram drawn as an SVG.
+    Give `destination_table` to only include the rules mapped to that table.
+    """
+
+    def get_scan_report(self, request, pk):
+        scan_report = get_object_or_404(ScanReport, pk=pk)
+        if not (
+            is_az_function_user(request.user) or has_viewership(scan_report, request)
+        ):
+            raise PermissionDenied("You do not have permission to view this.")
+        return scan_report
+
+    def get(self, request, pk):
+        scan_report = self.get_scan_report(request, pk)
+        destination_table = request.query_params.get("destination_table")
+        return Response(get_mapping_rules_graph(scan_report, destination_table))
+
+
+class MappingRulesSVGView(MappingRulesGraphView):
+    """
+    Draw the mapping rules diagram of a scan report as a job, returning the
+    job to poll. Its result is the SVG, or, if the diagram is too large to
+    draw at once, its `error_details` list the `destination_tables` which can
+    be drawn one at a time.
+    """
+
+    def get(self, request, pk):
+        scan_report = self.get_scan_report(request, pk)
+        return submit_job_response(
+            request,
+            {
+                "kind": JobKind.RULES_SVG,
+                "scan_report": scan_report.id,
+                "destination_table": request.query_params.get("destination_table", ""),
+            },
+        )
 
 
 class MappingRuleFilterViewSet(viewsets.ModelViewSet):
@@ -920,7 +1076,7 @@ class MappingRuleFilterViewSet(viewsets.ModelViewSet):
     }
 
 
-class ScanReportValueViewSet(viewsets.ModelViewSet):
+class ScanReportValueViewSet(DeferredCountersViewMixin, viewsets.ModelViewSet):
     queryset = ScanReportValue.objects.all()
     filter_backends = [DjangoFilterBackend]
     filterset_fields = {
@@ -985,21 +1141,46 @@ class ScanReportFilterViewSet(viewsets.ModelViewSet):
     }
 
 
-class ScanReportValuesFilterViewSetScanReport(viewsets.ModelViewSet):
+class ValueListingMixin:
+    """
+    Lists the values of a whole scan report or table either all at once, a page
+    at a time with `cursor` and `page_size`, or streamed with `format=ndjson`
+    (or `Accept: application/x-ndjson`), one value per line, reading them in
+    chunks so that memory use doesn't grow with the size of the report.
+    """
+
+    pagination_class = ValueCursorPagination
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer]
+    stream_chunk_size = 2000
+
+    def list(self, request, *args, **kwargs):
+        if not isinstance(request.accepted_renderer, NDJSONRenderer):
+            return super().list(request, *args, **kwargs)
+        fields = list(self.get_serializer().fields)
+        rows = (
+            self.filter_queryset(self.get_queryset())
+            .order_by("id")
+            .values(*fields)
+            .iterator(chunk_size=self.stream_chunk_size)
+        )
+        return StreamingHttpResponse(
+            iter_ndjson(rows), content_type=NDJSONRenderer.media_type
+        )
+
+
+class ScanReportValuesFilterViewSetScanReport(ValueListingMixin, viewsets.ModelViewSet):
     serializer_class = ScanReportValueViewSerializer
     filter_backends = [DjangoFilterBackend]
-    filterset_fields = ["scan_report_field__scan_report_table__scan_report"]
+    filterset_fields = ["scan_report"]
 
     def get_queryset(self):
-        qs = ScanReportValue.objects.filter(
-            scan_report_field__scan_report_table__scan_report=self.request.GET[
-                "scan_report"
-            ]
-        )
+        qs = ScanReportValue.objects.filter(scan_report=self.request.GET["scan_report"])
         return qs
 
 
-class ScanReportValuesFilterViewSetScanReportTable(viewsets.ModelViewSet):
+class ScanReportValuesFilterViewSetScanReportTable(
+    ValueListingMixin, viewsets.ModelViewSet
+):
     serializer_class = ScanReportValueViewSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["scan_report_field__scan_report_table"]
@@ -1015,21 +1196,30 @@ class CountStats(APIView):
     renderer_classes = (JSONRenderer,)
 
     def get(self, request, format=None):
-        scanreport_count = ScanReport.objects.count()
-        scanreporttable_count = ScanReportTable.objects.count()
-        scanreportfield_count = ScanReportField.objects.count()
-        scanreportvalue_count = ScanReportValue.objects.count()
-        scanreportmappingrule_count = MappingRule.objects.count()
-        content = {
-            "scanreport_count": scanreport_count,
-            "scanreporttable_count": scanreporttable_count,
-            "scanreportfield_count": scanreportfield_count,
-            "scanreportvalue_count": scanreportvalue_count,
-            "scanreportmappingrule_count": scanreportmappingrule_count,
-        }
+        counts = ScanReport.objects.aggregate(
+            scanreport_count=Count("id"),
+            scanreporttable_count=Sum("table_count"),
+            scanreportfield_count=Sum("field_count"),
+            scanreportvalue_count=Sum("value_count"),
+            scanreportmappingrule_count=Sum("mapping_rule_count"),
+        )
+        content = {name: count or 0 for name, count in counts.items()}
         return Response(content)
 
 
+def get_counters(model, ids, *names):
+    """
+    Read the counters of the rows of `model` with the given ids.
+
+    Returns a dict mapping each id to a dict of its counters; missing ids
+    are omitted.
+    """
+    return {
+        row.pop("id"): row
+        for row in model.objects.filter(id__in=ids).values("id", *names)
+    }
+
+
 class CountStatsScanReport(APIView):
     renderer_classes = (JSONRenderer,)
 
@@ -1037,27 +1227,24 @@ class CountStatsScanReport(APIView):
         parameterlist = list(
             map(int, self.request.query_params["scan_report"].split(","))
         )
+        counters = get_counters(
+            ScanReport,
+            parameterlist,
+            "table_count",
+            "field_count",
+            "value_count",
+            "mapping_rule_count",
+        )
+
         jsonrecords = []
         for scanreport in parameterlist:
-            scanreporttable_count = ScanReportTable.objects.filter(
-                scan_report=scanreport
-            ).count()
-            scanreportfield_count = ScanReportField.objects.filter(
-                scan_report_table__scan_report=scanreport
-            ).count()
-            scanreportvalue_count = ScanReportValue.objects.filter(
-                scan_report_field__scan_report_table__scan_report=scanreport
-            ).count()
-            scanreportmappingrule_count = MappingRule.objects.filter(
-                scan_report=scanreport
-            ).count()
-
+            counts = counters.get(scanreport, {})
             scanreport_content = {
                 "scanreport": scanreport,
-                "scanreporttable_count": scanreporttable_count,
-                "scanreportfield_count": scanreportfield_count,
-                "scanreportvalue_count": scanreportvalue_count,
-                "scanreportmappingrule_count": scanreportmappingrule_count,
+                "scanreporttable_count": counts.get("table_count", 0),
+                "scanreportfield_count": counts.get("field_count", 0),
+                "scanreportvalue_count": counts.get("value_count", 0),
+                "scanreportmappingrule_count": counts.get("mapping_rule_count", 0),
             }
             jsonrecords.append(scanreport_content)
         return Response(jsonrecords)
@@ -1070,19 +1257,17 @@ class CountStatsScanReportTable(APIView):
         parameterlist = list(
             map(int, self.request.query_params["scan_report_table"].split(","))
         )
+        counters = get_counters(
+            ScanReportTable, parameterlist, "field_count", "value_count"
+        )
+
         jsonrecords = []
         for scanreporttable in parameterlist:
-            scanreportfield_count = ScanReportField.objects.filter(
-                scan_report_table=scanreporttable
-            ).count()
-            scanreportvalue_count = ScanReportValue.objects.filter(
-                scan_report_field__scan_report_table=scanreporttable
-            ).count()
-
+            counts = counters.get(scanreporttable, {})
             scanreporttable_content = {
                 "scanreporttable": scanreporttable,
-                "scanreportfield_count": scanreportfield_count,
-                "scanreportvalue_count": scanreportvalue_count,
+                "scanreportfield_count": counts.get("field_count", 0),
+                "scanreportvalue_count": counts.get("value_count", 0),
             }
             jsonrecords.append(scanreporttable_content)
         return Response(jsonrecords)
@@ -1095,14 +1280,14 @@ class CountStatsScanReportTableField(APIView):
         parameterlist = list(
             map(int, self.request.query_params["scan_report_field"].split(","))
         )
+        counters = get_counters(ScanReportField, parameterlist, "value_count")
+
         jsonrecords = []
         for scanreportfield in parameterlist:
-            scanreportvalue_count = ScanReportValue.objects.filter(
-                scan_report_field=scanreportfield
-            ).count()
+            counts = counters.get(scanreportfield, {})
             scanreportfield_content = {
                 "scanreportfield": scanreportfield,
-                "scanreportvalue_count": scanreportvalue_count,
+                "scanreportvalue_count": counts.get("value_count", 0),
             }
             jsonrecords.append(scanreportfield_content)
         return Response(jsonrecords)
@@ -1111,16 +1296,14 @@ class CountStatsScanReportTableField(APIView):
 # This custom ModelViewSet returns all ScanReportValues for a given ScanReport
 # It also removes all conceptIDs which == -1, leaving only those SRVs with a
 # concept_id which has been looked up with omop_helpers
-class ScanReportValuePKViewSet(viewsets.ModelViewSet):
+class ScanReportValuePKViewSet(ValueListingMixin, viewsets.ModelViewSet):
     serializer_class = ScanReportValueViewSerializer
     filter_backends = [DjangoFilterBackend]
-    filterset_fields = ["scan_report_field__scan_report_table__scan_report"]
+    filterset_fields = ["scan_report"]
 
     def get_queryset(self):
         qs = ScanReportValue.objects.filter(
-            scan_report_field__scan_report_table__scan_report=self.request.GET[
-                "scan_report"
-            ]
+            scan_report=self.request.GET["scan_report"]
         ).exclude(conceptID=-1)
         return qs
 
@@ -1219,8 +1402,8 @@ class StructuralMappingTableListView(ListView):
             request.POST.get("download_rules") is not None
             or body.get("download_rules", None) is not None
         ):
-            qs = self.get_queryset()
-            return download_mapping_rules(request, qs)
+            scan_report = ScanReport.objects.get(pk=self.kwargs.get("pk"))
+            return download_mapping_rules(request, scan_report)
         elif (
             request.POST.get("download_rules_as_csv") is not None
             or body.get("download_rules_as_csv", None) is not None
@@ -1231,39 +1414,35 @@ class StructuralMappingTableListView(ListView):
             request.POST.get("refresh_rules") is not None
             or body.get("refresh_rules", None) is not None
         ):
-            # remove all existing rules first
-            remove_mapping_rules(request, self.kwargs.get("pk"))
-            # get all associated ScanReportConcepts for this given ScanReport
-            ## this method could be taking too long to execute
-            all_associated_concepts = find_existing_scan_report_concepts(
-                request, self.kwargs.get("pk")
+            # bring the rules in line with the ScanReportConcepts of this ScanReport,
+            # only adding missing rules and removing unwanted ones, as a job
+            job = submit_job(
+                JobKind.REFRESH_RULES, self.kwargs.get("pk"), user=request.user
+            )
+            messages.info(
+                request,
+                f"Refreshing the rules in the background (job {job.id}). Reload the page once it has finished to see them.",
             )
-            # save all of them
-            nconcepts = 0
-            nbadconcepts = 0
-            for concept in all_associated_concepts:
-                if save_mapping_rules(request, concept):
-                    nconcepts += 1
-                else:
-                    nbadconcepts += 1
-
-            if nbadconcepts == 0:
-                messages.success(
-                    request, f"Found and added rules for {nconcepts} existing concepts"
-                )
-            else:
-                messages.success(
-                    request,
-                    f"Found and added rules for {nconcepts} existing concepts. However, couldnt add rules for {nbadconcepts} concepts.",
-                )
             return redirect(request.path)
 
         elif (
             request.POST.get("get_svg") is not None
             or body.get("get_svg", None) is not None
         ):
-            qs = self.get_queryset()
-            return view_mapping_rules(request, qs)
+            destination_table = request.POST.get("destination_table") or body.get(
+                "destination_table"
+            )
+            # drawn as a job: return the job to poll for the svg
+            job = submit_job(
+                JobKind.RULES_SVG,
+                self.kwargs.get("pk"),
+                user=request.user,
+                destination_table=destination_table or "",
+            )
+            return JsonResponse(
+                JobSerializer(job).data,
+                status=200 if job.status == JobStatus.COMPLETE else 202,
+            )
         else:
             messages.error(request, "not working right now!")
             return redirect(request.path)
@@ -1560,6 +1739,39 @@ def load_omop_fields(request):
     )
 
 
+class NLPCacheLookupView(APIView):
+    """
+    Look up documents in the NLP cache.
+
+    POST {"documents": [{"id", "text"}]} returns {"hits": {id: codes}} for
+    the documents which have been through NLP before.
+    Only the `AZ_FUNCTION_USER` and staff may look documents up, as lookups
+    count towards the hit rate and expiry of the cache.
+    """
+
+    def post(self, request):
+        if not (is_az_function_user(request.user) or request.user.is_staff):
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        hits = lookup_nlp_cache(request.data.get("documents", []))
+        return Response({"hits": hits})
+
+
+class NLPCacheStoreView(APIView):
+    """
+    Store the codes returned by the NLP service in the NLP cache.
+
+    POST {"documents": [{"text", "codes"}]}, where codes is a list of
+    [entity, category, confidence, vocabulary, code] lists.
+    Only the `AZ_FUNCTION_USER` and staff may store results.
+    """
+
+    def post(self, request):
+        if not (is_az_function_user(request.user) or request.user.is_staff):
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        store_nlp_cache(request.data.get("documents", []))
+        return Response(status=status.HTTP_201_CREATED)
+
+
 # To be removed
 # Run NLP at the field level
 def run_nlp_field_level(request):
@@ -38,6 +38,28 @@ const usePost = async (url,data,withApi=true) =>{
     const res = withApi? await response.data:response;
     return res;
 }
+// start a job on the api, and poll it until it finishes, returning its result
+const runJob = async (kind, scan_report_id, onProgress = () => {}, interval = 2000) => {
+    let job = await usePost(`/jobs/`, { kind: kind, scan_report: scan_report_id })
+    while (job.status == "PENDING" || job.status == "RUNNING") {
+        onProgress(job.progress)
+        await new Promise(resolve => setTimeout(resolve, interval))
+        job = await useGet(`/jobs/${job.id}/`)
+    }
+    if (job.status == "FAILED") {
+        console.log(job)
+        throw job
+    }
+    const response = await fetch(`/api/jobs/${job.id}/result/`)
+    if (response.status < 200 || response.status > 300) {
+        console.log(response)
+        throw response
+    }
+    if (response.headers.get('Content-Type').includes('json')) {
+        return await response.json()
+    }
+    return await response.text()
+}
 const postForm = async (url,data) =>{
     const response = await fetch(url,
     {
@@ -362,5 +384,5 @@ const getScanReportTableRows = async (id) =>{
 
 export { saveMappingRules,useGet,usePost,useDelete,getScanReportFieldValues,chunkIds,
      getScanReportField,getScanReportTable,mapConceptToOmopField,m_allowed_tables,
-     getScanReportConcepts,getScanReports,getScanReportTableRows,usePatch,postForm
+     getScanReportConcepts,getScanReports,getScanReportTableRows,usePatch,postForm,runJob
      }
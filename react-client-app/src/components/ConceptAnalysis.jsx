@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from 'react'
 import AnalysisTbl from './AnalysisTbl'
-import { useGet } from '../api/values'
+import { runJob } from '../api/values'
 
 function ConceptAnalysis({ scan_report_id }) {
 
@@ -11,7 +11,7 @@ function ConceptAnalysis({ scan_report_id }) {
 
 
     useEffect(() => {
-        useGet(`/analyse/${scan_report_id}/`).then(res => {
+        runJob("ANALYSE_CONCEPTS", scan_report_id).then(res => {
             setData(res.data)
             setLoading(false);
             setLoadingMessage("");
@@ -10,7 +10,7 @@ import {
 } from "@chakra-ui/react"
 
 import { ArrowForwardIcon } from '@chakra-ui/icons'
-import { useGet, usePost } from '../api/values'
+import { useGet, usePost, runJob } from '../api/values'
 import { set_pagination_variables } from '../api/pagination_helpers'
 import ConceptTag from './ConceptTag'
 import MappingModal from './MappingModal'
@@ -97,8 +97,7 @@ const MappingTbl = (props) => {
         if (!mapDiagram.image) {
             // if no map diagram is loaded, request to get a new one
 
-            const result = await usePost(window.location.href, { 'get_svg': true }, false);
-            const diagramString = await result.data
+            const diagramString = await runJob("RULES_SVG", scan_report_id);
             var parser = new DOMParser();
             var diagram = parser.parseFromString(diagramString, "text/html");
 
@@ -138,7 +137,7 @@ const MappingTbl = (props) => {
         setLoading(true)
         setLoadingMessage("Refreshing rules")
         try {
-            await usePost(window.location.href, { 'refresh_rules': true }, false)
+            await runJob("REFRESH_RULES", scan_report_id, progress => setLoadingMessage(`Refreshing rules (${progress}%)`))
             setLoadingMessage("Rules Refreshed. Getting Mapping Rules")
             window.location.reload(true)
         }
@@ -0,0 +1,96 @@
+import itertools
+import json
+import time
+
+import httpx
+
+FAKE_NLP_URL = (
+    "https://fake-nlp.test/text/analytics/v3.1-preview.5/entities/health/jobs"
+)
+
+
+class FakeNLPService:
+    """
+    A local stand-in for the Text Analytics for Health jobs endpoint, for
+    testing NLP clients without calling Azure. Pass fake.transport to an
+    httpx client.
+
+    POSTing documents creates a job, whose operation-location is returned in
+    the response headers. The job reports "running" until its delay has
+    elapsed, then reports final_status along with one result per document.
+
+    Args:
+        delay (float): Seconds until a new job completes
+        final_status (str): Status of a job once completed
+        retry_after (float): If set, sent as Retry-After on running jobs
+        throttle (int): Number of polls of each job answered with a 429
+        entities (list): Entities reported for every document
+    """
+
+    def __init__(
+        self,
+        delay=0.0,
+        final_status="succeeded",
+        retry_after=None,
+        throttle=0,
+        entities=None,
+    ):
+        self.delay = delay
+        self.final_status = final_status
+        self.retry_after = retry_after
+        self.throttle = throttle
+        self.entities = entities or []
+        self.jobs = {}
+        self.polls = {}
+        self._ids = itertools.count(1)
+
+    @property
+    def transport(self):
+        return httpx.MockTransport(self.handler)
+
+    def submit(self, documents, delay=None, final_status=None):
+        """
+        Create a job directly, returning its operation-location.
+        """
+        job_id = str(next(self._ids))
+        self.jobs[job_id] = {
+            "documents": documents,
+            "done_at": time.monotonic() + (self.delay if delay is None else delay),
+            "final_status": final_status or self.final_status,
+        }
+        self.polls[job_id] = 0
+        return f"{FAKE_NLP_URL}/{job_id}"
+
+    def handler(self, request):
+        if request.method == "POST":
+            documents = json.loads(request.content)["documents"]
+            location = self.submit(documents)
+            return httpx.Response(202, headers={"operation-location": location})
+
+        job_id = request.url.path.rsplit("/", 1)[-1]
+        if job_id not in self.jobs:
+            return httpx.Response(404, json={"error": {"code": "NotFound"}})
+
+        self.polls[job_id] += 1
+        if self.polls[job_id] <= self.throttle:
+            return httpx.Response(429, headers={"retry-after": "0"})
+
+        job = self.jobs[job_id]
+        if time.monotonic() < job["done_at"]:
+            headers = {}
+            if self.retry_after is not None:
+                headers["retry-after"] = str(self.retry_after)
+            return httpx.Response(200, headers=headers, json={"status": "running"})
+
+        body = {"status": job["final_status"]}
+        if job["final_status"] == "failed":
+            body["errors"] = [{"code": "InternalServerError"}]
+        else:
+            body["results"] = {
+                "documents": [
+                    {"id": document["id"], "entities": self.entities}
+                    for document in job["documents"]
+                ],
+                "errors": [],
+            }
+        return httpx.Response(200, json=body)
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import time
+
+import httpx
+
+logger = logging.getLogger("test_logger")
+
+# Job statuses reported by the Text Analytics for Health jobs endpoint
+SUCCEEDED_STATUSES = {"succeeded", "partiallyCompleted"}
+FAILED_STATUSES = {"failed", "cancelled", "cancelling"}
+
+# HTTP statuses worth retrying, anything else is a failed job
+RETRY_HTTP_STATUSES = {429, 500, 502, 503, 504}
+
+
+def get_retry_after(response):
+    """
+    Return the Retry-After header of a response in seconds,
+    or None if it is missing or not a number of seconds.
+    """
+    retry_after = response.headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        return None
+
+
+async def poll_nlp_job(
+    client,
+    url,
+    headers,
+    semaphore=None,
+    initial_delay=1.0,
+    max_delay=30.0,
+    backoff=2.0,
+    timeout=600.0,
+):
+    """
+    Poll a single NLP job until it completes, fails or passes its deadline.
+
+    The first GET is made after initial_delay, and the delay between polls
+    grows by a factor of backoff up to max_delay. While the job is running,
+    the delay is capped by the service's Retry-After, as that is when the
+    service expects the job to have progressed. When the service is throttling
+    (429) or unavailable (5xx), the Retry-After is the minimum delay instead.
+
+    If a semaphore is given, it is held for the duration of each GET to bound
+    the number of requests in flight.
+
+    Returns a tuple (results, error), exactly one of which is None.
+    """
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(1)
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None, f"timed out after {timeout}s"
+        await asyncio.sleep(min(delay, remaining))
+
+        try:
+            async with semaphore:
+                response = await client.get(url, headers=headers)
+        except httpx.HTTPError as e:
+            logger.warning(f"Error polling NLP job {url}: {e}")
+            delay = min(delay * backoff, max_delay)
+            continue
+
+        retry_after = get_retry_after(response)
+        next_delay = min(delay * backoff, max_delay)
+
+        if response.status_code in RETRY_HTTP_STATUSES:
+            delay = max(next_delay, retry_after or 0.0)
+            continue
+        if response.status_code != 200:
+            return None, f"HTTP {response.status_code}: {response.text}"
+
+        job = response.json()
+        status = job.get("status")
+        if status in SUCCEEDED_STATUSES:
+            return job["results"], None
+        if status in FAILED_STATUSES:
+            return None, f"job {status}: {job.get('errors', [])}"
+
+        if retry_after is not None:
+            next_delay = max(min(next_delay, retry_after), initial_delay)
+        delay = next_delay
+
+
+async def poll_nlp_jobs(urls, headers, client=None, max_concurrency=10, **kwargs):
+    """
+    Poll many NLP jobs concurrently, with at most max_concurrency requests
+    in flight at a time. Extra keyword arguments are passed on to
+    poll_nlp_job().
+
+    Input: urls - A list of operation-location URLs
+    Output: (results, failures) - Dicts mapping each URL to either the
+            results of the job, or a description of why it failed
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    def poll(client, url):
+        return poll_nlp_job(client, url, headers, semaphore=semaphore, **kwargs)
+
+    if client is None:
+        async with httpx.AsyncClient() as client:
+            outcomes = await asyncio.gather(*[poll(client, url) for url in urls])
+    else:
+        outcomes = await asyncio.gather(*[poll(client, url) for url in urls])
+
+    results = {}
+    failures = {}
+    for url, (result, error) in zip(urls, outcomes):
+        if error is None:
+            results[url] = result
+        else:
+            logger.error(f"NLP job {url} failed: {error}")
+            failures[url] = error
+
+    return results, failures
+
+
+def get_nlp_jobs(urls, headers, **kwargs):
+    """
+    Synchronous wrapper around poll_nlp_jobs() for use from queue triggers.
+    """
+    return asyncio.run(poll_nlp_jobs(urls, headers, **kwargs))
@@ -1,9 +1,9 @@
 import os
-import time
 import requests
 import logging
 from collections import defaultdict, OrderedDict
 from ProcessQueue import helpers
+from shared_code import nlp_poller
 
 api_url = os.environ.get("APP_URL") + "api/"
 api_header = {"Authorization": "Token {}".format(os.environ.get("AZ_FUNCTION_KEY"))}
@@ -174,6 +174,70 @@ def get_concept_from_concept_code(concept_code, vocabulary_id, no_source_concept
         return (source_concept, concept)
 
 
+def get_concept_ids_from_concept_codes_batch(vocabulary_codes):
+    """
+    Given an iterable of (vocabulary_id, concept_code) pairs, as returned by the
+    NLP service, return a dictionary mapping each pair that is recognised in the
+    vocabularies to the concept_id of its standard concept.
+
+    The pairs are de-duplicated, and looked up with one paginated conceptsfilter
+    query per vocabulary, then one find_standard_concept_batch() for all
+    non-standard source concepts, rather than with up to three requests per pair.
+    Where a source concept maps to several standard concepts, the first is used.
+    """
+    # NLP returns SNOMED as SNOMEDCT_US, and RxNorm as RXNORM
+    nlp_to_omop_vocabulary = {"SNOMEDCT_US": "SNOMED", "RXNORM": "RxNorm"}
+
+    vocabulary_codes = set(vocabulary_codes)
+    codes_by_vocabulary = defaultdict(set)
+    for vocabulary_id, concept_code in vocabulary_codes:
+        omop_vocabulary_id = nlp_to_omop_vocabulary.get(vocabulary_id, vocabulary_id)
+        codes_by_vocabulary[omop_vocabulary_id].add(str(concept_code))
+
+    # Obtain the source concepts given the codes of each vocab
+    source_concepts = {}
+    for vocabulary_id, concept_codes in codes_by_vocabulary.items():
+        for page in helpers.paginate(
+            sorted(concept_codes), max_chars=max_chars_for_get
+        ):
+            get_concepts = requests.get(
+                url=f"{api_url}omop/conceptsfilter/",
+                headers=api_header,
+                params={
+                    "concept_code__in": ",".join(page),
+                    "vocabulary_id": vocabulary_id,
+                },
+            )
+            for concept in get_concepts.json():
+                source_concepts.setdefault(
+                    (vocabulary_id, concept["concept_code"]), concept
+                )
+
+    # Look up the standard concepts of all non-standard source concepts at once
+    standard_concepts = find_standard_concept_batch(
+        [
+            concept
+            for concept in source_concepts.values()
+            if concept["standard_concept"] != "S"
+        ]
+    )
+
+    concept_ids = {}
+    for vocabulary_id, concept_code in vocabulary_codes:
+        omop_vocabulary_id = nlp_to_omop_vocabulary.get(vocabulary_id, vocabulary_id)
+        source_concept = source_concepts.get((omop_vocabulary_id, str(concept_code)))
+        if source_concept is None:
+            continue
+        if source_concept["standard_concept"] == "S":
+            concept_ids[(vocabulary_id, concept_code)] = source_concept["concept_id"]
+        elif standard_concepts.get(source_concept["concept_id"]):
+            concept_ids[(vocabulary_id, concept_code)] = standard_concepts[
+                source_concept["concept_id"]
+            ][0]
+
+    return concept_ids
+
+
 def concept_code_to_id(codes):
     """
     This functions looks up standard and valid conceptIDs for concept codes
@@ -189,36 +253,34 @@ def concept_code_to_id(codes):
         "nlp_code",
         "conceptid",
     ]
+    concept_ids = get_concept_ids_from_concept_codes_batch(
+        (str(item[4]), str(item[5])) for item in codes
+    )
     for item in codes:
-        try:
-            x = get_concept_from_concept_code(
-                concept_code=str(item[5]), vocabulary_id=str(item[4])
-            )
-
-            item.append(x[1]["concept_id"])
-            codes_dict.append(dict(zip(keys, item)))
-        except:
+        concept_id = concept_ids.get((str(item[4]), str(item[5])))
+        if concept_id is None:
             print("Concept Code", item[5], "not found!")
+            continue
+
+        item.append(concept_id)
+        codes_dict.append(dict(zip(keys, item)))
 
     return codes_dict
 
 
 def get_data_from_nlp(url, headers, post_response_url):
+    """
+    Poll the NLP jobs at the POST'ed URLs concurrently until they complete,
+    and return the results of the last job.
 
-    for url in post_response_url:
-
-        req = requests.get(url, headers=headers)
-        job = req.json()
-
-        while job["status"] != "succeeded":
-            print("Waiting...")
-            req = requests.get(url, headers=headers)
-            job = req.json()
-            time.sleep(3)
-        else:
-            get_response = job["results"]
+    Raises a RuntimeError if any job failed or did not complete in time,
+    rather than waiting forever.
+    """
+    results, failures = nlp_poller.get_nlp_jobs(post_response_url, headers)
+    if failures:
+        raise RuntimeError(f"NLP jobs did not succeed: {failures}")
 
-    return get_response
+    return results[post_response_url[-1]]
 
 
 def process_nlp_response(get_response):
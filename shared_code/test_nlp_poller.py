@@ -0,0 +1,83 @@
+import asyncio
+import time
+import unittest
+
+import httpx
+
+from shared_code.fake_nlp_service import FAKE_NLP_URL, FakeNLPService
+from shared_code.nlp_poller import poll_nlp_jobs
+
+# Keep the tests fast, while still exercising the backoff
+FAST = {"initial_delay": 0.01, "max_delay": 0.05}
+
+
+def run(fake, urls, **kwargs):
+    async def main():
+        async with httpx.AsyncClient(transport=fake.transport) as client:
+            return await poll_nlp_jobs(urls, {}, client=client, **{**FAST, **kwargs})
+
+    return asyncio.run(main())
+
+
+class TestNLPPoller(unittest.TestCase):
+    def test_jobs_are_polled_concurrently(self):
+        fake = FakeNLPService(delay=0.2)
+        urls = [
+            fake.submit([{"language": "en", "id": f"{i}_value", "text": "Male"}])
+            for i in range(20)
+        ]
+        start = time.monotonic()
+        results, failures = run(fake, urls)
+        # 20 jobs of 0.2s complete together rather than one after another
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(failures, {})
+        self.assertEqual(set(results), set(urls))
+        self.assertEqual(results[urls[3]]["documents"][0]["id"], "3_value")
+
+    def test_backoff_bounds_polls(self):
+        fake = FakeNLPService(delay=0.3)
+        url = fake.submit([])
+        run(fake, [url])
+        # Polling every max_delay at worst, rather than spinning
+        self.assertLessEqual(fake.polls["1"], 0.3 / 0.05 + 3)
+
+    def test_retry_after_caps_delay(self):
+        fake = FakeNLPService(delay=0.3, retry_after=0.3)
+        url = fake.submit([])
+        start = time.monotonic()
+        results, failures = run(
+            fake, [url], initial_delay=0.2, backoff=10.0, max_delay=10.0
+        )
+        # Without the cap the second poll would be 2s after the first
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertIn(url, results)
+
+    def test_throttled_polls_are_retried(self):
+        fake = FakeNLPService(throttle=2)
+        url = fake.submit([])
+        results, failures = run(fake, [url])
+        self.assertIn(url, results)
+        self.assertEqual(fake.polls["1"], 3)
+
+    def test_failed_jobs_are_surfaced(self):
+        fake = FakeNLPService()
+        ok = fake.submit([])
+        failed = fake.submit([], final_status="failed")
+        missing = f"{FAKE_NLP_URL}/999"
+        results, failures = run(fake, [ok, failed, missing])
+        self.assertEqual(set(results), {ok})
+        self.assertIn("failed", failures[failed])
+        self.assertIn("404", failures[missing])
+
+    def test_deadline(self):
+        fake = FakeNLPService(delay=60)
+        url = fake.submit([])
+        start = time.monotonic()
+        results, failures = run(fake, [url], timeout=0.2)
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(results, {})
+        self.assertIn("timed out", failures[url])
+
+
+if __name__ == "__main__":
+    unittest.main()